@@ -0,0 +1,453 @@
+import argparse
+import asyncio
+import contextlib
+import io
+import json
+import multiprocessing
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+import zipfile
+from concurrent.futures import ProcessPoolExecutor
+
+from aiohttp import web
+
+try:
+    import resource
+except ImportError:
+    # Not available on Windows: the peak memory is not reported there.
+    resource = None
+
+MB = 1024 * 1024
+
+# Download paths that can be benchmarked: the synchronous functions.py path and the asynchronous engine, which
+# also drives the GUI's DownloadManager and the command line.
+PATHS = ('functions', 'engine')
+
+
+class MockPatreon:
+    """
+    Local stand-in for Patreon serving synthetic creators.
+
+    Serves a creator page referencing the campaign, a paginated posts feed with one zip attachment per post and
+    the attachments themselves, valid zip archives so they pass verification. Every response can be delayed and randomly replaced by 503 Service Unavailable,
+    the same way for every run with the same seed.
+    """
+
+    def __init__(self, creators=4, pages=3, posts_per_page=10, file_size=256 * 1024, latency=0.0, error_rate=0.0,
+                 seed=0):
+        """
+        Initializes the MockPatreon.
+
+        :param creators: Number of creators.
+        :type creators: int
+        :param pages: Number of posts pages of every creator.
+        :type pages: int
+        :param posts_per_page: Number of posts on a page.
+        :type posts_per_page: int
+        :param file_size: Size of every attachment, in bytes.
+        :type file_size: int
+        :param latency: Delay before every response, in seconds.
+        :type latency: float
+        :param error_rate: Share of the responses replaced by 503 Service Unavailable, from 0 to 1.
+        :type error_rate: float
+        :param seed: Seed of the random errors.
+        :type seed: int
+        """
+        self.creators = creators
+        self.pages = pages
+        self.posts_per_page = posts_per_page
+        self.latency = latency
+        self.error_rate = error_rate
+        self.body = self.archive(file_size)
+        self._random = random.Random(seed)
+
+    @staticmethod
+    def archive(size):
+        """
+        Builds a zip archive of roughly the given size.
+
+        :param size: Size in bytes.
+        :type size: int
+        :return: Archive content.
+        :rtype: bytes
+        """
+        buffer = io.BytesIO()
+        with zipfile.ZipFile(buffer, 'w', zipfile.ZIP_STORED) as archive:
+            archive.writestr('mod.package', b'DBPF' + b'\0' * max(size - 150, 0))
+        return buffer.getvalue()
+
+    @property
+    def files_total(self):
+        return self.creators * self.pages * self.posts_per_page
+
+    @staticmethod
+    def campaign_id(index):
+        return str(1000 + index)
+
+    async def _fail(self):
+        """
+        Waits for the configured latency and decides whether the response is an error.
+
+        :return: Whether to answer 503 Service Unavailable.
+        :rtype: bool
+        """
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        return self._random.random() < self.error_rate
+
+    def page(self, base, campaign_id, number):
+        """
+        Builds a posts page.
+
+        :param base: Base URL of the server.
+        :type base: str
+        :param campaign_id: Campaign ID.
+        :type campaign_id: str
+        :param number: Page number, from 0.
+        :type number: int
+        :return: Posts page as the Patreon API returns it.
+        :rtype: dict
+        """
+        posts, included = [], []
+        for index in range(self.posts_per_page):
+            post_id = f'{campaign_id}{number:04d}{index:04d}'
+            posts.append({
+                'id': post_id,
+                'type': 'post',
+                'attributes': {'title': f'Post {post_id}', 'published_at': '2024-01-01T00:00:00.000+00:00',
+                               'content': '<p>' + 'Lorem ipsum dolor sit amet. ' * 40 + '</p>'},
+                'relationships': {'attachments': {'data': [{'id': post_id, 'type': 'attachment'}]}},
+            })
+            included.append({
+                'id': post_id,
+                'type': 'attachment',
+                'attributes': {'name': f'{campaign_id}-{post_id}.zip', 'url': f'{base}/files/{post_id}.zip'},
+            })
+
+        page = {'data': posts, 'included': included, 'meta': {'pagination': {'total': self.pages * len(posts)}}}
+        if number + 1 < self.pages:
+            page['links'] = {'next': f'{base}/api/posts?filter[campaign_id]={campaign_id}&page[cursor]={number + 1}'}
+        return page
+
+    async def creator(self, request):
+        if await self._fail():
+            return web.Response(status=503)
+        name = request.match_info['name']
+        if not name.startswith('creator-'):
+            raise web.HTTPNotFound()
+        campaign_id = self.campaign_id(int(name[len('creator-'):]))
+        return web.Response(text=f'<html><link href="https://www.patreon.com/api/campaigns/{campaign_id}"></html>',
+                            content_type='text/html')
+
+    async def posts(self, request):
+        if await self._fail():
+            return web.Response(status=503)
+        campaign_id = request.query['filter[campaign_id]']
+        number = int(request.query.get('page[cursor]', 0))
+        return web.json_response(self.page(f'{request.scheme}://{request.host}', campaign_id, number))
+
+    async def file(self, request):
+        if await self._fail():
+            return web.Response(status=503)
+        return web.Response(body=self.body, content_type='application/zip')
+
+    def app(self):
+        """
+        Builds the aiohttp application of the server.
+
+        :return: Application.
+        :rtype: aiohttp.web.Application
+        """
+        app = web.Application()
+        app.router.add_get('/api/posts', self.posts)
+        app.router.add_get('/files/{name}', self.file)
+        app.router.add_get('/{name}', self.creator)
+        return app
+
+
+def serve(options, ready):
+    """
+    Runs a MockPatreon on a free local port until the process is terminated. Runs in a separate process, so
+    the server does not count towards the measured memory and CPU time.
+
+    :param options: Arguments passed to MockPatreon.
+    :type options: dict
+    :param ready: Queue receiving the port once the server listens.
+    :type ready: multiprocessing.Queue
+    :return: None
+    """
+    async def run():
+        runner = web.AppRunner(MockPatreon(**options).app(), access_log=None)
+        await runner.setup()
+        await web.TCPSite(runner, '127.0.0.1', 0).start()
+        ready.put(runner.addresses[0][1])
+        await asyncio.Event().wait()
+
+    asyncio.run(run())
+
+
+@contextlib.contextmanager
+def mock_server(options):
+    """
+    Starts a MockPatreon in a separate process for the duration of the block.
+
+    :param options: Arguments passed to MockPatreon.
+    :type options: dict
+    :return: Context manager giving the base URL of the server.
+    """
+    context = multiprocessing.get_context('spawn')
+    ready = context.Queue()
+    process = context.Process(target=serve, args=(options, ready), daemon=True)
+    process.start()
+    try:
+        yield f'http://127.0.0.1:{ready.get(timeout=30)}'
+    finally:
+        process.terminate()
+        process.join()
+
+
+def peak_rss():
+    """
+    Returns the peak resident memory of the current process.
+
+    :return: Peak memory in MB, or None where it cannot be measured.
+    :rtype: float or None
+    """
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Bytes on macOS, kilobytes elsewhere.
+    return peak / MB if sys.platform == 'darwin' else peak / 1024
+
+
+def run_functions(urls, folder, api_url):
+    """
+    Downloads the files of the creators one by one with the synchronous functions.py path.
+
+    :param urls: Creator URLs on the mock server.
+    :type urls: list
+    :param folder: Path to the download folder.
+    :type folder: str
+    :param api_url: Posts API URL of the mock server.
+    :type api_url: str
+    :return: None
+    """
+    import requests
+
+    import retry
+    from functions import download_file, process_page
+    from matcher import FileMatcher
+    from resolver import find_campaign_id, iter_creator_pages
+
+    session = requests.Session()
+    matcher = FileMatcher(['zip'])
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        for url in urls:
+            response = retry.get(session, url)
+            response.raise_for_status()
+            for page in iter_creator_pages(session, url, find_campaign_id(response.text), api_url=api_url):
+                download_file(process_page(page, matcher), folder, session=session)
+
+
+def run_engine(urls, folder, api_url, max_concurrency=8, rate=1000.0):
+    """
+    Downloads the files of the creators with the asynchronous engine.
+
+    :param urls: Creator URLs on the mock server.
+    :type urls: list
+    :param folder: Path to the download folder.
+    :type folder: str
+    :param api_url: Posts API URL of the mock server.
+    :type api_url: str
+    :param max_concurrency: Maximum number of files downloaded at the same time.
+    :type max_concurrency: int
+    :param rate: Maximum number of requests per second to the API and to the file host.
+    :type rate: float
+    :return: None
+    """
+    from engine import Engine
+
+    engine = Engine(urls, folder, extensions=['zip'], api_url=api_url, max_concurrency=max_concurrency,
+                    api_rate=rate, host_rate=rate, log=lambda text: None)
+    try:
+        asyncio.run(engine.run())
+    finally:
+        engine.close()
+
+
+def measure(path, urls, api_url, max_concurrency=8, rate=1000.0):
+    """
+    Runs one download path and measures it. Runs in a fresh process with a temporary home folder, so neither
+    the memory of an earlier run nor the state kept between runs in ~/.patreonscraper skews the result.
+
+    :param path: Name of the download path, one of PATHS.
+    :type path: str
+    :param urls: Creator URLs on the mock server.
+    :type urls: list
+    :param api_url: Posts API URL of the mock server.
+    :type api_url: str
+    :param max_concurrency: Maximum number of files downloaded at the same time, where the path supports it.
+    :type max_concurrency: int
+    :param rate: Maximum number of requests per second, where the path supports it.
+    :type rate: float
+    :return: Downloaded files and bytes, wall and CPU time, throughput and peak memory.
+    :rtype: dict
+    """
+    home = tempfile.mkdtemp(prefix='patreonscraper-benchmark-')
+    # The state folder is derived from the home folder when the modules are imported.
+    os.environ['HOME'] = os.environ['USERPROFILE'] = home
+    folder = os.path.join(home, 'downloads')
+    os.makedirs(folder)
+
+    try:
+        started_at, cpu_started_at = time.perf_counter(), time.process_time()
+        if path == 'functions':
+            run_functions(urls, folder, api_url)
+        else:
+            run_engine(urls, folder, api_url, max_concurrency, rate)
+        seconds = time.perf_counter() - started_at
+        cpu_seconds = time.process_time() - cpu_started_at
+
+        names = [name for name in os.listdir(folder) if not name.startswith('.') and not name.endswith('.part')]
+        size = sum(os.path.getsize(os.path.join(folder, name)) for name in names)
+    finally:
+        shutil.rmtree(home, ignore_errors=True)
+
+    return {
+        'files': len(names),
+        'bytes': size,
+        'seconds': seconds,
+        'cpu_seconds': cpu_seconds,
+        'files_per_second': len(names) / seconds,
+        'mb_per_second': size / MB / seconds,
+        'peak_rss_mb': peak_rss(),
+    }
+
+
+def run_benchmark(paths=PATHS, max_concurrency=8, rate=1000.0, **server_options):
+    """
+    Starts a mock server and measures every download path against it, each in its own process.
+
+    :param paths: Names of the download paths to measure.
+    :type paths: list
+    :param max_concurrency: Maximum number of files downloaded at the same time, where the path supports it.
+    :type max_concurrency: int
+    :param rate: Maximum number of requests per second, where the path supports it.
+    :type rate: float
+    :param server_options: Arguments passed to MockPatreon.
+    :return: Results by path, see measure.
+    :rtype: dict
+    """
+    results = {}
+    with mock_server(server_options) as base:
+        urls = [f'{base}/creator-{index}' for index in range(server_options.get('creators', 4))]
+        for path in paths:
+            with ProcessPoolExecutor(1, mp_context=multiprocessing.get_context('spawn')) as pool:
+                future = pool.submit(measure, path, urls, f'{base}/api/posts', max_concurrency, rate)
+                results[path] = future.result()
+    return results
+
+
+def print_results(results):
+    """
+    Prints the results as a table.
+
+    :param results: Results by path, see measure.
+    :type results: dict
+    :return: None
+    """
+    print(f'{"Path":<12}{"Files":>8}{"Seconds":>10}{"Files/s":>10}{"MB/s":>10}{"Peak RSS MB":>13}{"CPU s":>8}')
+    for path, result in results.items():
+        rss = f'{result["peak_rss_mb"]:.1f}' if result['peak_rss_mb'] is not None else '-'
+        print(f'{path:<12}{result["files"]:>8}{result["seconds"]:>10.2f}'
+              f'{result["files_per_second"]:>10.1f}{result["mb_per_second"]:>10.1f}{rss:>13}'
+              f'{result["cpu_seconds"]:>8.2f}')
+
+
+def find_regressions(results, baseline, tolerance):
+    """
+    Compares the results with an earlier run.
+
+    :param results: Results by path, see measure.
+    :type results: dict
+    :param baseline: Results of the earlier run.
+    :type baseline: dict
+    :param tolerance: Allowed relative slowdown, e.g. 0.1 for 10%.
+    :type tolerance: float
+    :return: Descriptions of the metrics that got worse by more than the tolerance.
+    :rtype: list
+    """
+    regressions = []
+    for path, result in results.items():
+        before = baseline.get(path)
+        if before is None:
+            continue
+        for key in ('files_per_second', 'mb_per_second'):
+            if result[key] < before[key] * (1 - tolerance):
+                regressions.append(f'{path} {key}: {before[key]:.1f} -> {result[key]:.1f}')
+    return regressions
+
+
+def main(argv=None):
+    """
+    Runs the benchmark from the command line.
+
+    :param argv: Command line arguments. Defaults to sys.argv.
+    :type argv: list
+    :return: Exit code: 0 if every path downloaded every file without a regression, 1 otherwise.
+    :rtype: int
+    """
+    parser = argparse.ArgumentParser(
+        description='Measures the download paths against a local mock of Patreon, without any network access.')
+    parser.add_argument('--paths', nargs='+', choices=PATHS, default=list(PATHS), help='download paths to measure')
+    parser.add_argument('--creators', type=int, default=4, metavar='N', help='number of creators')
+    parser.add_argument('--pages', type=int, default=3, metavar='N', help='number of posts pages of every creator')
+    parser.add_argument('--posts', dest='posts_per_page', type=int, default=10, metavar='N',
+                        help='number of posts on a page, each with one attachment')
+    parser.add_argument('--size', type=int, default=256, metavar='KB', help='size of every attachment, in KB')
+    parser.add_argument('--latency', type=float, default=0.0, metavar='MS', help='delay before every response, in ms')
+    parser.add_argument('--error-rate', type=float, default=0.0, metavar='RATE',
+                        help='share of the responses replaced by 503 Service Unavailable, from 0 to 1')
+    parser.add_argument('--seed', type=int, default=0, help='seed of the random errors')
+    parser.add_argument('--concurrency', dest='max_concurrency', type=int, default=8, metavar='N',
+                        help='maximum number of files downloaded at the same time by the engine')
+    parser.add_argument('--rate', type=float, default=1000.0, metavar='N',
+                        help='maximum number of requests per second of the engine, 1000 by default: '
+                             'the limits meant for Patreon would hide the speed of the code')
+    parser.add_argument('--json', metavar='FILE', help='save the results as JSON, e.g. to use them as a baseline')
+    parser.add_argument('--baseline', metavar='FILE', help='results of an earlier run to compare with')
+    parser.add_argument('--tolerance', type=float, default=0.1, metavar='RATE',
+                        help='allowed slowdown compared with the baseline, 0.1 (10%%) by default')
+    args = parser.parse_args(argv)
+
+    server_options = {'creators': args.creators, 'pages': args.pages, 'posts_per_page': args.posts_per_page,
+                      'file_size': args.size * 1024, 'latency': args.latency / 1000, 'error_rate': args.error_rate,
+                      'seed': args.seed}
+    expected_files = MockPatreon(**server_options).files_total
+    results = run_benchmark(args.paths, args.max_concurrency, args.rate, **server_options)
+    print_results(results)
+
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as f:
+            json.dump(results, f, indent=1)
+
+    failed = [path for path, result in results.items() if result['files'] != expected_files]
+    for path in failed:
+        print(f'{path} downloaded {results[path]["files"]} of {expected_files} files')
+
+    regressions = []
+    if args.baseline:
+        with open(args.baseline, encoding='utf-8') as f:
+            regressions = find_regressions(results, json.load(f), args.tolerance)
+        for regression in regressions:
+            print(f'Regression: {regression}')
+
+    return 1 if failed or regressions else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,382 @@
+import argparse
+import asyncio
+import functools
+import json
+import sys
+
+from engine import Engine, dated_folder
+from layout import DEFAULT_TEMPLATE, TEMPLATE_FIELDS, OutputLayout, shard_safe
+from manifest import Manifest
+from metrics import report_json_lines
+from postprocess import load_plugins
+from sharding import run_sharded, shard_of
+from storage import MB
+from watch import Watcher, parse_interval, read_watch_file
+
+DEFAULTS = {
+    'urls': [],
+    'extensions': [],
+    'folder': '.',
+    'dated': True,
+    'incremental': False,
+    'deduplicate': False,
+    'manifest': True,
+    'verify': True,
+    'http_cache': True,
+    'offline': False,
+    'post_process': [],
+    'post_workers': 2,
+    'plugins': [],
+    'keep_archives': True,
+    'layout': DEFAULT_TEMPLATE,
+    'max_concurrency': 8,
+    'per_host_limit': 4,
+    'fan_out': 16,
+    'feed_workers': 4,
+    'api_rate': 10.0,
+    'retries': 5,
+    'chunk_size': 256 * 1024,
+    'write_buffer': 1024 * 1024,
+    'min_free': 1024 * MB,
+    'fsync_batch': 0,
+    'processes': 1,
+    'shard': None,
+    'metrics': None,
+    'metrics_interval': 1.0,
+    'watch': None,
+    'interval': '60m',
+    'jitter': 0.1,
+}
+
+
+def read_urls_file(path):
+    """
+    Reads creator URLs from a text file, one per line. Empty lines and lines starting with '#' are ignored.
+
+    :param path: Path to the text file.
+    :type path: str
+    :return: List of Patreon creator URLs.
+    :rtype: list
+    """
+    with open(path, encoding='utf-8') as f:
+        return [line.strip() for line in f if line.strip() and not line.lstrip().startswith('#')]
+
+
+def kilobytes(value):
+    """
+    Converts a command line size in KB to bytes.
+
+    :param value: Size in KB.
+    :type value: str
+    :return: Size in bytes.
+    :rtype: int
+    """
+    return int(float(value) * 1024)
+
+
+def megabytes(value):
+    """
+    Converts a command line size in MB to bytes.
+
+    :param value: Size in MB.
+    :type value: str
+    :return: Size in bytes.
+    :rtype: int
+    """
+    return int(float(value) * MB)
+
+
+def build_parser():
+    """
+    Builds the command line parser.
+
+    :return: Argument parser.
+    :rtype: argparse.ArgumentParser
+    """
+    parser = argparse.ArgumentParser(
+        description='Downloads publicly available files from Patreon creators without any prompts.')
+    parser.add_argument('urls', nargs='*', help='creator URLs like "https://www.patreon.com/creator\'s-name"')
+    parser.add_argument('-c', '--config', metavar='FILE', help='JSON file with any of the options below, '
+                                               'e.g. {"urls": [...], "extensions": ["zip"], "folder": "..."}')
+    parser.add_argument('-u', '--urls-file', metavar='FILE', help='text file with one creator URL per line')
+    parser.add_argument('-e', '--ext', dest='extensions', action='append', metavar='EXT',
+                        help='file extension like "zip", may be repeated')
+    parser.add_argument('-o', '--folder', metavar='PATH', help='download folder path')
+    parser.add_argument('--layout', metavar='TEMPLATE',
+                        help='path of a file inside the download folder, e.g. "{creator}/{post_id}/{name}"; '
+                             f'fields: {", ".join(TEMPLATE_FIELDS)}')
+    parser.add_argument('--no-dated', dest='dated', action='store_false', default=None,
+                        help='save straight into the folder instead of a "Downloaded at <date>" subfolder')
+    parser.add_argument('--incremental', action='store_true', default=None,
+                        help='download only the posts published since the last run')
+    parser.add_argument('--dedup', dest='deduplicate', action='store_true', default=None,
+                        help='keep the files in a blob store inside the download folder, shared by the dated '
+                             'folders, and hard-link them, so a file seen again is not downloaded again')
+    parser.add_argument('--no-manifest', dest='manifest', action='store_false', default=None,
+                        help='do not record the files in the manifest, download again what earlier runs downloaded')
+    parser.add_argument('--no-verify', dest='verify', action='store_false', default=None,
+                        help='do not check the downloaded files; by default zip archives are test-read and broken '
+                             'files are quarantined and downloaded again')
+    parser.add_argument('--no-http-cache', dest='http_cache', action='store_false', default=None,
+                        help='do not keep the posts pages, request every page in full')
+    parser.add_argument('--offline', action='store_true', default=None,
+                        help='send no request, replay the posts pages kept by earlier runs and only list the files')
+    parser.add_argument('--post-process', action='append', metavar='NAME',
+                        help='run a post-processor on the downloaded files while the download goes on, may be '
+                             'repeated: "extract" unpacks zip archives, "flatten" flattens the folders inside them, '
+                             '"sims" moves .package and .ts4script files into a Sims 4 "Mods" folder')
+    parser.add_argument('--plugin', dest='plugins', action='append', metavar='MODULE',
+                        help='import a module registering more post-processors, may be repeated')
+    parser.add_argument('--post-workers', type=int, metavar='N',
+                        help='number of processes running the post-processors')
+    parser.add_argument('--remove-archives', dest='keep_archives', action='store_false', default=None,
+                        help='remove archives once extracted; later runs download them again unless --incremental')
+    parser.add_argument('--report', action='store_true',
+                        help='print the number of files and bytes in the manifest by creator and status, then exit')
+    parser.add_argument('--concurrency', dest='max_concurrency', type=int, metavar='N',
+                        help='maximum number of files downloaded at the same time')
+    parser.add_argument('--per-host', dest='per_host_limit', type=int, metavar='N',
+                        help='maximum number of files downloaded at the same time from a single host')
+    parser.add_argument('--fan-out', dest='fan_out', type=int, metavar='N',
+                        help='maximum number of creator pages fetched at the same time')
+    parser.add_argument('--feed-workers', type=int, metavar='N',
+                        help='number of posts feeds walked at the same time')
+    parser.add_argument('--api-rate', type=float, metavar='N',
+                        help='maximum number of requests per second to Patreon, lowered while Patreon throttles')
+    parser.add_argument('--retries', type=int, metavar='N',
+                        help='maximum number of attempts of every request and transfer')
+    parser.add_argument('--chunk-size', type=kilobytes, metavar='KB',
+                        help='size of the chunks read from the responses, 256 KB by default')
+    parser.add_argument('--write-buffer', type=kilobytes, metavar='KB',
+                        help='size of the buffer the files are written through, 1024 KB by default')
+    parser.add_argument('--min-free', type=megabytes, metavar='MB',
+                        help='free disk space to keep, downloads wait while there is less; 1024 MB by default, '
+                             '0 to turn off')
+    parser.add_argument('--fsync-batch', type=int, metavar='N',
+                        help='flush up to N finished files to the disk together before renaming them into place')
+    parser.add_argument('--processes', type=int, metavar='N',
+                        help='split the creators between N processes, each downloading its share')
+    parser.add_argument('--shard', metavar='I/N',
+                        help='download only the I-th of N shares of the creators, e.g. to split a list '
+                             'between hosts sharing the download folder and ~/.patreonscraper')
+    parser.add_argument('--metrics', metavar='FILE',
+                        help='append progress and throughput as JSON lines to the file, "-" for the standard output')
+    parser.add_argument('--metrics-interval', type=float, metavar='SECONDS',
+                        help='time between two metrics lines, 1 second by default')
+    parser.add_argument('--watch', metavar='FILE',
+                        help='keep running and poll the creators of the file, one URL per line optionally followed '
+                             'by its interval like "6h", plus the creators given otherwise; implies --incremental')
+    parser.add_argument('--interval', metavar='TIME',
+                        help='polling interval of the watched creators without one, like "90s", "30m" or "6h", '
+                             '60m by default')
+    parser.add_argument('--jitter', type=float, metavar='FRACTION',
+                        help='largest random shift of a poll as a fraction of its interval, 0.1 by default')
+    return parser
+
+
+def load_options(argv=None):
+    """
+    Merges the defaults, the config file and the command line arguments, in this order of precedence.
+
+    :param argv: Command line arguments. Defaults to sys.argv.
+    :type argv: list
+    :return: Options.
+    :rtype: dict
+    """
+    parser = build_parser()
+    args = parser.parse_args(argv)
+
+    options = dict(DEFAULTS)
+    if args.config:
+        with open(args.config, encoding='utf-8') as f:
+            options.update(json.load(f))
+
+    for key, value in vars(args).items():
+        if key in ('config', 'urls_file', 'urls', 'report') or value is None:
+            continue
+        options[key] = value
+
+    urls = list(options['urls']) + list(args.urls)
+    if args.urls_file:
+        urls += read_urls_file(args.urls_file)
+    try:
+        options['interval'] = parse_interval(str(options['interval']))
+        options['intervals'] = read_watch_file(options['watch'], options['interval']) if options['watch'] else {}
+    except ValueError as e:
+        parser.error(str(e))
+    options['urls'] = urls + [url for url in options['intervals'] if url not in urls]
+    options['report'] = args.report
+
+    if args.report:
+        return options
+    if options['shard']:
+        try:
+            index, count = (int(number) for number in options['shard'].split('/'))
+        except ValueError:
+            parser.error('--shard must look like I/N, e.g. 1/4')
+        if not 1 <= index <= count:
+            parser.error('--shard must look like I/N with I from 1 to N')
+        options['urls'] = [url for url in options['urls'] if shard_of(url, count) == index - 1]
+        if not options['urls']:
+            parser.error(f'no creator URLs in shard {index}/{count}')
+    if not options['urls']:
+        parser.error('no creator URLs given')
+    if not options['extensions']:
+        parser.error('no file extensions given')
+    try:
+        unknown = set(options['post_process']) - load_plugins(options['plugins']) - {'flatten'}
+    except ImportError as e:
+        parser.error(f'cannot import plugin: {e}')
+    if unknown:
+        parser.error(f'unknown post-processors: {", ".join(sorted(unknown))}')
+    if options['chunk_size'] < 1 or options['write_buffer'] < 1:
+        parser.error('--chunk-size and --write-buffer must be positive')
+    if options['min_free'] < 0 or options['fsync_batch'] < 0:
+        parser.error('--min-free and --fsync-batch must not be negative')
+    if options['watch'] and (options['processes'] > 1 or options['offline']):
+        parser.error('--watch cannot be combined with --processes or --offline')
+    if not 0 <= options['jitter'] < 1:
+        parser.error('--jitter must be at least 0 and below 1')
+    try:
+        OutputLayout.check(options['layout'])
+    except ValueError as e:
+        parser.error(str(e))
+    if options['shard'] or options['processes'] > 1:
+        # Processes only resolve the path collisions of their own creators.
+        options['layout'] = shard_safe(options['layout'])
+    return options
+
+
+async def run_with_metrics(engine, path, interval):
+    """
+    Runs the engine while writing its metrics as JSON lines.
+
+    :param engine: Engine to run.
+    :type engine: Engine
+    :param path: Path to the metrics file, '-' for the standard output.
+    :type path: str
+    :param interval: Time between two metrics lines, in seconds.
+    :type interval: float
+    :return: Number of saved, linked, skipped and failed files.
+    :rtype: dict
+    """
+    stream = sys.stdout if path == '-' else open(path, 'a', encoding='utf-8')
+    reporter = asyncio.create_task(report_json_lines(engine.metrics, stream, interval))
+    try:
+        return await engine.run()
+    finally:
+        reporter.cancel()
+        await asyncio.gather(reporter, return_exceptions=True)
+        if stream is not sys.stdout:
+            stream.close()
+
+
+def run_sharded_with_metrics(options, folder, engine_options):
+    """
+    Runs a sharded download, writing the combined metrics of the shards as JSON lines if asked to.
+
+    :param options: Options.
+    :type options: dict
+    :param folder: Path to the folder where the downloaded files are saved.
+    :type folder: str
+    :param engine_options: Extra arguments passed to every Engine.
+    :type engine_options: dict
+    :return: Number of saved, linked, skipped and failed files.
+    :rtype: dict
+    """
+    if not options['metrics']:
+        return run_sharded(options['urls'], folder, options['processes'], **engine_options)
+
+    stream = sys.stdout if options['metrics'] == '-' else open(options['metrics'], 'a', encoding='utf-8')
+    last = {'time': 0.0, 'snapshot': None}
+
+    def write(snapshot):
+        stream.write(json.dumps(snapshot) + '\n')
+        stream.flush()
+
+    def progress(snapshot):
+        last['snapshot'] = snapshot
+        if snapshot['time'] - last['time'] >= options['metrics_interval']:
+            last['time'] = snapshot['time']
+            write(snapshot)
+
+    try:
+        return run_sharded(options['urls'], folder, options['processes'], progress=progress, **engine_options)
+    finally:
+        if last['snapshot'] is not None and last['snapshot']['time'] != last['time']:
+            write(last['snapshot'])
+        if stream is not sys.stdout:
+            stream.close()
+
+
+def print_report(manifest):
+    """
+    Prints the number of files and bytes in the manifest by campaign and status.
+
+    :param manifest: Manifest to summarize.
+    :type manifest: Manifest
+    :return: None
+    """
+    print(f'{"Campaign":<16}{"Status":<10}{"Files":>10}{"MB":>12}')
+    for row in manifest.summary():
+        print(f'{row["campaign_id"]:<16}{row["status"]:<10}{row["files"]:>10}{row["bytes"] / 1024 / 1024:>12.1f}')
+
+
+def main(argv=None):
+    """
+    Runs a download without any prompts.
+
+    :param argv: Command line arguments. Defaults to sys.argv.
+    :type argv: list
+    :return: Exit code: 0 if every file was downloaded, 1 otherwise.
+    :rtype: int
+    """
+    options = load_options(argv)
+    if options['report']:
+        print_report(Manifest())
+        return 0
+
+    engine_options = {key: options[key] for key in ('extensions', 'max_concurrency', 'per_host_limit', 'fan_out',
+                                                    'feed_workers', 'incremental', 'deduplicate', 'manifest', 'verify',
+                                                    'api_rate', 'retries', 'http_cache', 'offline', 'post_process',
+                                                    'post_workers', 'plugins', 'keep_archives', 'layout',
+                                                    'chunk_size', 'write_buffer', 'min_free', 'fsync_batch')}
+    engine_options['store_folder'] = options['folder']
+    engine_options['shared_state'] = bool(options['shard'])
+    # Metrics on the standard output are read by machines, so the log lines go to the standard error then.
+    log = functools.partial(print, file=sys.stderr) if options['metrics'] == '-' else print
+    engine_options['log'] = log
+    if options['watch']:
+        intervals = {url: options['intervals'].get(url, options['interval']) for url in options['urls']}
+        watcher = Watcher(intervals, options['folder'], options['dated'], options['jitter'], **engine_options)
+        log(f'- Watching {len(intervals)} creators, press Ctrl+C to stop.')
+        try:
+            asyncio.run(watcher.run())
+        except KeyboardInterrupt:
+            log('- Watching stopped.')
+        return 0
+
+    folder = dated_folder(options['folder']) if options['dated'] else options['folder']
+    log(f'- Folder is ready! {folder}')
+
+    if options['processes'] > 1:
+        stats = run_sharded_with_metrics(options, folder, engine_options)
+    elif options['metrics']:
+        engine = Engine(options['urls'], folder, **engine_options)
+        try:
+            stats = asyncio.run(run_with_metrics(engine, options['metrics'], options['metrics_interval']))
+        finally:
+            engine.close()
+    else:
+        engine = Engine(options['urls'], folder, **engine_options)
+        try:
+            stats = asyncio.run(engine.run())
+        finally:
+            engine.close()
+
+    log(f'- Download completed! {stats}')
+    return 1 if stats['failed'] else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,251 @@
+import codecs
+import json
+
+from extractor import FILE_RELATIONSHIPS
+
+# Top-level lists of a posts page that are decoded one object at a time.
+STREAMED_KEYS = ('data', 'included')
+
+POST_ATTRIBUTES = ('published_at', 'title', 'post_file')
+FILE_ATTRIBUTES = ('name', 'url', 'file_name', 'download_url', 'size_bytes', 'mimetype')
+FILE_TYPES = ('attachment', 'media')
+
+_WHITESPACE = ' \t\n\r'
+
+
+def slim_post(post):
+    """
+    Keeps only the parts of a post used for downloading: its ID, date, title, post file and file relationships.
+    Drops the HTML content, the teaser and the rest, which make up most of a page.
+
+    :param post: Post object from the posts feed.
+    :type post: dict
+    :return: Slimmed post.
+    :rtype: dict
+    """
+    attributes = post.get('attributes') or {}
+    relationships = post.get('relationships') or {}
+    return {
+        'id': post.get('id'),
+        'type': post.get('type'),
+        'attributes': {key: attributes[key] for key in POST_ATTRIBUTES if key in attributes},
+        'relationships': {key: relationships[key] for key in FILE_RELATIONSHIPS if key in relationships},
+    }
+
+
+def slim_included(item):
+    """
+    Keeps only the file attributes of an `attachment` or `media` object and drops every other included object.
+
+    :param item: Included object.
+    :type item: dict
+    :return: Slimmed object, or None if the object does not describe a file.
+    :rtype: dict or None
+    """
+    if item.get('type') not in FILE_TYPES:
+        return None
+    attributes = item.get('attributes') or {}
+    return {
+        'id': item.get('id'),
+        'type': item.get('type'),
+        'attributes': {key: attributes[key] for key in FILE_ATTRIBUTES if key in attributes},
+    }
+
+
+SLIMMERS = {'data': slim_post, 'included': slim_included}
+
+
+class PageDecoder:
+    """
+    Incremental decoder of a posts page.
+
+    Takes the response body chunk by chunk. The `data` and `included` lists are decoded one object at a time
+    as soon as the object is complete, slimmed down and the raw text is dropped, so neither the whole body
+    nor the full decoded document is ever held in memory. The other top-level members, like `links` and
+    `meta`, are small and kept as they are.
+    """
+
+    def __init__(self, slimmers=None):
+        """
+        Initializes the PageDecoder.
+
+        :param slimmers: Functions reducing the objects of the streamed lists, by list name. An object the function
+            returns None for is dropped. Defaults to SLIMMERS.
+        :type slimmers: dict
+        """
+        self.slimmers = SLIMMERS if slimmers is None else slimmers
+        self.page = {}
+
+        self._text = codecs.getincrementaldecoder('utf-8')()
+        self._decoder = json.JSONDecoder()
+        self._buffer = ''
+        self._pos = 0
+        self._state = 'start'
+        self._key = None
+        self._done = False
+
+    def _skip_whitespace(self):
+        while self._pos < len(self._buffer) and self._buffer[self._pos] in _WHITESPACE:
+            self._pos += 1
+        return self._pos < len(self._buffer)
+
+    def _expect(self, chars):
+        if not self._skip_whitespace():
+            return None
+        char = self._buffer[self._pos]
+        if char not in chars:
+            raise ValueError(f'Unexpected {char!r} at position {self._pos} of the posts page')
+        self._pos += 1
+        return char
+
+    def _value(self, final):
+        """
+        Decodes the JSON value at the current position.
+
+        :return: True and the value, or False and None if the value is not complete yet.
+        :rtype: tuple
+        """
+        if not self._skip_whitespace():
+            return False, None
+        try:
+            value, end = self._decoder.raw_decode(self._buffer, self._pos)
+        except json.JSONDecodeError:
+            if final:
+                raise
+            return False, None
+        # A number at the end of the buffer may still continue in the next chunk.
+        if end == len(self._buffer) and not final:
+            return False, None
+        self._pos = end
+        return True, value
+
+    def _parse(self, final=False):
+        while not self._done:
+            if self._state == 'start':
+                if self._expect('{') is None:
+                    return
+                self._state = 'key'
+
+            elif self._state == 'key':
+                if not self._skip_whitespace():
+                    return
+                if self._buffer[self._pos] == '}':
+                    self._pos += 1
+                    self._done = True
+                    return
+                complete, self._key = self._value(final)
+                if not complete:
+                    return
+                self._state = 'colon'
+
+            elif self._state == 'colon':
+                if self._expect(':') is None:
+                    return
+                if self._key in self.slimmers:
+                    self._state = 'list'
+                else:
+                    self._state = 'value'
+
+            elif self._state == 'value':
+                complete, value = self._value(final)
+                if not complete:
+                    return
+                self.page[self._key] = value
+                self._state = 'next_key'
+
+            elif self._state == 'list':
+                if not self._skip_whitespace():
+                    return
+                if self._buffer[self._pos] != '[':
+                    self._state = 'value'
+                    continue
+                self._pos += 1
+                self.page[self._key] = []
+                self._state = 'item'
+
+            elif self._state in ('item', 'next_item'):
+                if not self._skip_whitespace():
+                    return
+                if self._buffer[self._pos] == ']':
+                    self._pos += 1
+                    self._state = 'next_key'
+                    continue
+                if self._state == 'next_item':
+                    self._expect(',')
+                    self._state = 'item'
+                    continue
+                complete, item = self._value(final)
+                if not complete:
+                    return
+                item = self.slimmers[self._key](item) if isinstance(item, dict) else None
+                if item is not None:
+                    self.page[self._key].append(item)
+                self._state = 'next_item'
+                self._buffer, self._pos = self._buffer[self._pos:], 0
+
+            elif self._state == 'next_key':
+                char = self._expect(',}')
+                if char is None:
+                    return
+                if char == '}':
+                    self._done = True
+                    return
+                self._state = 'key'
+
+    def feed(self, chunk):
+        """
+        Decodes the next chunk of the response body.
+
+        :param chunk: Chunk of the body.
+        :type chunk: bytes
+        :return: None
+        """
+        self._buffer += self._text.decode(chunk)
+        self._parse()
+
+    def close(self):
+        """
+        Decodes the rest of the body and returns the page.
+
+        :return: Decoded, slimmed posts page.
+        :rtype: dict
+        """
+        self._buffer += self._text.decode(b'', final=True)
+        self._parse(final=True)
+        if not self._done:
+            raise ValueError('The posts page ended unexpectedly')
+        return self.page
+
+
+def decode_page(chunks, slimmers=None):
+    """
+    Decodes a posts page from an iterable of body chunks.
+
+    :param chunks: Iterable of byte chunks, e.g. requests' iter_content.
+    :type chunks: iterable
+    :param slimmers: Functions reducing the objects of the streamed lists, see PageDecoder.
+    :type slimmers: dict
+    :return: Decoded, slimmed posts page.
+    :rtype: dict
+    """
+    decoder = PageDecoder(slimmers)
+    for chunk in chunks:
+        decoder.feed(chunk)
+    return decoder.close()
+
+
+async def adecode_page(chunks, slimmers=None):
+    """
+    Asynchronous counterpart of decode_page, e.g. for aiohttp's response.content.iter_chunked.
+
+    :param chunks: Asynchronous iterable of byte chunks.
+    :type chunks: async_iterable
+    :param slimmers: Functions reducing the objects of the streamed lists, see PageDecoder.
+    :type slimmers: dict
+    :return: Decoded, slimmed posts page.
+    :rtype: dict
+    """
+    decoder = PageDecoder(slimmers)
+    async for chunk in chunks:
+        decoder.feed(chunk)
+    return decoder.close()
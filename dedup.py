@@ -0,0 +1,272 @@
+import hashlib
+import os
+import shutil
+import time
+
+from state import JsonStore
+
+STORE_NAME = '.blobs'
+
+# Age below which a stored file is never pruned, as another process may be about to link it, in seconds.
+PRUNE_GRACE = 24 * 3600
+
+
+def hash_file(path, chunk_size=1024 * 1024):
+    """
+    Starts a SHA-256 hash with the content of an existing file, e.g. the part of a download already on disk.
+
+    :param path: Path to the file.
+    :type path: str
+    :param chunk_size: Size of the chunks read from the file, in bytes.
+    :type chunk_size: int
+    :return: Hash object to be updated with the rest of the content.
+    :rtype: hashlib._Hash
+    """
+    hasher = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            hasher.update(chunk)
+    return hasher
+
+
+class BlobStore:
+    """
+    Content-addressed store of downloaded files.
+
+    Every file is kept once, under its SHA-256 hash, and linked into the download folders. The index remembers
+    which URL and which ETag and size gave which content, so a file that is already in the store costs
+    no bandwidth when it shows up again under another post, name or dated folder.
+
+    Files are hard-linked into the download folders, so the store lives inside the main download folder, on
+    the same drive. A stored file no download links to any more is pruned, so deleting downloads frees the space.
+    """
+
+    def __init__(self, root):
+        """
+        Initializes the BlobStore and loads its index.
+
+        :param root: Path to the store folder.
+        :type root: str
+        """
+        self.root = root
+        self.index = JsonStore(os.path.join(root, 'index.json'))
+        self.index.merge_depth = 2
+        self.index.entries.setdefault('urls', {})
+        self.index.entries.setdefault('validators', {})
+
+    @classmethod
+    def inside(cls, folder):
+        """
+        Creates the store kept in a hidden folder inside the main download folder, shared by its dated folders.
+
+        :param folder: Path to the main download folder.
+        :type folder: str
+        :return: Blob store.
+        :rtype: BlobStore
+        """
+        return cls(os.path.join(folder, STORE_NAME))
+
+    def links_supported(self, folder):
+        """
+        Checks that files of the store can be hard-linked into a folder. FAT and exFAT drives, or a folder on
+        another drive, cannot, and copying every file would double the disk use instead of saving it.
+
+        :param folder: Path to the download folder.
+        :type folder: str
+        :return: True if hard links work.
+        :rtype: bool
+        """
+        probe_path = os.path.join(self.root, f'probe-{os.getpid()}')
+        link_path = os.path.join(folder, f'.blobs-probe-{os.getpid()}')
+        try:
+            os.makedirs(self.root, exist_ok=True)
+            os.makedirs(folder, exist_ok=True)
+            with open(probe_path, 'wb'):
+                pass
+            os.link(probe_path, link_path)
+            os.remove(link_path)
+            return True
+        except OSError:
+            return False
+        finally:
+            if os.path.exists(probe_path):
+                os.remove(probe_path)
+
+    @staticmethod
+    def validator(etag, size):
+        """
+        Builds the index key of a response from its ETag and size.
+
+        :param etag: ETag of the response.
+        :type etag: str
+        :param size: Size of the file in bytes.
+        :type size: int
+        :return: Index key, or None if either value is unknown.
+        :rtype: str or None
+        """
+        if not etag or size is None:
+            return None
+        return f'{etag}|{size}'
+
+    def blob_path(self, digest):
+        """
+        Returns the path of a blob.
+
+        :param digest: Hex SHA-256 digest of the content.
+        :type digest: str
+        :return: Path to the blob.
+        :rtype: str
+        """
+        return os.path.join(self.root, digest[:2], digest)
+
+    def find(self, url=None, etag=None, size=None):
+        """
+        Looks up a file that is already in the store by its URL or by its ETag and size.
+
+        :param url: File URL.
+        :type url: str
+        :param etag: ETag of the response.
+        :type etag: str
+        :param size: Size of the file in bytes.
+        :type size: int
+        :return: Digest of the stored content, or None.
+        :rtype: str or None
+        """
+        candidates = [self.index.entries['urls'].get(url),
+                      self.index.entries['validators'].get(self.validator(etag, size))]
+        for digest in candidates:
+            if digest is not None and os.path.exists(self.blob_path(digest)):
+                return digest
+        return None
+
+    def link(self, digest, target_path):
+        """
+        Places a stored file at the target path. The file is copied if it cannot be linked, e.g. when it has
+        reached the link limit of the file system.
+
+        :param digest: Digest of the stored content.
+        :type digest: str
+        :param target_path: Path where the file should appear.
+        :type target_path: str
+        :return: None
+        """
+        try:
+            os.link(self.blob_path(digest), target_path)
+        except OSError:
+            shutil.copyfile(self.blob_path(digest), target_path)
+
+    def add(self, path, digest, url=None, etag=None, size=None):
+        """
+        Moves a freshly downloaded file into the store and indexes it, see put and remember.
+
+        :param path: Path to the downloaded file. It no longer exists afterwards.
+        :type path: str
+        :param digest: Digest of the content.
+        :type digest: str
+        :param url: File URL.
+        :type url: str
+        :param etag: ETag of the response.
+        :type etag: str
+        :param size: Size of the file in bytes.
+        :type size: int
+        :return: None
+        """
+        self.put(path, digest)
+        self.remember(digest, url, etag, size)
+
+    def put(self, path, digest):
+        """
+        Moves a freshly downloaded file into the store, or drops it if the same content is already stored. Only
+        the files are touched, not the index, so this can run on a worker thread.
+
+        :param path: Path to the downloaded file. It no longer exists afterwards.
+        :type path: str
+        :param digest: Digest of the content.
+        :type digest: str
+        :return: None
+        """
+        blob_path = self.blob_path(digest)
+        if os.path.exists(blob_path):
+            os.remove(path)
+        else:
+            os.makedirs(os.path.dirname(blob_path), exist_ok=True)
+            shutil.move(path, blob_path)
+
+    def remember(self, digest, url=None, etag=None, size=None):
+        """
+        Indexes stored content under the URL and the ETag and size it was downloaded with.
+
+        :param digest: Digest of the content.
+        :type digest: str
+        :param url: File URL.
+        :type url: str
+        :param etag: ETag of the response.
+        :type etag: str
+        :param size: Size of the file in bytes.
+        :type size: int
+        :return: None
+        """
+        if url:
+            self.index.entries['urls'][url] = digest
+        validator = self.validator(etag, size)
+        if validator:
+            self.index.entries['validators'][validator] = digest
+
+    def remove(self, digest):
+        """
+        Drops a stored file and the URLs and validators pointing at it, e.g. because it turned out to be broken,
+        so it is not linked again. Files placed from it earlier stay where they are.
+
+        :param digest: Digest of the stored content.
+        :type digest: str
+        :return: None
+        """
+        for entries in (self.index.entries['urls'], self.index.entries['validators']):
+            for key in [key for key, value in entries.items() if value == digest]:
+                del entries[key]
+        try:
+            os.remove(self.blob_path(digest))
+        except FileNotFoundError:
+            pass
+
+    def prune(self):
+        """
+        Removes the stored files that no download links to any more, e.g. because the downloads were deleted,
+        and forgets their URLs and validators. Files stored within the last day are kept.
+
+        :return: Number of removed files.
+        :rtype: int
+        """
+        orphans = set()
+        now = time.time()
+        for folder, _, names in os.walk(self.root):
+            if folder == self.root:
+                # The index, not a stored file.
+                continue
+            for name in names:
+                try:
+                    stat = os.stat(os.path.join(folder, name))
+                except FileNotFoundError:
+                    continue
+                if stat.st_nlink == 1 and now - stat.st_mtime > PRUNE_GRACE:
+                    orphans.add(name)
+        if not orphans:
+            return 0
+
+        for entries in (self.index.entries['urls'], self.index.entries['validators']):
+            for key in [key for key, value in entries.items() if value in orphans]:
+                del entries[key]
+        for digest in orphans:
+            try:
+                os.remove(self.blob_path(digest))
+            except FileNotFoundError:
+                pass
+        return len(orphans)
+
+    def save(self):
+        """
+        Writes the index to disk.
+
+        :return: None
+        """
+        self.index.save()
@@ -0,0 +1,433 @@
+import asyncio
+import datetime
+import os
+import sqlite3
+
+import aiohttp
+
+from dedup import BlobStore
+from extractor import extract_attachments
+from feed import CampaignNotFoundError, SyncState, aiter_new_pages, post_mark
+from httpcache import CacheMissError, ResponseCache
+from manifest import Manifest
+from layout import DEFAULT_TEMPLATE, OutputLayout, creator_name
+from matcher import FileMatcher
+from metrics import TransferMetrics
+from postprocess import PostProcessor
+from resolver import CampaignCache, aiter_creator_pages, resolve_campaign
+from retry import AdaptiveLimiter, RetryPolicy
+from scheduler import DownloadScheduler
+from settings import API_URL
+from storage import MB, DiskBudget, SyncBatcher
+from verify import Verifier
+
+# Maximum number of posts pages waiting for the extractor.
+PAGE_QUEUE_SIZE = 4
+
+
+def dated_folder(root):
+    """
+    Creates the 'Downloaded at <date>' folder of today inside the given folder.
+
+    :param root: Path to the main download folder.
+    :type root: str
+    :return: Path to the dated folder.
+    :rtype: str
+    """
+    folder = os.path.join(root, f'Downloaded at {datetime.datetime.now().strftime("%d-%m-%Y")}')
+    os.makedirs(folder, exist_ok=True)
+    return folder
+
+
+class Engine:
+    """
+    Downloads the files of many creators without any user interface.
+
+    Resolves the creators, walks their posts feeds page by page, extracts and filters the attachments and hands
+    them to a DownloadScheduler as soon as each page arrives. The GUI and the command line both drive this class.
+    """
+
+    def __init__(self, urls, download_folder, extensions=None, matcher=None, api_url=API_URL,
+                 max_concurrency=8, per_host_limit=4, fan_out=16, feed_workers=4, incremental=False,
+                 deduplicate=False, manifest=True, verify=True, api_rate=10.0, host_rate=20.0, retries=5,
+                 http_cache=True, offline=False, post_process=(), post_workers=2, plugins=(), keep_archives=True,
+                 layout=DEFAULT_TEMPLATE, chunk_size=256 * 1024, write_buffer=1024 * 1024, min_free=1024 * MB,
+                 fsync_batch=0, store_folder=None, shared_state=False, log=print, progress=None):
+        """
+        Initializes the Engine.
+
+        :param urls: List of Patreon creator URLs.
+        :type urls: list
+        :param download_folder: Path to the folder where the downloaded files are saved.
+        :type download_folder: str
+        :param extensions: Extensions like 'zip' or '*.zip' to download. Ignored if a matcher is given.
+        :type extensions: list
+        :param matcher: Matcher deciding which files are downloaded.
+        :type matcher: matcher.FileMatcher
+        :param api_url: Patreon API URL for fetching posts data.
+        :type api_url: str
+        :param max_concurrency: Maximum number of files downloaded at the same time.
+        :type max_concurrency: int
+        :param per_host_limit: Maximum number of files downloaded at the same time from a single host.
+        :type per_host_limit: int
+        :param fan_out: Maximum number of creator pages fetched at the same time.
+        :type fan_out: int
+        :param feed_workers: Number of posts feeds walked at the same time.
+        :type feed_workers: int
+        :param incremental: Whether to download only the posts published since the last run.
+        :type incremental: bool
+        :param deduplicate: Whether to keep the files in a blob store shared by the dated folders and hard-link them
+            into the download folder. Turned off where hard links are not supported.
+        :type deduplicate: bool
+        :param manifest: Whether to record the files in the manifest and skip the ones downloaded by earlier runs.
+        :type manifest: bool
+        :param verify: Whether to check the downloaded files, test-reading zip archives, and download the broken ones
+            again.
+        :type verify: bool
+        :param api_rate: Maximum number of requests per second to Patreon, lowered while Patreon throttles.
+        :type api_rate: float
+        :param host_rate: Maximum number of file requests per second to a single host.
+        :type host_rate: float
+        :param retries: Maximum number of attempts of every request and transfer.
+        :type retries: int
+        :param http_cache: Whether to keep the posts pages and request them again only if they changed.
+        :type http_cache: bool
+        :param offline: Whether to replay the cached posts pages without any request and only list the files
+            found, e.g. to work on the extractor or the filters.
+        :type offline: bool
+        :param post_process: Names of the post-processors to run on the downloaded files, e.g. 'extract', 'flatten'
+            and 'sims', see postprocess.PostProcessor.
+        :type post_process: list
+        :param post_workers: Number of worker processes of the post-processors.
+        :type post_workers: int
+        :param plugins: Names of modules registering more post-processors.
+        :type plugins: list
+        :param keep_archives: Whether to keep archives once they are extracted.
+        :type keep_archives: bool
+        :param layout: Template of the path of a file inside the download folder, e.g. '{creator}/{post_id}/{name}',
+            see layout.OutputLayout.
+        :type layout: str
+        :param chunk_size: Size of the chunks read from the responses, in bytes.
+        :type chunk_size: int
+        :param write_buffer: Size of the buffer the files are written through, in bytes.
+        :type write_buffer: int
+        :param min_free: Free space to keep on the disk, in bytes. Downloads wait while there is not enough;
+            0 turns the check off.
+        :type min_free: int
+        :param fsync_batch: Number of finished files flushed to the disk together before they are renamed into
+            place. 0 leaves flushing to the system, 1 flushes every file on its own.
+        :type fsync_batch: int
+        :param store_folder: Path to the main download folder, which holds the blob store. Defaults to the download
+            folder; dated folders pass their parent, so they share the store.
+        :type store_folder: str
+        :param shared_state: Whether several hosts share the state folder, e.g. with --shard, so the manifest
+            database does not rely on memory shared by the processes of one host.
+        :type shared_state: bool
+        :param log: Callable receiving log lines.
+        :type log: callable
+        :param progress: Optional callable receiving the TransferMetrics of the run whenever they change.
+        :type progress: callable
+        """
+        self.urls = urls
+        self.download_folder = download_folder
+        self.matcher = matcher or FileMatcher(extensions or [])
+        self.api_url = api_url
+        self.max_concurrency = max_concurrency
+        self.per_host_limit = per_host_limit
+        self.fan_out = fan_out
+        self.feed_workers = feed_workers
+        self.log = log
+        self.progress = progress
+        self.metrics = TransferMetrics()
+        self.policy = RetryPolicy(retries)
+        self.api_limiter = AdaptiveLimiter(api_rate, fan_out)
+        self.host_rate = host_rate
+        self.offline = offline
+        self.response_cache = ResponseCache(offline=offline) if http_cache or offline else None
+
+        self.campaign_cache = CampaignCache()
+        self.sync_state = SyncState() if incremental else None
+        self.store = None
+        if deduplicate:
+            store = BlobStore.inside(store_folder or download_folder)
+            if store.links_supported(download_folder):
+                self.store = store
+            else:
+                log('- Hard links are not supported in the download folder, files are not deduplicated.')
+        self.manifest = Manifest(shared=shared_state) if manifest else None
+        self.verify = verify
+        self.post_process = list(post_process)
+        self.post_workers = post_workers
+        self.plugins = list(plugins)
+        self.keep_archives = keep_archives
+        self.layout_template = layout
+        self.chunk_size = chunk_size
+        self.write_buffer = write_buffer
+        self.min_free = min_free
+        self.fsync_batch = fsync_batch
+        self.layout = None
+        self._walks = {}
+        self._file_posts = {}
+
+    def process_page(self, page):
+        """
+        Processes a posts page, extracts the files accepted by the matcher.
+
+        :param page: Decoded posts page.
+        :type page: dict
+        :return: Attachments to download.
+        :rtype: list
+        """
+        return [attachment for attachment in extract_attachments(page) if self.matcher(attachment)]
+
+    async def process_campaign(self, session, pages_queue, url, campaign_id):
+        """
+        Walks the posts feed of a campaign and passes its pages on one by one. In the incremental mode, the new
+        posts of a complete walk are kept to move the high-water mark once their files are downloaded.
+
+        :param session: Aiohttp session.
+        :type session: aiohttp.ClientSession
+        :param pages_queue: Queue receiving the creator URL, the campaign ID, the page number and the page.
+        :type pages_queue: asyncio.Queue
+        :param url: Patreon creator URL.
+        :type url: str
+        :param campaign_id: Patreon campaign ID.
+        :type campaign_id: str
+        :return: None
+        """
+        pages = aiter_creator_pages(session, url, campaign_id, self.campaign_cache, self.api_url,
+                                    policy=self.policy, limiter=self.api_limiter, response_cache=self.response_cache)
+        if self.sync_state is not None:
+            pages = aiter_new_pages(pages, self.sync_state.get(campaign_id))
+
+        page_number = 0
+        new_posts = []
+        async for page in pages:
+            page_number += 1
+            if self.sync_state is not None:
+                new_posts.extend(post_mark(post) for post in page.get('data', []))
+            await pages_queue.put((url, campaign_id, page_number, page))
+        if self.sync_state is not None:
+            self._walks[campaign_id] = new_posts
+
+    async def resolve_stage(self, session, campaigns_queue, urls=None):
+        """
+        First stage: resolves the creators, up to `fan_out` at a time, and passes each campaign on as soon as it is
+        resolved.
+
+        :param session: Aiohttp session.
+        :type session: aiohttp.ClientSession
+        :param campaigns_queue: Queue receiving the creator URL and the campaign ID.
+        :type campaigns_queue: asyncio.Queue
+        :param urls: Creator URLs to resolve. Defaults to the URLs of the engine.
+        :type urls: list
+        :return: None
+        """
+        limit = asyncio.Semaphore(self.fan_out)
+
+        async def resolve(url):
+            if self.offline:
+                campaign_id = self.campaign_cache.get(url)
+                if campaign_id is None:
+                    self.log(f'Failed to resolve {url}: the campaign ID is not cached')
+                else:
+                    await campaigns_queue.put((url, campaign_id))
+                return
+            async with limit:
+                campaign_id = await resolve_campaign(session, url, log=self.log, cache=self.campaign_cache,
+                                                     policy=self.policy, limiter=self.api_limiter)
+            if campaign_id is not None:
+                await campaigns_queue.put((url, campaign_id))
+
+        self.log('- Urls processing started...')
+        await asyncio.gather(*(resolve(url) for url in dict.fromkeys(urls or self.urls)))
+        self.campaign_cache.save()
+        self.log('- Campaigns are ready!')
+
+    async def feed_stage(self, session, campaigns_queue, pages_queue):
+        """
+        Second stage: walks the feeds of the resolved campaigns. Several of these run side by side, each taking
+        the next campaign until it receives None. A creator whose feed fails is logged and skipped.
+
+        :param session: Aiohttp session.
+        :type session: aiohttp.ClientSession
+        :param campaigns_queue: Queue of creator URLs and campaign IDs.
+        :type campaigns_queue: asyncio.Queue
+        :param pages_queue: Queue receiving the pages.
+        :type pages_queue: asyncio.Queue
+        :return: None
+        """
+        while True:
+            item = await campaigns_queue.get()
+            if item is None:
+                return
+            url, campaign_id = item
+            try:
+                await self.process_campaign(session, pages_queue, url, campaign_id)
+            except (aiohttp.ClientError, asyncio.TimeoutError, CampaignNotFoundError, CacheMissError,
+                    ValueError) as e:
+                self.log(f'Failed to process the posts of {url}: {e}')
+
+    async def extract_stage(self, pages_queue, scheduler, layout):
+        """
+        Third stage: extracts the files of each page, plans their paths and submits them to the download workers
+        until it receives None. In offline mode the files are only listed.
+
+        :param pages_queue: Queue of creator URLs, campaign IDs, page numbers and pages.
+        :type pages_queue: asyncio.Queue
+        :param scheduler: Running download scheduler, the last stage.
+        :type scheduler: DownloadScheduler
+        :param layout: Output layout placing the files.
+        :type layout: layout.OutputLayout
+        :return: None
+        """
+        while True:
+            item = await pages_queue.get()
+            if item is None:
+                return
+            url, campaign_id, page_number, page = item
+            attachments = self.process_page(page)
+            self.log(f'- Campaign {campaign_id}, page {page_number}: {len(attachments)} files found.')
+            for attachment in attachments:
+                name = layout.plan(attachment, creator_name(url), campaign_id)
+                if self.offline:
+                    self.log(f'  {name} ({attachment.url})')
+                else:
+                    self._file_posts[name] = (campaign_id, {'published_at': attachment.published_at,
+                                                            'post_id': attachment.post_id})
+                    await scheduler.submit(name, attachment.url, attachment.size,
+                                           (campaign_id, attachment.post_id, attachment.id, attachment.name))
+
+    def advance_marks(self, failed):
+        """
+        Moves the high-water marks of the campaigns walked by the run, keeping the posts with a failed file new,
+        so the next incremental run tries them again.
+
+        :param failed: Names of the files that failed.
+        :type failed: set
+        :return: None
+        """
+        failed_posts = {}
+        for name in failed:
+            if name in self._file_posts:
+                campaign_id, mark = self._file_posts[name]
+                failed_posts.setdefault(campaign_id, []).append(mark)
+        for campaign_id, posts in self._walks.items():
+            self.sync_state.advance(campaign_id, posts, failed_posts.get(campaign_id, ()))
+
+    async def relocate(self, path, destination):
+        """
+        Records where a post-processor moved a downloaded file, so the next run does not download it again.
+
+        :param path: Absolute path the file was downloaded to.
+        :type path: str
+        :param destination: Absolute path where its content went.
+        :type destination: str
+        :return: None
+        """
+        if self.manifest is None:
+            return
+        try:
+            await self.manifest.arelocate(path, destination)
+        except sqlite3.Error as e:
+            self.log(f'Error occurred while recording {destination} in the manifest: {e}')
+
+    def close(self):
+        """
+        Closes the manifest database. The verifier and the post-processor pools only live for the length of a run.
+
+        :return: None
+        """
+        if self.manifest is not None:
+            self.manifest.close()
+
+    def new_session(self):
+        """
+        Creates an aiohttp session whose keep-alive connection pool serves the download workers as well as the
+        creator pages fetched at the same time.
+
+        :return: Aiohttp session.
+        :rtype: aiohttp.ClientSession
+        """
+        return aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=max(self.max_concurrency, self.fan_out)))
+
+    async def run(self, urls=None, session=None):
+        """
+        Downloads the files of all the creators.
+
+        The work flows through four stages joined by bounded queues: the resolver, `feed_workers` feed walkers,
+        the extractor and the download workers of the scheduler. Every stage starts as soon as the one before
+        has produced something, so the first file is downloading while creators are still being resolved, and
+        a full queue holds the stages before it back, so a fast feed cannot flood the memory.
+
+        The output layout is kept by the engine, so running it again, e.g. from a watcher, does not list the
+        download folder again.
+
+        :param urls: Creator URLs to download from. Defaults to the URLs of the engine.
+        :type urls: list
+        :param session: Optional aiohttp session to reuse. A new one is created and closed otherwise.
+        :type session: aiohttp.ClientSession
+        :return: Number of saved, linked, skipped and failed files.
+        :rtype: dict
+        """
+        if session is None:
+            async with self.new_session() as session:
+                return await self.run(urls, session)
+
+        if self.layout is None:
+            self.layout = OutputLayout(self.download_folder, self.layout_template, self.manifest)
+        layout = self.layout
+        self._walks = {}
+        self._file_posts = {}
+        verifier = Verifier.inside(self.download_folder) if self.verify else None
+        post_processor = None
+        if self.post_process and not self.offline:
+            post_processor = PostProcessor(self.download_folder, self.post_process, self.post_workers, self.plugins,
+                                           self.keep_archives, self.relocate, self.log)
+        scheduler = DownloadScheduler(self.download_folder, max_concurrency=self.max_concurrency,
+                                      per_host_limit=self.per_host_limit, log=self.log, progress=self.progress,
+                                      store=self.store, metrics=self.metrics, policy=self.policy,
+                                      host_rate=self.host_rate, manifest=self.manifest, verifier=verifier,
+                                      completed=post_processor and post_processor.submit, layout=layout,
+                                      chunk_size=self.chunk_size, write_buffer=self.write_buffer,
+                                      disk_budget=DiskBudget(self.download_folder, self.min_free, log=self.log)
+                                      if self.min_free else None,
+                                      syncer=SyncBatcher(self.fsync_batch) if self.fsync_batch else None)
+        campaigns_queue = asyncio.Queue(self.fan_out)
+        pages_queue = asyncio.Queue(PAGE_QUEUE_SIZE)
+
+        async def produce():
+            await self.resolve_stage(session, campaigns_queue, urls)
+            for _ in feeds:
+                await campaigns_queue.put(None)
+            await asyncio.gather(*feeds)
+            await pages_queue.put(None)
+
+        await scheduler.start(session)
+        feeds = [asyncio.create_task(self.feed_stage(session, campaigns_queue, pages_queue))
+                 for _ in range(self.feed_workers)]
+        stages = [asyncio.create_task(produce()),
+                  asyncio.create_task(self.extract_stage(pages_queue, scheduler, layout))]
+        try:
+            await asyncio.gather(*stages)
+        finally:
+            for task in feeds + stages:
+                task.cancel()
+            await asyncio.gather(*feeds, *stages, return_exceptions=True)
+            try:
+                stats = await scheduler.join()
+            finally:
+                if verifier is not None:
+                    verifier.close()
+                if post_processor is not None:
+                    await post_processor.join()
+
+        if self.sync_state is not None and not self.offline:
+            self.advance_marks(scheduler.failed)
+            self.sync_state.save()
+        if self.store is not None and not self.offline:
+            pruned = await asyncio.get_running_loop().run_in_executor(None, self.store.prune)
+            if pruned:
+                self.store.save()
+                self.log(f'- Removed {pruned} files no download links to from the blob store.')
+        return stats
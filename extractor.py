@@ -0,0 +1,114 @@
+from typing import NamedTuple, Optional
+
+
+class Attachment(NamedTuple):
+    """
+    A downloadable file of a post.
+    """
+    post_id: str
+    name: str
+    url: str
+    size: Optional[int] = None
+    mimetype: Optional[str] = None
+    id: Optional[str] = None
+    post_title: Optional[str] = None
+    published_at: Optional[str] = None
+
+
+# Relationships of a post pointing at its files in the `included` list.
+FILE_RELATIONSHIPS = ('attachments', 'attachments_media', 'media')
+
+
+def _from_included(post_id, item):
+    """
+    Builds an attachment record from an `attachment` or `media` object of the `included` list.
+
+    :param post_id: ID of the post the object belongs to.
+    :type post_id: str
+    :param item: Included object.
+    :type item: dict
+    :return: Attachment record, or None if the object does not describe a downloadable file.
+    :rtype: Attachment or None
+    """
+    attributes = item.get('attributes') or {}
+    if item.get('type') == 'attachment':
+        name, url = attributes.get('name'), attributes.get('url')
+    elif item.get('type') == 'media':
+        name, url = attributes.get('file_name'), attributes.get('download_url')
+    else:
+        return None
+
+    if not name or not url:
+        return None
+    return Attachment(post_id, name, url, attributes.get('size_bytes'), attributes.get('mimetype'), item.get('id'))
+
+
+def _merge(known, attachment):
+    return known._replace(size=known.size or attachment.size, mimetype=known.mimetype or attachment.mimetype,
+                          id=known.id or attachment.id)
+
+
+def _renamed(attachment, index):
+    stem, dot, extension = attachment.name.rpartition('.')
+    if not dot:
+        stem, extension = attachment.name, ''
+    return attachment._replace(name=f'{stem} ({attachment.id or index + 1}){dot}{extension}')
+
+
+def extract_attachments(page):
+    """
+    Extracts the files of every post on a posts page.
+
+    Follows the `post_file` attribute and the file relationships of each post into the `included` list instead of
+    walking the whole document, so names and URLs always come from the same object. A post describes the same
+    file through several relationships, e.g. as an attachment and as a media object: the n-th object of a name in
+    one relationship is taken for the same file as the n-th object of that name in the others, and reported once.
+    Different files of a post sharing a name are all reported, the later ones with their ID, or their position,
+    added to the name.
+
+    :param page: Decoded posts page.
+    :type page: dict
+    :return: Generator of attachment records.
+    :rtype: generator
+    """
+    included = {(item.get('type'), item.get('id')): item for item in page.get('included') or []}
+
+    for post in page.get('data') or []:
+        post_id = post.get('id')
+        attributes = post.get('attributes') or {}
+        # Files by name, in the order their objects were first met.
+        found = {}
+
+        post_file = attributes.get('post_file') or {}
+        if post_file.get('name') and post_file.get('url'):
+            found[post_file['name']] = [Attachment(post_id, post_file['name'], post_file['url'])]
+
+        relationships = post.get('relationships') or {}
+        seen_objects = set()
+        for relationship in FILE_RELATIONSHIPS:
+            counts = {}
+            linked = (relationships.get(relationship) or {}).get('data') or []
+            for link in linked if isinstance(linked, list) else [linked]:
+                key = (link.get('type'), link.get('id'))
+                if key in seen_objects:
+                    continue
+                seen_objects.add(key)
+                item = included.get(key)
+                attachment = _from_included(post_id, item) if item is not None else None
+                if attachment is None:
+                    continue
+
+                same_name = found.setdefault(attachment.name, [])
+                index = counts.get(attachment.name, 0)
+                counts[attachment.name] = index + 1
+                if index < len(same_name):
+                    same_name[index] = _merge(same_name[index], attachment)
+                else:
+                    same_name.append(attachment)
+
+        for same_name in found.values():
+            for index, attachment in enumerate(same_name):
+                if index:
+                    attachment = _renamed(attachment, index)
+                yield attachment._replace(post_title=attributes.get('title'),
+                                          published_at=attributes.get('published_at'))
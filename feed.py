@@ -0,0 +1,339 @@
+import os
+
+import retry
+from decoder import adecode_page, decode_page
+from httpcache import CacheMissError
+from settings import API_URL, HEADERS, STATE_DIR
+from state import JsonStore
+
+DEFAULT_SYNC_STATE_PATH = os.path.join(STATE_DIR, 'sync.json')
+
+# Size of the chunks of a posts page handed to the incremental decoder, in bytes.
+PAGE_CHUNK_SIZE = 64 * 1024
+
+
+class CampaignNotFoundError(Exception):
+    """
+    Raised when the posts feed of a campaign does not exist, e.g. because a cached campaign ID is outdated.
+    """
+
+
+def first_page_params(campaign_id):
+    """
+    Builds the query parameters of the first page of a campaign's posts feed.
+
+    :param campaign_id: Patreon campaign ID.
+    :type campaign_id: str
+    :return: Query parameters.
+    :rtype: dict
+    """
+    return {'filter[campaign_id]': campaign_id, 'sort': '-published_at'}
+
+
+def next_page_request(page, api_url, params):
+    """
+    Finds the request for the page following the given one.
+
+    Follows `links.next` when the API provides it and falls back to the pagination cursor in `meta` otherwise.
+
+    :param page: Decoded posts page.
+    :type page: dict
+    :param api_url: Patreon API URL for fetching posts data.
+    :type api_url: str
+    :param params: Query parameters of the first page.
+    :type params: dict
+    :return: URL and query parameters of the next page, or None on the last page.
+    :rtype: tuple or None
+    """
+    next_url = (page.get('links') or {}).get('next')
+    if next_url:
+        return next_url, None
+
+    cursors = ((page.get('meta') or {}).get('pagination') or {}).get('cursors') or {}
+    if cursors.get('next'):
+        return api_url, dict(params, **{'page[cursor]': cursors['next']})
+
+    return None
+
+
+def cached_page(response_cache, url, query):
+    """
+    Looks up the stored response of a posts page.
+
+    :param response_cache: Optional response cache.
+    :type response_cache: httpcache.ResponseCache
+    :param url: Request URL.
+    :type url: str
+    :param query: Query parameters of the request.
+    :type query: dict
+    :return: Stored response, or None if it must be requested. Raises CacheMissError in offline mode
+        if the page is not stored.
+    :rtype: httpcache.CachedResponse or None
+    """
+    if response_cache is None:
+        return None
+    cached = response_cache.get(url, query)
+    if cached is None and response_cache.offline:
+        raise CacheMissError(f'No cached response for {url}')
+    return cached
+
+
+def iter_post_pages(session, campaign_id, api_url=API_URL, headers=HEADERS, policy=None, response_cache=None):
+    """
+    Yields the pages of a campaign's posts feed one by one, following the pagination until the last page.
+
+    Only one page is held at a time, so the caller can process a page before the next one is requested.
+    Each page is decoded while it is received and keeps only what is needed for downloading, see
+    decoder.PageDecoder. Throttled and failed requests are retried with backoff. Raises CampaignNotFoundError if the feed of
+    the campaign does not exist.
+
+    With a response cache, pages are requested conditionally and the stored body is decoded again when the server
+    answers 304 Not Modified. In offline mode only the stored pages are decoded.
+
+    :param session: Requests session.
+    :type session: requests.Session
+    :param campaign_id: Patreon campaign ID.
+    :type campaign_id: str
+    :param api_url: Patreon API URL for fetching posts data.
+    :type api_url: str
+    :param headers: Request headers.
+    :type headers: dict
+    :param policy: Retry policy of the requests. Defaults to retry.DEFAULT_POLICY.
+    :type policy: retry.RetryPolicy
+    :param response_cache: Optional cache of the API responses.
+    :type response_cache: httpcache.ResponseCache
+    :return: Generator of decoded posts pages.
+    :rtype: generator
+    """
+    params = first_page_params(campaign_id)
+    request = (api_url, params)
+
+    while request is not None:
+        url, query = request
+        cached = cached_page(response_cache, url, query)
+        if cached is not None and response_cache.offline:
+            page = decode_page(cached.chunks())
+        else:
+            conditional = dict(headers, **cached.validators()) if cached is not None else headers
+            with retry.get(session, url, policy, headers=conditional, params=query, stream=True) as response:
+                if response.status_code == 304 and cached is not None:
+                    page = decode_page(cached.chunks())
+                else:
+                    if response.status_code == 404 and query is params:
+                        raise CampaignNotFoundError(campaign_id)
+                    response.raise_for_status()
+                    chunks = response.iter_content(PAGE_CHUNK_SIZE)
+                    if response_cache is None:
+                        page = decode_page(chunks)
+                    else:
+                        writer = response_cache.writer(url, query, response.headers)
+                        try:
+                            page = decode_page(writer.tee(chunks))
+                        except BaseException:
+                            writer.abort()
+                            raise
+                        writer.commit()
+        yield page
+        request = next_page_request(page, api_url, params)
+
+
+async def aiter_post_pages(session, campaign_id, api_url=API_URL, headers=HEADERS, policy=None, limiter=None,
+                           response_cache=None):
+    """
+    Asynchronous counterpart of iter_post_pages built on aiohttp.
+
+    :param session: Aiohttp session.
+    :type session: aiohttp.ClientSession
+    :param campaign_id: Patreon campaign ID.
+    :type campaign_id: str
+    :param api_url: Patreon API URL for fetching posts data.
+    :type api_url: str
+    :param headers: Request headers.
+    :type headers: dict
+    :param policy: Retry policy of the requests. Defaults to retry.DEFAULT_POLICY.
+    :type policy: retry.RetryPolicy
+    :param limiter: Optional rate limiter of the API host.
+    :type limiter: retry.AdaptiveLimiter
+    :param response_cache: Optional cache of the API responses.
+    :type response_cache: httpcache.ResponseCache
+    :return: Asynchronous generator of decoded posts pages.
+    :rtype: async_generator
+    """
+    params = first_page_params(campaign_id)
+    request = (api_url, params)
+
+    while request is not None:
+        url, query = request
+        cached = cached_page(response_cache, url, query)
+        if cached is not None and response_cache.offline:
+            page = decode_page(cached.chunks())
+        else:
+            conditional = dict(headers, **cached.validators()) if cached is not None else headers
+            async with retry.request(session, url, policy, limiter, headers=conditional, params=query) as response:
+                if response.status == 304 and cached is not None:
+                    page = decode_page(cached.chunks())
+                else:
+                    if response.status == 404 and query is params:
+                        raise CampaignNotFoundError(campaign_id)
+                    response.raise_for_status()
+                    chunks = response.content.iter_chunked(PAGE_CHUNK_SIZE)
+                    if response_cache is None:
+                        page = await adecode_page(chunks)
+                    else:
+                        writer = response_cache.writer(url, query, response.headers)
+                        try:
+                            page = await adecode_page(writer.atee(chunks))
+                        except BaseException:
+                            writer.abort()
+                            raise
+                        writer.commit()
+        yield page
+        request = next_page_request(page, api_url, params)
+
+
+class SyncState(JsonStore):
+    """
+    Per-campaign high-water marks for the incremental sync mode.
+
+    A mark is the publishing date and ID of the newest post of a campaign whose files, and those of every older
+    post, were downloaded. As the feed is sorted from the newest post to the oldest one, a walk can stop as soon
+    as it reaches the marked post.
+    """
+
+    def __init__(self, path=DEFAULT_SYNC_STATE_PATH):
+        """
+        Initializes the SyncState and loads the existing marks.
+
+        :param path: Path to the JSON state file.
+        :type path: str
+        """
+        super().__init__(path)
+
+    def get(self, campaign_id):
+        """
+        Returns the high-water mark of a campaign.
+
+        :param campaign_id: Patreon campaign ID.
+        :type campaign_id: str
+        :return: Dictionary with the 'published_at' and 'post_id' of the newest seen post, or None.
+        :rtype: dict or None
+        """
+        return self.entries.get(campaign_id)
+
+    def advance(self, campaign_id, posts, failed=()):
+        """
+        Moves the high-water mark of a campaign forward after a complete walk of its new posts.
+
+        The mark moves to the newest new post if none of their files failed. Otherwise it moves to the newest post
+        older than the oldest post with a failed file, so the next run walks that post again.
+
+        :param campaign_id: Patreon campaign ID.
+        :type campaign_id: str
+        :param posts: Marks of the new posts, see post_mark.
+        :type posts: list
+        :param failed: Marks of the posts with a failed file.
+        :type failed: list
+        :return: None
+        """
+        if failed:
+            limit = min(mark_key(post) for post in failed)
+            posts = [post for post in posts if mark_key(post) < limit]
+        if not posts:
+            return
+
+        newest = max(posts, key=mark_key)
+        mark = self.get(campaign_id)
+        if mark is None or mark_key(newest) > mark_key(mark):
+            self.entries[campaign_id] = newest
+
+
+def post_mark(post):
+    """
+    Returns the high-water mark of a post.
+
+    :param post: Post object from the posts feed.
+    :type post: dict
+    :return: Dictionary with the 'published_at' and 'post_id' of the post.
+    :rtype: dict
+    """
+    return {'published_at': (post.get('attributes') or {}).get('published_at'), 'post_id': post['id']}
+
+
+def mark_key(mark):
+    """
+    Orders the posts by publishing date, then by ID, so posts published at the same second are told apart.
+    Numeric IDs are compared as numbers.
+
+    :param mark: High-water mark, see post_mark.
+    :type mark: dict
+    :return: Sort key.
+    :rtype: tuple
+    """
+    return mark['published_at'] or '', len(mark['post_id']), mark['post_id']
+
+
+def is_seen(post, mark):
+    """
+    Checks whether a post is at or below a high-water mark.
+
+    :param post: Post object from the posts feed.
+    :type post: dict
+    :param mark: High-water mark, or None.
+    :type mark: dict
+    :return: True if the post was already seen.
+    :rtype: bool
+    """
+    if mark is None:
+        return False
+    return post['id'] == mark['post_id'] or mark_key(post_mark(post)) <= mark_key(mark)
+
+
+def trim_page(page, mark):
+    """
+    Drops the already seen posts from a page, together with the included objects only they refer to.
+
+    :param page: Decoded posts page.
+    :type page: dict
+    :param mark: High-water mark, or None.
+    :type mark: dict
+    :return: Trimmed page and whether the page reached an already seen post.
+    :rtype: tuple
+    """
+    posts = page.get('data', [])
+    new_posts = [post for post in posts if not is_seen(post, mark)]
+    if len(new_posts) == len(posts):
+        return page, False
+
+    referenced = set()
+    for post in new_posts:
+        for relationship in (post.get('relationships') or {}).values():
+            linked = (relationship or {}).get('data') or []
+            for item in linked if isinstance(linked, list) else [linked]:
+                referenced.add((item['type'], item['id']))
+
+    trimmed = dict(page, data=new_posts)
+    if 'included' in page:
+        trimmed['included'] = [item for item in page['included'] if (item['type'], item['id']) in referenced]
+    return trimmed, True
+
+
+async def aiter_new_pages(pages, mark):
+    """
+    Yields only the posts published since the last sync of a campaign and stops the walk at the first seen post,
+    so no further pages are requested.
+
+    The high-water mark is not moved: the caller does it once it knows the files of the new posts were downloaded,
+    see SyncState.advance.
+
+    :param pages: Asynchronous iterable of decoded posts pages, newest first.
+    :type pages: async_iterable
+    :param mark: High-water mark of the campaign, or None.
+    :type mark: dict
+    :return: Asynchronous generator of trimmed posts pages.
+    :rtype: async_generator
+    """
+    async for page in pages:
+        page, reached_seen = trim_page(page, mark)
+        yield page
+        if reached_seen:
+            break
@@ -1,71 +1,244 @@
+import hashlib
 import os
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
 import requests
-import fnmatch
 
+import retry
+from dedup import hash_file
+from extractor import extract_attachments
+from layout import sanitize
+from resume import ResumeJournal, content_range_start
+from verify import QUARANTINE_NAME, quarantine, verify_file
 
-def unpack_data(data):
-    values = list(data.values())
-    if len(values) == 4:
-        scrapped_data, inner_list, attributes, info = values
-    elif len(values) == 3:
-        scrapped_data, inner_list, attributes = values
-    else:
-        raise ValueError("Unexpected number of items in data")
-    return inner_list
+# Number of downloaded files verified at the same time.
+VERIFY_WORKERS = 2
 
 
-def process_data_recursive(data, extensions):
+def process_page(page, matcher):
     """
-    Processes data, extracts file URLs and file names.
-
-    :param data: Data to be processed.
-    :type data: list, dict or str
-    :param extensions: Extensions to be found among files.
-    :type extensions: list
-    :return: List of file URLs and list of file names.
-    :rtype: tuple
+    Processes a posts page, extracts the files accepted by the matcher.
+
+    :param page: Decoded posts page.
+    :type page: dict
+    :param matcher: Matcher deciding which files are downloaded.
+    :type matcher: matcher.FileMatcher
+    :return: Dictionary with data for downloading files, the key - file name, the value - file URL.
+    :rtype: dict
     """
-    file_urls = []
-    file_names = []
-
-    def process_item(item):
-        if isinstance(item, list):
-            for sub_item in item:
-                print(sub_item)
-                process_item(sub_item)
-        elif isinstance(item, dict):
-            for key, value in item.items():
-                process_item(value)
-        elif isinstance(item, str):
-            if item.startswith('https://www.patreon.com/file?h'):
-                file_urls.append(item)
-            elif any(fnmatch.fnmatch(item, pattern) for pattern in extensions):
-                file_names.append(item)
-
-    for item in data:
-        process_item(item)
-
-    return file_names, file_urls
-
-
-def download_file(content_to_download: dict, download_folder_path: str):
+    return {attachment.name: attachment.url for attachment in extract_attachments(page) if matcher(attachment)}
+
+
+def preallocate(f, size):
+    """
+    Reserves disk space for a file of the given size, so it is written into one contiguous block where possible.
+
+    :param f: File opened for writing.
+    :type f: file object
+    :param size: Expected file size in bytes.
+    :type size: int
+    """
+    if hasattr(os, 'posix_fallocate'):
+        try:
+            os.posix_fallocate(f.fileno(), 0, size)
+            return
+        except OSError:
+            pass
+    f.truncate(size)
+
+
+def fetch_file(http, journal, name, url, file_path, chunk_size=1024 * 1024, preallocate_files=False, store=None,
+               policy=None):
+    """
+    Downloads a single file through a '.part' file, resuming an earlier attempt if possible.
+
+    :param http: Requests session or the requests module.
+    :param journal: Journal of the unfinished downloads of the folder.
+    :type journal: resume.ResumeJournal
+    :param name: File name.
+    :type name: str
+    :param url: File URL.
+    :type url: str
+    :param file_path: Path where the file is saved.
+    :type file_path: str
+    :param chunk_size: Size of the chunks written to disk, in bytes.
+    :type chunk_size: int
+    :param preallocate_files: Whether to reserve the disk space announced by Content-Length before writing.
+    :type preallocate_files: bool
+    :param store: Optional blob store deduplicating the downloaded files.
+    :type store: dedup.BlobStore
+    :param policy: Retry policy of the request. Defaults to retry.DEFAULT_POLICY.
+    :type policy: retry.RetryPolicy
+    :return: Outcome of the transfer: 'saved', 'linked' or 'failed'.
+    :rtype: str
+    :raises requests.exceptions.ChunkedEncodingError: If the body broke off midway. The '.part' file and the
+        journal entry are kept, so calling this again resumes the transfer.
+    """
+    temp_path = file_path + '.part'
+    hasher = None
+    etag = None
+
+    offset = journal.resume_offset(name, url, temp_path)
+    with retry.get(http, url, policy, headers=journal.request_headers(name, offset), stream=True) as response:
+        if response.status_code == 416 and offset and journal.entries[name]['size'] == offset:
+            size = written = offset
+        elif response.status_code not in (200, 206):
+            print(f'Failed to download |{name}|. Status code: {response.status_code}')
+            if response.status_code == 416 and offset:
+                os.remove(temp_path)
+                journal.discard(name)
+            return 'failed'
+        else:
+            if response.status_code == 200:
+                offset = 0
+            elif content_range_start(response.headers) != offset:
+                # Appending another range than the one asked for would corrupt the file: start over.
+                os.remove(temp_path)
+                journal.discard(name)
+                raise requests.exceptions.ChunkedEncodingError(
+                    f'got {response.headers.get("Content-Range")} instead of bytes {offset}-')
+            size = journal.record(name, url, response.status_code, offset, response.headers)
+            etag = response.headers.get('ETag')
+
+            if store is not None:
+                digest = store.find(etag=etag, size=size)
+                if digest is not None:
+                    if os.path.exists(temp_path):
+                        os.remove(temp_path)
+                    journal.discard(name)
+                    store.link(digest, file_path)
+                    print(f'Linked from the store: |{name}|')
+                    return 'linked'
+                hasher = hash_file(temp_path) if offset else hashlib.sha256()
+
+            with open(temp_path, 'ab' if offset else 'wb') as f:
+                if preallocate_files and size and not offset:
+                    # Recorded first: a run killed before the truncate below leaves a full-size file of zeros.
+                    journal.preallocating(name)
+                    preallocate(f, size)
+
+                written = offset
+                try:
+                    for chunk in response.iter_content(chunk_size):
+                        f.write(chunk)
+                        written += len(chunk)
+                        if hasher is not None:
+                            hasher.update(chunk)
+                except (requests.ConnectionError, requests.Timeout) as e:
+                    raise requests.exceptions.ChunkedEncodingError(f'stopped at {written} bytes ({e})') from e
+                finally:
+                    f.truncate(written)
+                    f.flush()
+                    journal.preallocating(name, False)
+
+    if size is not None and written != size:
+        raise requests.exceptions.ChunkedEncodingError(f'stopped at {written} of {size} bytes')
+
+    if store is None:
+        os.replace(temp_path, file_path)
+    else:
+        digest = (hasher or hash_file(temp_path)).hexdigest()
+        store.add(temp_path, digest, url, etag, size)
+        store.link(digest, file_path)
+
+    journal.discard(name)
+    print(f'Saved: |{name}|')
+    return 'saved'
+
+
+def download_file(content_to_download: dict, download_folder_path: str, chunk_size: int = 1024 * 1024,
+                  preallocate_files: bool = False, session=None, store=None, verify: bool = True):
     """
     The function downloads files.
 
+    The response body is streamed to disk in chunks instead of being held in memory. Each file is written
+    to a temporary '.part' file first and renamed once complete, so an interrupted download never looks like
+    a finished one. A '.part' file left by an earlier, interrupted run is continued with a Range request.
+    Throttled and failed requests are retried with backoff, and a transfer that breaks off is retried from where
+    it stopped.
+    With a blob store, files already held in it are linked instead of downloaded again.
+    Saved files are verified on a thread pool while the next ones download, see verify.verify_file. A broken file is
+    moved to the '.quarantine' folder and downloaded once more after the others.
+
     :param content_to_download: Dictionary with data for downloading files, the key - file name, the value - file URL.
     :type content_to_download: dict
     :param download_folder_path: Path to the folder where you want to save the downloaded files.
     :type download_folder_path: str
+    :param chunk_size: Size of the chunks written to disk, in bytes.
+    :type chunk_size: int
+    :param preallocate_files: Whether to reserve the disk space announced by Content-Length before writing.
+    :type preallocate_files: bool
+    :param session: Optional requests session to reuse connections.
+    :type session: requests.Session
+    :param store: Optional blob store deduplicating the downloaded files.
+    :type store: dedup.BlobStore
+    :param verify: Whether to check the saved files and download the broken ones again.
+    :type verify: bool
     """
+    http = session or requests
+    journal = ResumeJournal(download_folder_path)
+    quarantine_folder = os.path.join(download_folder_path, QUARANTINE_NAME)
+
+    def fetch(name, url, file_path):
+        for attempt in range(retry.DEFAULT_POLICY.attempts):
+            try:
+                return fetch_file(http, journal, name, url, file_path, chunk_size, preallocate_files, store)
+            except requests.exceptions.ChunkedEncodingError as e:
+                error = e
+            except (requests.RequestException, OSError) as e:
+                print(f'Error occurred while downloading |{name}|: {e}. It will be resumed on the next run.')
+                return 'failed'
+
+            if attempt + 1 < retry.DEFAULT_POLICY.attempts:
+                delay = retry.DEFAULT_POLICY.delay(attempt)
+                print(f'Download of |{name}| interrupted ({error}), retrying in {delay:.1f} s.')
+                time.sleep(delay)
+
+        print(f'Error occurred while downloading |{name}|: {error}. It will be resumed on the next run.')
+        return 'failed'
+
+    def drop(name, url, file_path):
+        if store is not None:
+            digest = store.find(url=url)
+            if digest is not None:
+                store.remove(digest)
+        return quarantine(file_path, quarantine_folder)
+
+    pool = ThreadPoolExecutor(VERIFY_WORKERS, thread_name_prefix='verify')
+    checks = {}
+
     for name, url in content_to_download.items():
-        response = requests.get(url)
-        if response.status_code == 200:
-
-            file_name = name
-            file_path = os.path.join(download_folder_path, file_name)
-            if not os.path.exists(file_path):
-                with open(file_path, 'wb') as f:
-                    f.write(response.content)
-                print(f'Saved: |{name}|')
-            else:
-                print(f'The file |{name}| already exists.')
+        file_path = os.path.join(download_folder_path, sanitize(name))
+        if os.path.exists(file_path):
+            print(f'The file |{name}| already exists.')
+            continue
+
+        digest = store.find(url=url) if store is not None else None
+        if digest is not None:
+            store.link(digest, file_path)
+            print(f'Linked from the store: |{name}|')
+            continue
+
+        if fetch(name, url, file_path) == 'saved' and verify:
+            checks[pool.submit(verify_file, file_path)] = name, url, file_path
+
+    for check in as_completed(checks):
+        name, url, file_path = checks[check]
+        try:
+            problem = check.result()
+            if problem is None:
+                continue
+            drop(name, url, file_path)
+            print(f'|{name}| failed verification ({problem}), downloading it again.')
+            if fetch(name, url, file_path) != 'saved':
+                continue
+            problem = verify_file(file_path)
+            if problem is not None:
+                print(f'Failed to verify |{name}| again ({problem}), kept at {drop(name, url, file_path)}.')
+        except OSError as e:
+            print(f'Error occurred while verifying |{name}|: {e}')
+    pool.shutdown()
+
+    if store is not None:
+        store.save()
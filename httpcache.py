@@ -0,0 +1,275 @@
+import hashlib
+import json
+import os
+import time
+from urllib.parse import urlencode
+
+from settings import STATE_DIR
+
+DEFAULT_CACHE_DIR = os.path.join(STATE_DIR, 'http-cache')
+
+
+class CacheMissError(Exception):
+    """
+    Raised in offline mode when a response is not in the cache.
+    """
+
+
+def cache_key(url, params=None):
+    """
+    Builds the cache key of a request from its URL and query parameters.
+
+    :param url: Request URL.
+    :type url: str
+    :param params: Query parameters added to the URL.
+    :type params: dict
+    :return: Hex digest identifying the request.
+    :rtype: str
+    """
+    if params:
+        url += ('&' if '?' in url else '?') + urlencode(sorted(params.items()))
+    return hashlib.sha256(url.encode('utf-8')).hexdigest()
+
+
+class CachedResponse:
+    """
+    A response body kept in the cache with the validators of the response.
+    """
+
+    def __init__(self, body_path, meta):
+        """
+        Initializes the CachedResponse.
+
+        :param body_path: Path to the stored body.
+        :type body_path: str
+        :param meta: URL, validators and storing time of the response.
+        :type meta: dict
+        """
+        self.body_path = body_path
+        self.meta = meta
+
+    def validators(self):
+        """
+        Returns the headers making the next request conditional.
+
+        :return: If-None-Match and If-Modified-Since headers, for the validators the response had.
+        :rtype: dict
+        """
+        headers = {}
+        if self.meta.get('etag'):
+            headers['If-None-Match'] = self.meta['etag']
+        if self.meta.get('last_modified'):
+            headers['If-Modified-Since'] = self.meta['last_modified']
+        return headers
+
+    def chunks(self, chunk_size=64 * 1024):
+        """
+        Reads the body chunk by chunk.
+
+        :param chunk_size: Size of the chunks, in bytes.
+        :type chunk_size: int
+        :return: Generator of byte chunks.
+        :rtype: generator
+        """
+        with open(self.body_path, 'rb') as f:
+            yield from iter(lambda: f.read(chunk_size), b'')
+
+
+class CacheWriter:
+    """
+    Writes a response body into the cache while it is received. The entry only appears once commit() is called,
+    so a broken transfer leaves nothing behind.
+    """
+
+    def __init__(self, cache, key, url, headers):
+        """
+        Initializes the CacheWriter and opens a temporary file for the body.
+
+        :param cache: Cache receiving the response.
+        :type cache: ResponseCache
+        :param key: Cache key of the request.
+        :type key: str
+        :param url: Request URL.
+        :type url: str
+        :param headers: Response headers.
+        :type headers: Mapping
+        """
+        self.cache = cache
+        self.key = key
+        self.meta = {'url': url, 'etag': headers.get('ETag'), 'last_modified': headers.get('Last-Modified'),
+                     'stored_at': time.time()}
+        body_path, _ = cache.paths(key)
+        os.makedirs(os.path.dirname(body_path), exist_ok=True)
+        self.temp_path = f'{body_path}.{os.getpid()}.tmp'
+        self.file = open(self.temp_path, 'wb')
+
+    def tee(self, chunks):
+        """
+        Passes body chunks through while writing them.
+
+        :param chunks: Iterable of byte chunks.
+        :type chunks: iterable
+        :return: Generator of the same chunks.
+        :rtype: generator
+        """
+        for chunk in chunks:
+            self.file.write(chunk)
+            yield chunk
+
+    async def atee(self, chunks):
+        """
+        Asynchronous counterpart of tee.
+
+        :param chunks: Asynchronous iterable of byte chunks.
+        :type chunks: async_iterable
+        :return: Asynchronous generator of the same chunks.
+        :rtype: async_generator
+        """
+        async for chunk in chunks:
+            self.file.write(chunk)
+            yield chunk
+
+    def commit(self):
+        """
+        Stores the written body in the cache.
+
+        :return: None
+        """
+        self.file.close()
+        self.cache.put(self.key, self.temp_path, self.meta)
+
+    def abort(self):
+        """
+        Drops the written body.
+
+        :return: None
+        """
+        self.file.close()
+        if os.path.exists(self.temp_path):
+            os.remove(self.temp_path)
+
+
+class ResponseCache:
+    """
+    On-disk cache of posts API responses.
+
+    Every response is stored with its ETag and Last-Modified headers, so the next run can ask the server
+    whether the page changed and reuse the stored body on 304 Not Modified. The cache is bounded in size:
+    the least recently used responses are evicted first. In offline mode no request is sent at all and
+    the stored responses are replayed, e.g. to work on the extractor without network.
+    """
+
+    def __init__(self, root=DEFAULT_CACHE_DIR, max_bytes=256 * 1024 * 1024, offline=False):
+        """
+        Initializes the ResponseCache and takes stock of the stored responses.
+
+        :param root: Path to the cache folder.
+        :type root: str
+        :param max_bytes: Maximum total size of the stored bodies, in bytes.
+        :type max_bytes: int
+        :param offline: Whether to replay the stored responses instead of sending requests.
+        :type offline: bool
+        """
+        self.root = root
+        self.max_bytes = max_bytes
+        self.offline = offline
+
+        self._sizes = {}
+        self._used = {}
+        if os.path.isdir(root):
+            for folder, _, names in os.walk(root):
+                for name in names:
+                    if name.endswith('.body'):
+                        stat = os.stat(os.path.join(folder, name))
+                        key = name[:-len('.body')]
+                        self._sizes[key] = stat.st_size
+                        self._used[key] = stat.st_mtime
+
+    def paths(self, key):
+        """
+        Returns the paths of the body and of the metadata of an entry.
+
+        :param key: Cache key.
+        :type key: str
+        :return: Body path and metadata path.
+        :rtype: tuple
+        """
+        base = os.path.join(self.root, key[:2], key)
+        return base + '.body', base + '.json'
+
+    def get(self, url, params=None):
+        """
+        Looks up the stored response of a request and marks it as recently used.
+
+        :param url: Request URL.
+        :type url: str
+        :param params: Query parameters added to the URL.
+        :type params: dict
+        :return: Stored response, or None.
+        :rtype: CachedResponse or None
+        """
+        key = cache_key(url, params)
+        body_path, meta_path = self.paths(key)
+        try:
+            with open(meta_path, encoding='utf-8') as f:
+                meta = json.load(f)
+            os.utime(body_path)
+        except (OSError, ValueError):
+            return None
+
+        self._used[key] = time.time()
+        return CachedResponse(body_path, meta)
+
+    def writer(self, url, params, headers):
+        """
+        Starts storing the response of a request.
+
+        :param url: Request URL.
+        :type url: str
+        :param params: Query parameters added to the URL.
+        :type params: dict
+        :param headers: Response headers.
+        :type headers: Mapping
+        :return: Writer receiving the body.
+        :rtype: CacheWriter
+        """
+        return CacheWriter(self, cache_key(url, params), url, headers)
+
+    def put(self, key, temp_path, meta):
+        """
+        Stores a received body under its key and evicts the least recently used entries if the cache is full.
+
+        :param key: Cache key.
+        :type key: str
+        :param temp_path: Path to the received body. It no longer exists afterwards.
+        :type temp_path: str
+        :param meta: Metadata of the response.
+        :type meta: dict
+        :return: None
+        """
+        body_path, meta_path = self.paths(key)
+        os.replace(temp_path, body_path)
+        with open(meta_path, 'w', encoding='utf-8') as f:
+            json.dump(meta, f)
+
+        self._sizes[key] = os.path.getsize(body_path)
+        self._used[key] = time.time()
+        self.evict()
+
+    def evict(self):
+        """
+        Removes the least recently used entries until the cache fits in `max_bytes`.
+
+        :return: None
+        """
+        total = sum(self._sizes.values())
+        for key in sorted(self._used, key=self._used.get):
+            if total <= self.max_bytes:
+                break
+            for path in self.paths(key):
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+            total -= self._sizes.pop(key, 0)
+            del self._used[key]
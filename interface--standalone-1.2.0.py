@@ -1,18 +1,16 @@
 import asyncio
 import os
 import sys
-import re
-import datetime
 import fnmatch
-
-import requests
-import aiohttp
+from collections import deque
 
 from PyQt6.QtGui import QIcon, QGuiApplication, QTextCursor
-from PyQt6.QtCore import Qt, pyqtSignal, QObject, QCoreApplication, QThread
+from PyQt6.QtCore import Qt, pyqtSignal, QObject, QThread, QTimer
 from PyQt6.QtWidgets import (QApplication, QWidget, QVBoxLayout,
                              QLabel, QLineEdit, QPushButton,
-                             QTextEdit, QProgressBar, QFileDialog)
+                             QTextEdit, QProgressBar, QFileDialog, QCheckBox)
+
+from engine import Engine, dated_folder
 
 
 def resource_path(relative_path):
@@ -31,8 +29,19 @@ class CustomTextEdit(QTextEdit):
     """
     Subclasses the QTextEdit widget.
 
-    Provides a custom text edit for displaying logs.
+    Provides a custom text edit for displaying logs. Only the last `max_lines` lines are kept, so a long run does
+    not grow the document without bound.
     """
+    def __init__(self, max_lines=5000):
+        """
+        Initializes the CustomTextEdit.
+
+        :param max_lines: Maximum number of log lines kept in the view.
+        :type max_lines: int
+        """
+        super().__init__()
+        self.document().setMaximumBlockCount(max_lines)
+
     def write(self, text):
         """
          Appends the specified text to the end of the text edit.
@@ -40,6 +49,7 @@ class CustomTextEdit(QTextEdit):
          :param text: The text to be appended.
          :type text: str
          """
+        self.moveCursor(QTextCursor.MoveOperation.End)
         self.insertPlainText(text + '\n')
         self.setReadOnly(True)
 
@@ -48,6 +58,79 @@ class CustomTextEdit(QTextEdit):
         self.setTextCursor(cursor)
 
 
+class EventBus(QObject):
+    """
+    Subclasses the QObject class.
+
+    Carries log lines and progress updates from the download thread to the widgets.
+
+    The download thread only appends to a buffer, which is safe from any thread. A timer in the GUI thread
+    flushes the buffer to the widgets a fixed number of times per second, so a burst of log lines costs
+    a single insertion and relayout.
+    """
+    def __init__(self, log_output, progress_bar, interval=100):
+        """
+        Initializes the EventBus. Must be created in the GUI thread.
+
+        :param log_output: Custom text edit widget for displaying logs.
+        :type log_output: CustomTextEdit
+        :param progress_bar: QProgressBar widget for displaying download progress.
+        :type progress_bar: QProgressBar
+        :param interval: Time between two flushes, in milliseconds.
+        :type interval: int
+        """
+        super().__init__()
+        self.log_output = log_output
+        self.progress_bar = progress_bar
+
+        self._lines = deque()
+        self._progress = None
+
+        self._timer = QTimer(self)
+        self._timer.timeout.connect(self.flush)
+        self._timer.start(interval)
+
+    def log(self, text):
+        """
+        Queues a log line. Can be called from any thread.
+
+        :param text: The text to be logged.
+        :type text: str
+        :return: None
+        """
+        self._lines.append(text)
+
+    def progress(self, value, text=None):
+        """
+        Records the current progress. Only the latest value is shown. Can be called from any thread.
+
+        :param value: Progress in percent.
+        :type value: int
+        :param text: Optional text shown in the progress bar after the percentage.
+        :type text: str
+        :return: None
+        """
+        self._progress = (value, text)
+
+    def flush(self):
+        """
+        Writes the queued log lines and the latest progress to the widgets. Runs in the GUI thread.
+
+        :return: None
+        """
+        lines = []
+        while self._lines:
+            lines.append(self._lines.popleft())
+        if lines:
+            self.log_output.write('\n'.join(lines))
+
+        if self._progress is not None:
+            value, text = self._progress
+            if value != self.progress_bar.value():
+                self.progress_bar.setValue(value)
+            self.progress_bar.setFormat(f'%p% - {text}' if text else '%p%')
+
+
 class InitApp(QWidget):
     """
     Subclasses the QWidget widget.
@@ -74,11 +157,15 @@ class InitApp(QWidget):
         self.download_folder = r'C:\Downloaded Content --by PatreonScraper'
         self.urls = []
         self.extensions = []
+        self.max_concurrency = 8
+        self.per_host_limit = 4
+        self.fan_out = 16
 
         self.log_output = CustomTextEdit()
         self.log_output.setReadOnly(True)
 
         self.progress_bar = QProgressBar()
+        self.events = EventBus(self.log_output, self.progress_bar)
 
         self.init_ui()
 
@@ -106,6 +193,8 @@ class InitApp(QWidget):
         self.btn_choose_folder = QPushButton('Choose Folder')
         self.btn_choose_folder.clicked.connect(self.choose_folder)
 
+        self.incremental_checkbox = QCheckBox('Download only posts published since the last run')
+
         self.btn_clear_log = QPushButton('Clear Log')
         self.btn_clear_log.clicked.connect(self.log_output.clear)
 
@@ -123,6 +212,7 @@ class InitApp(QWidget):
         layout.addWidget(self.folder_label)
         layout.addWidget(self.folder_input)
         layout.addWidget(self.btn_choose_folder)
+        layout.addWidget(self.incremental_checkbox)
 
         layout.addWidget(self.log_output)
         layout.addWidget(self.progress_bar)
@@ -329,17 +419,12 @@ class InitApp(QWidget):
 
         :return: None
         """
-        self.download_folder = os.path.join(self.download_folder,
-                                   f'Downloaded at {datetime.datetime.now().strftime("%d-%m-%Y")}')
-
-        if not os.path.exists(self.download_folder):
-            os.makedirs(self.download_folder)
-            self.log_output.write(f'- Folder created: {self.download_folder}')
-
+        self.download_folder = dated_folder(self.download_folder)
         self.log_output.write(f'- Folder is ready! {self.download_folder}')
 
-        self.worker = DownloadWorker(self.api_url, self.download_folder, self.urls,
-                                     self.extensions, self.log_output, self.progress_bar)
+        self.worker = DownloadWorker(self.api_url, self.download_folder, self.urls, self.extensions, self.events,
+                                     self.max_concurrency, self.per_host_limit, self.fan_out,
+                                     self.incremental_checkbox.isChecked())
         self.worker.start()
 
     def worker_finished(self):
@@ -366,7 +451,8 @@ class DownloadWorker(QThread):
     """
     finished = pyqtSignal()
 
-    def __init__(self, api_url, download_folder, urls, extensions, log_output, progress_bar):
+    def __init__(self, api_url, download_folder, urls, extensions, events,
+                 max_concurrency=8, per_host_limit=4, fan_out=16, incremental=False):
         """
         Initializes a DownloadWorker instance.
 
@@ -378,18 +464,27 @@ class DownloadWorker(QThread):
         :type urls: list
         :param extensions: List of file extensions to be considered during data processing.
         :type extensions: list
-        :param log_output: Custom text edit widget for displaying logs.
-        :type log_output: CustomTextEdit
-        :param progress_bar: QProgressBar widget for displaying download progress.
-        :type progress_bar: QProgressBar
+        :param events: Event bus carrying log lines and progress to the widgets.
+        :type events: EventBus
+        :param max_concurrency: Maximum number of files downloaded at the same time.
+        :type max_concurrency: int
+        :param per_host_limit: Maximum number of files downloaded at the same time from a single host.
+        :type per_host_limit: int
+        :param fan_out: Maximum number of creator pages fetched at the same time.
+        :type fan_out: int
+        :param incremental: Whether to download only the posts published since the last run.
+        :type incremental: bool
         """
         super().__init__()
         self.api_url = api_url
         self.download_folder = download_folder
         self.urls = urls
         self.extensions = extensions
-        self.log_output = log_output
-        self.progress_bar = progress_bar
+        self.events = events
+        self.max_concurrency = max_concurrency
+        self.per_host_limit = per_host_limit
+        self.fan_out = fan_out
+        self.incremental = incremental
 
     def run(self):
         """
@@ -400,8 +495,9 @@ class DownloadWorker(QThread):
 
         :return: None
         """
-        downloader = DownloadManager(self.api_url, self.download_folder, self.urls,
-                                     self.extensions, self.log_output, self.progress_bar)
+        downloader = DownloadManager(self.api_url, self.download_folder, self.urls, self.extensions, self.events,
+                                     self.max_concurrency, self.per_host_limit, self.fan_out,
+                                     self.incremental)
         downloader.download_files()
         self.finished.emit()
 
@@ -417,7 +513,8 @@ class DownloadManager(QObject):
     """
     finished = pyqtSignal()
 
-    def __init__(self, api_url, download_folder, urls, extensions, log_output, progress_bar):
+    def __init__(self, api_url, download_folder, urls, extensions, events,
+                 max_concurrency=8, per_host_limit=4, fan_out=16, incremental=False):
         """
         Initializes the DownloadManager.
 
@@ -429,10 +526,16 @@ class DownloadManager(QObject):
         :type urls: list
         :param extensions: List of file extensions to be considered during data processing.
         :type extensions: list
-        :param log_output: Custom text edit widget for displaying logs.
-        :type log_output: CustomTextEdit
-        :param progress_bar: QProgressBar widget for displaying download progress.
-        :type progress_bar: QProgressBar
+        :param events: Event bus carrying log lines and progress to the widgets.
+        :type events: EventBus
+        :param max_concurrency: Maximum number of files downloaded at the same time.
+        :type max_concurrency: int
+        :param per_host_limit: Maximum number of files downloaded at the same time from a single host.
+        :type per_host_limit: int
+        :param fan_out: Maximum number of creator pages fetched at the same time.
+        :type fan_out: int
+        :param incremental: Whether to download only the posts published since the last run.
+        :type incremental: bool
         """
         super().__init__()
         self.download_folder = download_folder
@@ -440,12 +543,11 @@ class DownloadManager(QObject):
         self.urls = urls
         self.extensions = extensions
 
-        self.log_output = log_output
-        self.progress_bar = progress_bar
-
-        self.data = self.process_urls()
-        self.inner_list = self.unpack_data(self.data)
-        self.content_to_download = self.process_data_recursive(self.inner_list)
+        self.events = events
+        self.max_concurrency = max_concurrency
+        self.per_host_limit = per_host_limit
+        self.fan_out = fan_out
+        self.incremental = incremental
 
     def run(self):
         """
@@ -456,150 +558,43 @@ class DownloadManager(QObject):
 
         :return: None
         """
-        downloader = DownloadManager(self.api_url, self.download_folder, self.urls,
-                                     self.extensions, self.log_output, self.progress_bar)
+        downloader = DownloadManager(self.api_url, self.download_folder, self.urls, self.extensions, self.events,
+                                     self.max_concurrency, self.per_host_limit, self.fan_out,
+                                     self.incremental)
         downloader.download_files()
         self.finished.emit()
 
-    def process_urls(self):
-        """
-        Processes Patreon URLs and fetches posts data, and prepares it for further processing.
-
-        :return: List of Patreon campaign data.
-        :rtype: list
-        """
-        self.log_output.write('- Urls processing started...')
-        data_list = []
-
-        for url in self.urls:
-            headers = {'User-Agent': 'Mozilla/5.0 (compatible; Google-Podcast)'}
-
-            with requests.session() as s:
-                html_text = s.get(url, headers=headers).text
-                campaign_id = re.search(r'https://www\.patreon\.com/api/campaigns/(\d+)', html_text).group(1)
-                data = s.get(self.api_url, headers=headers, params={'filter[campaign_id]': campaign_id,
-                                                                    'sort': '-published_at'}).json()
-                data_list.append(data)
-
-        self.log_output.write('- Data is ready!')
-        return data_list
-
-    def unpack_data(self, data_list):
-        """
-        Unpacks data obtained from Patreon.
-
-        :param data_list: List of Patreon campaign data.
-        :type data_list: list
-        :return: List of inner data.
-        :rtype: list
-        """
-        self.log_output.write('- Data unpacking started...')
-        inner_list = []
-
-        for data in data_list:
-            values = list(data.values())
-            if len(values) == 4:
-                scrapped_data, inner, attributes, info = values
-            elif len(values) == 3:
-                scrapped_data, inner, attributes = values
-            else:
-                self.log_output.write("ValueError: Unexpected number of items in data!")
-                continue
-
-            inner_list.extend(inner)
-
-        self.log_output.write('- Data unpacking finished.')
-        return inner_list
-
-    def process_data_recursive(self, data):
+    async def download_files_async(self):
         """
-        Processes data, extracts file URLs and file names.
+        Downloads the files of all the creators with the shared download engine.
 
-        :param data: Data to be processed.
-        :type data: list, dict or str
-        :return: List of file URLs and list of file names.
-        :rtype: tuple
+        :return: None
         """
-        self.log_output.write('- Data processing started...')
-
-        file_urls = []
-        file_names = []
-
-        def process_item(item):
-            if isinstance(item, list):
-                for sub_item in item:
-                    process_item(sub_item)
-            elif isinstance(item, dict):
-                for key, value in item.items():
-                    process_item(value)
-            elif isinstance(item, str):
-                if item.startswith('https://www.patreon.com/file?h'):
-                    file_urls.append(item)
-                elif any(fnmatch.fnmatch(item, pattern) for pattern in self.extensions):
-                    file_names.append(item)
-
-        for item in data:
-            process_item(item)
-
-        content_to_download = dict(zip(file_names, file_urls))
-
-        self.log_output.write('- Data processing finished.')
-        return content_to_download
-
-    async def download_file(self, session, url, file_path):
+        def report_progress(metrics):
+            eta = metrics.eta()
+            text = f'{metrics.current_rate():.1f} MB/s'
+            if eta is not None:
+                text += f', {int(eta) // 60}:{int(eta) % 60:02d} left'
+            self.events.progress(metrics.percent(), text)
+
+        engine = Engine(self.urls, self.download_folder, extensions=self.extensions, api_url=self.api_url,
+                        max_concurrency=self.max_concurrency, per_host_limit=self.per_host_limit,
+                        fan_out=self.fan_out, incremental=self.incremental, log=self.events.log,
+                        progress=report_progress)
         try:
-            async with session.get(url) as response:
-                if response.status == 200:
-                    with open(file_path, 'wb') as f:
-                        while True:
-                            chunk = await response.content.read(65536)  # 8192
-                            if not chunk:
-                                break
-                            f.write(chunk)
-                else:
-                    self.log_output.write(f"Failed to download {url}. Status code: {response.status}")
-        except Exception as e:
-            self.log_output.write(f"Error occurred while downloading {url}: {e}")
-
-    async def download_files_async(self):
-        total_files = len(self.content_to_download)
-        completed_files = 0
-
-        async with aiohttp.ClientSession() as session:
-            tasks = []
-            for name, url in self.content_to_download.items():
-                file_name = name
-                file_path = os.path.join(self.download_folder, file_name)
-
-                if not os.path.exists(file_path):
-                    task = self.download_file(session, url, file_path)
-                    tasks.append(task)
-                    self.log_output.write(f'- Saved: | {name} |')
-                else:
-                    self.log_output.write(f'- The file | {name} | already exists.')
-
-                completed_files += 1
-                progress_percentage = int((completed_files / total_files) * 100)
+            await engine.run()
+        finally:
+            engine.close()
 
-                await asyncio.sleep(0.2)
-                QCoreApplication.processEvents()
-
-                self.progress_bar.setValue(progress_percentage)
-
-                await asyncio.gather(task)  # fix for skipping the download for more than 3 URLs bug
-
-            #await asyncio.gather(*tasks)
-
-            self.log_output.write('- Download completed!')
-            self.log_output.write('*' * 5)
-            self.finished.emit()
+        self.events.log('- Download completed!')
+        self.events.log('*' * 5)
+        self.finished.emit()
 
     def download_files(self):
         try:
             asyncio.run(self.download_files_async())
         except Exception as e:
-            #self.log_output.write(f"Error occurred while downloading files: {e}")
-            pass
+            self.events.log(f"Error occurred while downloading files: {e!r}")
 
 
 if __name__ == '__main__':
@@ -0,0 +1,228 @@
+import os
+import re
+import string
+from urllib.parse import urlsplit
+
+DEFAULT_TEMPLATE = '{name}'
+
+# Fields a layout template can use.
+TEMPLATE_FIELDS = ('creator', 'campaign_id', 'post_id', 'post_title', 'published', 'name')
+
+# Fields of which at least one differs between the files of two creators.
+CREATOR_FIELDS = ('creator', 'campaign_id', 'post_id')
+
+# Characters Windows does not allow in file names, plus the path separators and control characters.
+ILLEGAL_CHARACTERS = re.compile(r'[<>:"/\\|?*\x00-\x1f]')
+
+RESERVED_NAMES = {'CON', 'PRN', 'AUX', 'NUL', *(f'COM{number}' for number in range(1, 10)),
+                  *(f'LPT{number}' for number in range(1, 10))}
+
+# Leaves room under the usual limit of 255 for collision suffixes and the '.part' extension.
+MAX_COMPONENT_LENGTH = 200
+
+
+def sanitize(component):
+    """
+    Turns a string into a file or folder name valid on Windows, macOS and Linux.
+
+    Illegal characters become '_', trailing dots and spaces are dropped, reserved Windows names get a '_' and
+    long names are shortened, keeping the extension.
+
+    :param component: File or folder name.
+    :type component: str
+    :return: Valid name.
+    :rtype: str
+    """
+    component = ILLEGAL_CHARACTERS.sub('_', component).strip().rstrip('. ')
+    if component in ('', '.', '..'):
+        return '_'
+
+    first, dot, rest = component.partition('.')
+    if first.upper() in RESERVED_NAMES:
+        component = f'{first}_{dot}{rest}'
+
+    stem, extension = os.path.splitext(component)
+    if len(extension) > 16:
+        stem, extension = stem + extension, ''
+    return stem[:MAX_COMPONENT_LENGTH - len(extension)] + extension
+
+
+def template_fields(template):
+    """
+    Returns the fields a layout template uses.
+
+    :param template: Layout template.
+    :type template: str
+    :return: Field names.
+    :rtype: set
+    """
+    return {field for _, field, _, _ in string.Formatter().parse(template) if field is not None}
+
+
+def shard_safe(template):
+    """
+    Returns a template under which processes downloading different creators into the same folder never plan
+    the same path. Collisions are only resolved within a process, so a template without a field telling
+    the creators apart, like the default '{name}', gets a folder per creator.
+
+    :param template: Layout template.
+    :type template: str
+    :return: Layout template.
+    :rtype: str
+    """
+    if template_fields(template) & set(CREATOR_FIELDS):
+        return template
+    return '{creator}/' + template
+
+
+def creator_name(url):
+    """
+    Returns the name of a creator from its page URL, e.g. 'name' for 'https://www.patreon.com/c/name'.
+
+    :param url: Patreon creator URL.
+    :type url: str
+    :return: Creator name.
+    :rtype: str
+    """
+    segments = [segment for segment in urlsplit(url.strip()).path.split('/') if segment]
+    return segments[-1] if segments else urlsplit(url.strip()).netloc
+
+
+class OutputLayout:
+    """
+    Plans where the downloaded files go inside the download folder.
+
+    The relative path of a file comes from a template like '{creator}/{post_id}/{name}', whose parts are sanitized.
+    Every planned path is kept in memory with the file it belongs to. When two different files get the same path,
+    e.g. two creators both shipping 'update.zip', the later one gets a suffix made from its post ID, so a file
+    always gets the same path for the same feeds. The files already in the folder are listed once at start,
+    which saves a stat call per file on network file systems; with a manifest, a file left by an earlier run is
+    only taken for the same file if the manifest says so.
+    """
+
+    def __init__(self, download_folder, template=DEFAULT_TEMPLATE, manifest=None):
+        """
+        Initializes the OutputLayout and lists the files already in the download folder.
+
+        :param download_folder: Path to the download folder.
+        :type download_folder: str
+        :param template: Relative path of a file with fields among TEMPLATE_FIELDS, '/' separating folders.
+        :type template: str
+        :param manifest: Optional manifest telling which file an existing path belongs to.
+        :type manifest: manifest.Manifest
+        :raises ValueError: If the template is invalid, see check.
+        """
+        self.check(template)
+        self.download_folder = download_folder
+        self.template = template
+        self.manifest = manifest
+        self._owners = {}
+        self._existing = set()
+
+        for folder, subfolders, names in os.walk(download_folder):
+            # Skips the blob store, the quarantine and the other hidden folders of the downloader.
+            subfolders[:] = [subfolder for subfolder in subfolders if not subfolder.startswith('.')]
+            relative_folder = os.path.relpath(folder, download_folder)
+            for name in names:
+                self._existing.add(os.path.normpath(os.path.join(relative_folder, name)))
+
+    @staticmethod
+    def check(template):
+        """
+        Checks a layout template.
+
+        :param template: Layout template.
+        :type template: str
+        :return: None
+        :raises ValueError: If the template uses an unknown field or does not contain the file name.
+        """
+        fields = template_fields(template)
+        unknown = fields - set(TEMPLATE_FIELDS)
+        if unknown:
+            raise ValueError(f'Unknown layout fields: {", ".join(sorted(unknown))}')
+        if 'name' not in fields:
+            raise ValueError('The layout must contain {name}')
+
+    def render(self, attachment, creator, campaign_id):
+        """
+        Builds the relative path of a file from the template, without looking for collisions.
+
+        :param attachment: File to place.
+        :type attachment: extractor.Attachment
+        :param creator: Creator name.
+        :type creator: str
+        :param campaign_id: Patreon campaign ID.
+        :type campaign_id: str
+        :return: Relative path.
+        :rtype: str
+        """
+        fields = {
+            'creator': creator,
+            'campaign_id': campaign_id,
+            'post_id': attachment.post_id or 'post',
+            'post_title': attachment.post_title or attachment.post_id or 'post',
+            'published': (attachment.published_at or '')[:10] or 'undated',
+            'name': attachment.name,
+        }
+        # Fields are sanitized before formatting, so a '/' inside a value never adds a folder.
+        fields = {key: sanitize(str(value)) for key, value in fields.items()}
+        parts = self.template.format(**fields).replace('\\', '/').split('/')
+        return os.path.join(*(sanitize(part) for part in parts if part))
+
+    def _taken(self, path, owner):
+        if path in self._owners:
+            return self._owners[path] != owner
+        if path not in self._existing or self.manifest is None:
+            return False
+        recorded = self.manifest.owner(os.path.abspath(os.path.join(self.download_folder, path)))
+        return recorded is not None and recorded != owner
+
+    def plan(self, attachment, creator, campaign_id):
+        """
+        Returns the relative path of a file, unique among the files of the run.
+
+        :param attachment: File to place.
+        :type attachment: extractor.Attachment
+        :param creator: Creator name.
+        :type creator: str
+        :param campaign_id: Patreon campaign ID.
+        :type campaign_id: str
+        :return: Relative path.
+        :rtype: str
+        """
+        owner = (campaign_id, attachment.post_id, attachment.name)
+        path = self.render(attachment, creator, campaign_id)
+        stem, extension = os.path.splitext(path)
+
+        candidates = [path, f'{stem} ({attachment.post_id}){extension}',
+                      f'{stem} ({campaign_id}-{attachment.post_id}){extension}']
+        number = 2
+        while True:
+            for candidate in candidates:
+                if not self._taken(candidate, owner):
+                    self._owners[candidate] = owner
+                    return candidate
+            candidates = [f'{stem} ({campaign_id}-{attachment.post_id}-{number}){extension}']
+            number += 1
+
+    def exists(self, path):
+        """
+        Tells whether a file was in the download folder when the layout was created.
+
+        :param path: Relative path.
+        :type path: str
+        :return: Whether the file exists.
+        :rtype: bool
+        """
+        return path in self._existing
+
+    def add(self, path):
+        """
+        Records a file placed into the download folder after the layout was created, so a layout kept across runs
+        knows it.
+
+        :param path: Relative path.
+        :type path: str
+        :return: None
+        """
+        self._existing.add(os.path.normpath(path))
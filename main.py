@@ -1,6 +1,6 @@
-import re
-import datetime
-from functions import *
+import asyncio
+
+from engine import Engine, dated_folder
 
 urls = []
 default_folder = r'C:\Sims 4 Mods -by PatreonScraper'
@@ -31,35 +31,15 @@ while True:
     default_folder = folder_input
     break
 
-current_date = datetime.datetime.now()
-date_str = current_date.strftime('%d-%m-%Y')
-folder_path = os.path.join(default_folder, f'Downloaded at {date_str}')
-
-
-if not os.path.exists(folder_path):
-    os.makedirs(folder_path)
+incremental = input(
+    'Download only posts published since the last run? Type "yes" or "no".\nYour answer: '
+).strip().lower() == 'yes'
 
+folder_path = dated_folder(default_folder)
 print(f'Folder created: {folder_path}')
 
-
-api_url = 'https://www.patreon.com/api/posts'
-
-
-for url in urls:
-    headers = {
-        'User-Agent': 'Mozilla/5.0 (compatible; Google-Podcast)'
-    }
-
-    with requests.session() as s:
-        html_text = s.get(url, headers=headers).text
-        campaign_id = re.search(r'https://www\.patreon\.com/api/campaigns/(\d+)', html_text).group(1)
-        data = s.get(api_url, headers=headers,
-                     params={'filter[campaign_id]': campaign_id,
-                             'sort': '-published_at'}).json()
-
-        #print(json.dumps(data, indent=4))
-
-    inner_list = unpack_data(data)
-    file_names, file_urls = process_data_recursive(inner_list, extensions)
-    content_to_download = dict(zip(file_names, file_urls))
-    download_file(content_to_download, default_folder)
+engine = Engine(urls, folder_path, extensions=extensions, incremental=incremental)
+try:
+    asyncio.run(engine.run())
+finally:
+    engine.close()
@@ -0,0 +1,257 @@
+import asyncio
+import functools
+import os
+import sqlite3
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from settings import STATE_DIR
+
+DEFAULT_MANIFEST_PATH = os.path.join(STATE_DIR, 'manifest.sqlite3')
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS files (
+    campaign_id TEXT NOT NULL,
+    post_id TEXT NOT NULL,
+    name TEXT NOT NULL,
+    attachment_id TEXT,
+    url TEXT NOT NULL,
+    size INTEGER,
+    sha256 TEXT,
+    status TEXT NOT NULL,
+    path TEXT,
+    created_at REAL NOT NULL,
+    updated_at REAL NOT NULL,
+    PRIMARY KEY (campaign_id, post_id, name)
+);
+CREATE INDEX IF NOT EXISTS files_status ON files (status, campaign_id);
+CREATE INDEX IF NOT EXISTS files_sha256 ON files (sha256);
+CREATE INDEX IF NOT EXISTS files_path ON files (path);
+'''
+
+# Statuses of a file that was placed on disk.
+DONE_STATUSES = ('saved', 'linked')
+
+
+class Manifest:
+    """
+    SQLite database of every file seen by the downloader, shared by all the runs and download folders.
+
+    A file is identified by its campaign, post and name, as the download URLs of Patreon are signed and change
+    over time. Each row keeps the attachment ID, the last URL, the size, the SHA-256 hash of the content,
+    the outcome of the last attempt and where the file was saved, so a run can tell in one indexed lookup
+    that a file was already downloaded, even into the folder of another day. Several processes can share
+    the database; every record is committed at once, so the write lock is only held for a moment, and a writer
+    waits up to `timeout` seconds for the others.
+
+    The methods starting with 'a' run the lookups and commits on a thread of the manifest, so waiting for
+    another process does not hold up an event loop.
+    """
+
+    def __init__(self, path=DEFAULT_MANIFEST_PATH, timeout=60.0, shared=False):
+        """
+        Initializes the Manifest, creating the database if needed.
+
+        :param path: Path to the database file.
+        :type path: str
+        :param timeout: Time to wait for another process holding the database, in seconds.
+        :type timeout: float
+        :param shared: Whether several hosts share the database, e.g. on a network file system. The default
+            rollback journal is used then, as the WAL mode relies on memory shared by the processes of one host.
+        :type shared: bool
+        """
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        self.path = path
+        self.connection = sqlite3.connect(path, timeout=timeout, check_same_thread=False)
+        self.connection.row_factory = sqlite3.Row
+        if shared:
+            self.connection.execute('PRAGMA journal_mode=DELETE')
+        else:
+            self.connection.execute('PRAGMA journal_mode=WAL')
+            self.connection.execute('PRAGMA synchronous=NORMAL')
+        self.connection.executescript(SCHEMA)
+        self._lock = threading.RLock()
+        self._executor = ThreadPoolExecutor(1, thread_name_prefix='manifest')
+
+    async def _call(self, function, *args, **kwargs):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, functools.partial(function, *args, **kwargs))
+
+    def get(self, campaign_id, post_id, name):
+        """
+        Returns the record of a file.
+
+        :param campaign_id: Patreon campaign ID.
+        :type campaign_id: str
+        :param post_id: ID of the post the file belongs to.
+        :type post_id: str
+        :param name: File name.
+        :type name: str
+        :return: Record with the columns of the files table, or None if the file was never seen.
+        :rtype: sqlite3.Row or None
+        """
+        with self._lock:
+            return self.connection.execute('SELECT * FROM files WHERE campaign_id = ? AND post_id = ? AND name = ?',
+                                           (campaign_id, post_id, name)).fetchone()
+
+    def downloaded_path(self, campaign_id, post_id, name):
+        """
+        Returns where a file was downloaded to, if it is still there.
+
+        :param campaign_id: Patreon campaign ID.
+        :type campaign_id: str
+        :param post_id: ID of the post the file belongs to.
+        :type post_id: str
+        :param name: File name.
+        :type name: str
+        :return: Path to the file, or None if the file was not downloaded or was removed since.
+        :rtype: str or None
+        """
+        record = self.get(campaign_id, post_id, name)
+        if record is None or record['status'] not in DONE_STATUSES or not record['path']:
+            return None
+        return record['path'] if os.path.exists(record['path']) else None
+
+    async def adownloaded_path(self, campaign_id, post_id, name):
+        """
+        Asynchronous counterpart of downloaded_path.
+
+        :param campaign_id: Patreon campaign ID.
+        :type campaign_id: str
+        :param post_id: ID of the post the file belongs to.
+        :type post_id: str
+        :param name: File name.
+        :type name: str
+        :return: Path to the file, or None if the file was not downloaded or was removed since.
+        :rtype: str or None
+        """
+        return await self._call(self.downloaded_path, campaign_id, post_id, name)
+
+    def owner(self, path):
+        """
+        Tells which file was downloaded to a path.
+
+        :param path: Absolute path to the file.
+        :type path: str
+        :return: Campaign ID, post ID and name of the file, or None if no file was downloaded there.
+        :rtype: tuple or None
+        """
+        with self._lock:
+            record = self.connection.execute(
+                f'''SELECT campaign_id, post_id, name FROM files
+                    WHERE path = ? AND status IN ({", ".join("?" * len(DONE_STATUSES))})
+                    ORDER BY updated_at DESC LIMIT 1''', (path, *DONE_STATUSES)).fetchone()
+        return tuple(record) if record is not None else None
+
+    def relocate(self, path, new_path):
+        """
+        Moves the record of a downloaded file along with the file, e.g. after a post-processor moved it or
+        extracted and removed it, so later runs still know it was downloaded.
+
+        :param path: Absolute path the file was downloaded to.
+        :type path: str
+        :param new_path: Absolute path where its content is now.
+        :type new_path: str
+        :return: None
+        """
+        with self._lock:
+            self.connection.execute(
+                f'''UPDATE files SET path = ?, updated_at = ?
+                    WHERE path = ? AND status IN ({", ".join("?" * len(DONE_STATUSES))})''',
+                (new_path, time.time(), path, *DONE_STATUSES))
+            self.save()
+
+    async def arelocate(self, path, new_path):
+        """
+        Asynchronous counterpart of relocate.
+
+        :param path: Absolute path the file was downloaded to.
+        :type path: str
+        :param new_path: Absolute path where its content is now.
+        :type new_path: str
+        :return: None
+        """
+        await self._call(self.relocate, path, new_path)
+
+    def record(self, campaign_id, post_id, name, url, status, attachment_id=None, size=None, sha256=None,
+               path=None):
+        """
+        Creates or updates the record of a file. Unknown values keep what an earlier run recorded.
+
+        :param campaign_id: Patreon campaign ID.
+        :type campaign_id: str
+        :param post_id: ID of the post the file belongs to.
+        :type post_id: str
+        :param name: File name.
+        :type name: str
+        :param url: File URL.
+        :type url: str
+        :param status: Outcome of the last attempt: 'saved', 'linked', 'skipped' or 'failed'.
+        :type status: str
+        :param attachment_id: ID of the attachment or media object.
+        :type attachment_id: str
+        :param size: Size of the file in bytes.
+        :type size: int
+        :param sha256: Hex SHA-256 digest of the content.
+        :type sha256: str
+        :param path: Path where the file was saved.
+        :type path: str
+        :return: None
+        """
+        now = time.time()
+        with self._lock:
+            self.connection.execute(
+                '''INSERT INTO files (campaign_id, post_id, name, attachment_id, url, size, sha256, status, path,
+                                      created_at, updated_at)
+                   VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+                   ON CONFLICT (campaign_id, post_id, name) DO UPDATE SET
+                       attachment_id = COALESCE(excluded.attachment_id, attachment_id),
+                       url = excluded.url,
+                       size = COALESCE(excluded.size, size),
+                       sha256 = COALESCE(excluded.sha256, sha256),
+                       status = excluded.status,
+                       path = COALESCE(excluded.path, path),
+                       updated_at = excluded.updated_at''',
+                (campaign_id, post_id, name, attachment_id, url, size, sha256, status, path, now, now))
+            # A transaction left open would hold the write lock against the other processes until the next commit.
+            self.save()
+
+    async def arecord(self, *args, **kwargs):
+        """
+        Asynchronous counterpart of record, taking the same arguments.
+
+        :return: None
+        """
+        await self._call(self.record, *args, **kwargs)
+
+    def summary(self):
+        """
+        Counts the files and their bytes by campaign and status.
+
+        :return: List of records with the campaign_id, status, files and bytes columns.
+        :rtype: list
+        """
+        with self._lock:
+            return self.connection.execute(
+                '''SELECT campaign_id, status, COUNT(*) AS files, COALESCE(SUM(size), 0) AS bytes
+                   FROM files GROUP BY campaign_id, status ORDER BY campaign_id, status''').fetchall()
+
+    def save(self):
+        """
+        Commits the recorded files.
+
+        :return: None
+        """
+        with self._lock:
+            self.connection.commit()
+
+    def close(self):
+        """
+        Commits the recorded files and closes the database, once the pending asynchronous calls are done.
+
+        :return: None
+        """
+        self._executor.shutdown()
+        self.save()
+        self.connection.close()
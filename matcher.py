@@ -0,0 +1,113 @@
+import fnmatch
+import re
+
+
+def _compile_patterns(patterns):
+    """
+    Splits glob patterns into plain suffixes and a single case-insensitive regular expression for the rest.
+
+    Patterns like '*.zip' or 'zip' become the suffix '.zip', which is checked with one str.endswith call.
+
+    :param patterns: Glob patterns or bare extensions.
+    :type patterns: iterable
+    :return: Tuple of lowercase suffixes and a compiled regular expression (or None).
+    :rtype: tuple
+    """
+    suffixes = []
+    globs = []
+
+    for pattern in patterns:
+        pattern = pattern.strip()
+        if not pattern:
+            continue
+        if not any(char in pattern for char in '*?['):
+            pattern = f'*.{pattern.lstrip(".")}'
+
+        tail = pattern[1:]
+        if pattern.startswith('*.') and not any(char in tail for char in '*?['):
+            suffixes.append(tail.lower())
+        else:
+            globs.append(fnmatch.translate(pattern))
+
+    regex = re.compile('|'.join(globs), re.IGNORECASE) if globs else None
+    return tuple(suffixes), regex
+
+
+class FileMatcher:
+    """
+    Decides which attachments are downloaded.
+
+    Extension patterns are compiled once, so checking a file name costs a suffix lookup and at most one regular
+    expression match instead of a fnmatch call per pattern. Names are matched case-insensitively.
+    """
+
+    def __init__(self, include=None, exclude=(), min_size=None, max_size=None, mimetypes=None):
+        """
+        Initializes the FileMatcher.
+
+        :param include: Patterns like '*.zip' or bare extensions like 'zip' a file name must match.
+            None matches any name, an empty list matches none.
+        :type include: list
+        :param exclude: Patterns a file name must not match.
+        :type exclude: list
+        :param min_size: Minimal file size in bytes.
+        :type min_size: int
+        :param max_size: Maximal file size in bytes.
+        :type max_size: int
+        :param mimetypes: Accepted MIME types like 'application/zip' or 'application/*'.
+        :type mimetypes: list
+        """
+        self.include = None if include is None else _compile_patterns(include)
+        self.exclude = _compile_patterns(exclude)
+        self.min_size = min_size
+        self.max_size = max_size
+
+        self.mimetypes = None
+        self.mime_prefixes = ()
+        if mimetypes is not None:
+            self.mimetypes = {mimetype.lower() for mimetype in mimetypes if not mimetype.endswith('/*')}
+            self.mime_prefixes = tuple(mimetype[:-1].lower() for mimetype in mimetypes if mimetype.endswith('/*'))
+
+    @staticmethod
+    def _matches(compiled, name):
+        suffixes, regex = compiled
+        return name.lower().endswith(suffixes) or (regex is not None and regex.match(name) is not None)
+
+    def matches_name(self, name):
+        """
+        Checks a file name against the include and exclude patterns.
+
+        :param name: File name.
+        :type name: str
+        :return: True if the name is accepted.
+        :rtype: bool
+        """
+        if self.include is not None and not self._matches(self.include, name):
+            return False
+        return not self._matches(self.exclude, name)
+
+    def __call__(self, attachment):
+        """
+        Checks an attachment record. Sizes and MIME types that are unknown are not held against the file.
+
+        :param attachment: Attachment record.
+        :type attachment: extractor.Attachment
+        :return: True if the attachment should be downloaded.
+        :rtype: bool
+        """
+        if not self.matches_name(attachment.name):
+            return False
+
+        size = attachment.size
+        if size is not None:
+            if self.min_size is not None and size < self.min_size:
+                return False
+            if self.max_size is not None and size > self.max_size:
+                return False
+
+        mimetype = (attachment.mimetype or '').lower()
+        if self.mimetypes is not None and mimetype:
+            if mimetype not in self.mimetypes and not mimetype.startswith(self.mime_prefixes):
+                return False
+
+        return True
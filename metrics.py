@@ -0,0 +1,278 @@
+import asyncio
+import json
+import sys
+import time
+from collections import deque
+
+MB = 1024 * 1024
+
+
+class FileProgress:
+    """
+    Progress of a single file.
+    """
+
+    def __init__(self, expected=None):
+        self.expected = expected
+        self.received = 0
+        self.started_at = None
+
+    def rate(self, now):
+        """
+        Returns the average transfer rate of the file, in MB/s.
+
+        :param now: Current monotonic time.
+        :type now: float
+        :return: Transfer rate.
+        :rtype: float
+        """
+        if self.started_at is None or now <= self.started_at:
+            return 0.0
+        return self.received / MB / (now - self.started_at)
+
+
+class TransferMetrics:
+    """
+    Byte-accurate progress and throughput of a download run.
+
+    Tracks the bytes received against the sizes announced by the posts feed and by Content-Length, the files
+    in flight, the outcome counts, and the aggregate transfer rate, both since the start and over a short
+    sliding window that drives the ETA.
+    """
+
+    def __init__(self, window=5.0):
+        """
+        Initializes the TransferMetrics.
+
+        :param window: Length of the sliding window of the current transfer rate, in seconds.
+        :type window: float
+        """
+        self.window = window
+        self.started_at = time.monotonic()
+
+        self.files = {}
+        self.in_flight = set()
+        self.outcomes = {'saved': 0, 'linked': 0, 'skipped': 0, 'failed': 0}
+
+        self.bytes_done = 0
+        self.bytes_total = 0
+        self.bytes_received = 0
+        self._samples = deque([(self.started_at, 0)])
+
+    def file_queued(self, name, size=None):
+        """
+        Registers a file waiting for download, with its size if the posts feed announced it.
+
+        :param name: File name.
+        :type name: str
+        :param size: Expected size in bytes.
+        :type size: int
+        :return: None
+        """
+        self.files[name] = FileProgress(size)
+        self.bytes_total += size or 0
+
+    def file_started(self, name, size=None, offset=0):
+        """
+        Marks a file as in flight once its response headers arrived.
+
+        :param name: File name.
+        :type name: str
+        :param size: Size of the complete file from Content-Length or Content-Range.
+        :type size: int
+        :param offset: Bytes already on disk from an earlier attempt.
+        :type offset: int
+        :return: None
+        """
+        file = self.files.setdefault(name, FileProgress())
+        if size is not None and size != file.expected:
+            self.bytes_total += size - (file.expected or 0)
+            file.expected = size
+
+        file.started_at = time.monotonic()
+        self.bytes_done += offset - file.received
+        file.received = offset
+        self.in_flight.add(name)
+
+    def bytes_arrived(self, name, count):
+        """
+        Adds received bytes of a file.
+
+        :param name: File name.
+        :type name: str
+        :param count: Number of bytes.
+        :type count: int
+        :return: None
+        """
+        self.files[name].received += count
+        self.bytes_done += count
+        self.bytes_received += count
+
+        now = time.monotonic()
+        if now - self._samples[-1][0] >= 0.25:
+            self._samples.append((now, self.bytes_received))
+            while now - self._samples[0][0] > self.window:
+                self._samples.popleft()
+
+    def file_finished(self, name, outcome):
+        """
+        Records the outcome of a file. Skipped and linked files count as done; the missing bytes of a failed
+        file are taken out of the total.
+
+        :param name: File name.
+        :type name: str
+        :param outcome: 'saved', 'linked', 'skipped' or 'failed'.
+        :type outcome: str
+        :return: None
+        """
+        self.outcomes[outcome] += 1
+        self.in_flight.discard(name)
+
+        file = self.files.pop(name, None)
+        if file is None or file.expected is None:
+            return
+
+        missing = max(file.expected - file.received, 0)
+        if outcome == 'failed':
+            self.bytes_total -= missing
+        else:
+            self.bytes_done += missing
+
+    @property
+    def files_done(self):
+        return sum(self.outcomes.values())
+
+    @property
+    def files_total(self):
+        return self.files_done + len(self.files)
+
+    def percent(self):
+        """
+        Returns the progress in percent, by bytes if sizes are known and by files otherwise.
+
+        :return: Progress.
+        :rtype: int
+        """
+        if self.bytes_total > 0:
+            return min(int(self.bytes_done * 100 / self.bytes_total), 100)
+        if self.files_total > 0:
+            return int(self.files_done * 100 / self.files_total)
+        return 0
+
+    def current_rate(self):
+        """
+        Returns the aggregate transfer rate over the sliding window, in MB/s.
+
+        :return: Transfer rate.
+        :rtype: float
+        """
+        (first_time, first_bytes), (last_time, last_bytes) = self._samples[0], self._samples[-1]
+        if last_time <= first_time:
+            return self.average_rate()
+        return (last_bytes - first_bytes) / MB / (last_time - first_time)
+
+    def average_rate(self):
+        """
+        Returns the aggregate transfer rate since the start, in MB/s.
+
+        :return: Transfer rate.
+        :rtype: float
+        """
+        elapsed = time.monotonic() - self.started_at
+        return self.bytes_received / MB / elapsed if elapsed > 0 else 0.0
+
+    def eta(self):
+        """
+        Returns the estimated time left for the known bytes, in seconds.
+
+        :return: Estimated time left, or None if nothing is being transferred.
+        :rtype: float or None
+        """
+        rate = self.current_rate()
+        if rate <= 0:
+            return None
+        return max(self.bytes_total - self.bytes_done, 0) / MB / rate
+
+    def snapshot(self):
+        """
+        Returns the metrics as a JSON-serializable dictionary.
+
+        :return: Metrics.
+        :rtype: dict
+        """
+        now = time.monotonic()
+        eta = self.eta()
+        return {
+            'time': time.time(),
+            'elapsed': round(now - self.started_at, 3),
+            'percent': self.percent(),
+            'bytes_done': self.bytes_done,
+            'bytes_total': self.bytes_total,
+            'rate_mbps': round(self.current_rate(), 3),
+            'average_rate_mbps': round(self.average_rate(), 3),
+            'eta_seconds': None if eta is None else round(eta, 1),
+            'files_done': self.files_done,
+            'files_total': self.files_total,
+            'in_flight': len(self.in_flight),
+            **self.outcomes,
+            'transfers': [{'name': name, 'bytes': self.files[name].received, 'size': self.files[name].expected,
+                           'rate_mbps': round(self.files[name].rate(now), 3)}
+                          for name in sorted(self.in_flight)],
+        }
+
+
+def aggregate_snapshots(snapshots):
+    """
+    Combines the metrics snapshots of several runs going on at the same time, e.g. the shards of a sharded run.
+
+    :param snapshots: Snapshots returned by TransferMetrics.snapshot.
+    :type snapshots: iterable
+    :return: Combined snapshot, without the list of transfers.
+    :rtype: dict
+    """
+    snapshots = list(snapshots)
+    totals = {key: sum(snapshot[key] for snapshot in snapshots)
+              for key in ('bytes_done', 'bytes_total', 'rate_mbps', 'average_rate_mbps', 'files_done',
+                          'files_total', 'in_flight', 'saved', 'linked', 'skipped', 'failed')}
+
+    if totals['bytes_total'] > 0:
+        percent = min(int(totals['bytes_done'] * 100 / totals['bytes_total']), 100)
+    elif totals['files_total'] > 0:
+        percent = int(totals['files_done'] * 100 / totals['files_total'])
+    else:
+        percent = 0
+
+    eta = None
+    if totals['rate_mbps'] > 0:
+        eta = round(max(totals['bytes_total'] - totals['bytes_done'], 0) / MB / totals['rate_mbps'], 1)
+
+    return {
+        'time': time.time(),
+        'elapsed': max((snapshot['elapsed'] for snapshot in snapshots), default=0),
+        'percent': percent,
+        'eta_seconds': eta,
+        **{key: round(value, 3) if isinstance(value, float) else value for key, value in totals.items()},
+    }
+
+
+async def report_json_lines(metrics, stream=sys.stdout, interval=1.0):
+    """
+    Writes a metrics snapshot as a JSON line every `interval` seconds until cancelled, then a final one.
+
+    :param metrics: Metrics of the run.
+    :type metrics: TransferMetrics
+    :param stream: Text stream receiving the lines.
+    :type stream: file object
+    :param interval: Time between two lines, in seconds.
+    :type interval: float
+    :return: None
+    """
+    try:
+        while True:
+            stream.write(json.dumps(metrics.snapshot()) + '\n')
+            stream.flush()
+            await asyncio.sleep(interval)
+    except asyncio.CancelledError:
+        stream.write(json.dumps(metrics.snapshot()) + '\n')
+        stream.flush()
+        raise
@@ -0,0 +1,314 @@
+import asyncio
+import filecmp
+import importlib
+import os
+import zipfile
+from concurrent.futures import ProcessPoolExecutor
+
+# Folder inside the download folder laid out like the Mods folder of The Sims 4.
+MODS_NAME = 'Mods'
+
+# Processors by file extension, in the order they were registered: lists of processor names and functions.
+PROCESSORS = {}
+
+
+def processor(name, *extensions):
+    """
+    Registers a post-processor of the files with the given extensions. Plugins are modules calling this.
+
+    The function receives the path to a file and a ProcessContext and returns the paths of the files it created,
+    e.g. the content of an archive, which are post-processed in turn. A function moving or removing the file sets
+    `context.destination` to where its content went. It runs in a worker process.
+
+    :param name: Processor name, used to enable it.
+    :type name: str
+    :param extensions: Extensions like '.zip' the processor handles.
+    :type extensions: str
+    :return: Decorator.
+    :rtype: callable
+    """
+    def register(function):
+        for extension in extensions:
+            PROCESSORS.setdefault(extension.lower(), []).append((name, function))
+        return function
+
+    return register
+
+
+def load_plugins(plugins=()):
+    """
+    Imports plugin modules, which register their processors.
+
+    :param plugins: Module names.
+    :type plugins: list
+    :return: Names of all the registered processors.
+    :rtype: set
+    """
+    for plugin in plugins:
+        importlib.import_module(plugin)
+    return {name for handlers in PROCESSORS.values() for name, _ in handlers}
+
+
+class ProcessContext:
+    """
+    What a processor knows about the file it handles.
+    """
+
+    def __init__(self, root, enabled, group=None, keep_archives=True):
+        """
+        Initializes the ProcessContext.
+
+        :param root: Path to the download folder.
+        :type root: str
+        :param enabled: Names of the enabled processors.
+        :type enabled: set
+        :param group: Name of the archive the file was extracted from, or None for a downloaded file.
+        :type group: str
+        :param keep_archives: Whether to keep archives once they are extracted.
+        :type keep_archives: bool
+        """
+        self.root = root
+        self.enabled = enabled
+        self.group = group
+        self.keep_archives = keep_archives
+        # Where the content of the file went, if a processor moved or removed it.
+        self.destination = None
+
+
+def free_path(path):
+    """
+    Returns the path itself if nothing exists there, the path with the first free ' (N)' suffix otherwise.
+
+    :param path: Wanted path.
+    :type path: str
+    :return: Free path.
+    :rtype: str
+    """
+    stem, extension = os.path.splitext(path)
+    number = 1
+    while os.path.exists(path):
+        path = f'{stem} ({number}){extension}'
+        number += 1
+    return path
+
+
+def same_content(path, other_path):
+    """
+    Checks whether two files hold the same bytes.
+
+    :param path: Path to a file.
+    :type path: str
+    :param other_path: Path to the other file.
+    :type other_path: str
+    :return: True if both files exist and are identical.
+    :rtype: bool
+    """
+    try:
+        return filecmp.cmp(path, other_path, shallow=False)
+    except OSError:
+        return False
+
+
+def flatten(folder):
+    """
+    Moves every file from the subfolders of a folder into the folder itself and removes the subfolders.
+
+    :param folder: Path to the folder.
+    :type folder: str
+    :return: Paths of the files.
+    :rtype: list
+    """
+    paths = []
+    for current, _, names in os.walk(folder, topdown=False):
+        for name in names:
+            path = os.path.join(current, name)
+            if current != folder:
+                target_path = free_path(os.path.join(folder, name))
+                os.replace(path, target_path)
+                path = target_path
+            paths.append(path)
+        if current != folder:
+            os.rmdir(current)
+    return paths
+
+
+@processor('extract', '.zip')
+def extract_zip(path, context):
+    """
+    Extracts a zip archive into a folder named after it, next to it. With the 'flatten' processor enabled,
+    the nested folders of the archive are flattened. The archive is removed afterwards unless asked to keep it.
+
+    :param path: Path to the archive.
+    :type path: str
+    :param context: Context of the file.
+    :type context: ProcessContext
+    :return: Paths of the extracted files.
+    :rtype: list
+    """
+    folder = free_path(os.path.splitext(path)[0])
+    with zipfile.ZipFile(path) as archive:
+        # extractall() drops absolute paths and '..' from the member names, so nothing lands outside the folder.
+        archive.extractall(folder)
+
+    if 'flatten' in context.enabled:
+        paths = flatten(folder)
+    else:
+        paths = [os.path.join(current, name) for current, _, names in os.walk(folder) for name in names]
+
+    if not context.keep_archives:
+        os.remove(path)
+        context.destination = folder
+    return paths
+
+
+@processor('sims', '.package', '.ts4script')
+def route_sims_mod(path, context):
+    """
+    Moves a Sims 4 mod into the 'Mods' folder. Mods extracted from an archive get a subfolder named after it;
+    a script mod is never nested deeper than that, as the game does not load it otherwise. A mod already in
+    the 'Mods' folder with the same content is not moved there again, the new copy is removed instead.
+
+    :param path: Path to the mod.
+    :type path: str
+    :param context: Context of the file.
+    :type context: ProcessContext
+    :return: No new files.
+    :rtype: list
+    """
+    folder = os.path.join(context.root, MODS_NAME)
+    if context.group:
+        folder = os.path.join(folder, context.group)
+    os.makedirs(folder, exist_ok=True)
+    target_path = os.path.join(folder, os.path.basename(path))
+    if same_content(path, target_path):
+        os.remove(path)
+    else:
+        target_path = free_path(target_path)
+        os.replace(path, target_path)
+    context.destination = target_path
+    return []
+
+
+def process_file(path, root, enabled, keep_archives=True):
+    """
+    Runs the enabled processors on a file and on the files they create. Runs in a worker process.
+
+    :param path: Path to the downloaded file.
+    :type path: str
+    :param root: Path to the download folder.
+    :type root: str
+    :param enabled: Names of the enabled processors.
+    :type enabled: set
+    :param keep_archives: Whether to keep archives once they are extracted.
+    :type keep_archives: bool
+    :return: Number of files handled by each processor, and where the downloaded file went if a processor moved
+        or removed it, otherwise None.
+    :rtype: tuple
+    """
+    counts = {}
+    destination = None
+    pending = [(path, None)]
+    while pending:
+        path, group = pending.pop()
+        for name, function in PROCESSORS.get(os.path.splitext(path)[1].lower(), []):
+            if name not in enabled or not os.path.exists(path):
+                continue
+            context = ProcessContext(root, enabled, group, keep_archives)
+            created = function(path, context)
+            counts[name] = counts.get(name, 0) + 1
+            if group is None and context.destination is not None:
+                destination = context.destination
+            child_group = group or os.path.splitext(os.path.basename(path))[0]
+            pending.extend((child, child_group) for child in created)
+    return counts, destination
+
+
+class PostProcessor:
+    """
+    Post-processes the downloaded files on a pool of worker processes while the download goes on, so unpacking
+    thousands of archives does not wait for the end of the run nor hold up the event loop.
+
+    Processors are chosen by file extension, see `processor`. Built-in ones: 'extract' unpacks zip archives,
+    'flatten' makes 'extract' flatten the folders inside them and 'sims' moves .package and .ts4script files
+    into a Sims 4 'Mods' layout.
+
+    A downloaded file that a processor moved or removed is reported to `moved` with where its content went,
+    so the manifest can keep treating it as downloaded instead of the next run fetching and processing it again.
+    """
+
+    def __init__(self, download_folder, enabled, workers=2, plugins=(), keep_archives=True, moved=None, log=print):
+        """
+        Initializes the PostProcessor and starts its worker processes.
+
+        :param download_folder: Path to the download folder.
+        :type download_folder: str
+        :param enabled: Names of the enabled processors.
+        :type enabled: list
+        :param workers: Number of worker processes.
+        :type workers: int
+        :param plugins: Names of modules registering more processors.
+        :type plugins: list
+        :param keep_archives: Whether to keep archives once they are extracted. A removed archive is downloaded again
+            by the next run, unless it only looks for new posts.
+        :type keep_archives: bool
+        :param moved: Optional coroutine function receiving the absolute path of a downloaded file that a processor
+            moved or removed and the absolute path where its content went.
+        :type moved: callable
+        :param log: Callable receiving log lines.
+        :type log: callable
+        :raises ValueError: If a processor is unknown.
+        """
+        unknown = set(enabled) - load_plugins(plugins) - {'flatten'}
+        if unknown:
+            raise ValueError(f'Unknown post-processors: {", ".join(sorted(unknown))}')
+
+        self.download_folder = download_folder
+        self.enabled = set(enabled)
+        self.keep_archives = keep_archives
+        self.moved = moved
+        self.log = log
+        self.executor = ProcessPoolExecutor(workers, initializer=load_plugins, initargs=(tuple(plugins),))
+        self._tasks = set()
+
+    def submit(self, name, path):
+        """
+        Queues a downloaded file for post-processing.
+
+        :param name: File name.
+        :type name: str
+        :param path: Path to the file.
+        :type path: str
+        :return: None
+        """
+        task = asyncio.ensure_future(self._process(name, path))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _process(self, name, path):
+        loop = asyncio.get_running_loop()
+        path = os.path.abspath(path)
+        try:
+            counts, destination = await loop.run_in_executor(self.executor, process_file, path,
+                                                             os.path.abspath(self.download_folder), self.enabled,
+                                                             self.keep_archives)
+        except Exception as e:
+            # Processors come from plugins too, so any error only costs this file.
+            self.log(f'Error occurred while post-processing | {name} |: {e}')
+            return
+        if destination is not None and self.moved is not None:
+            await self.moved(path, os.path.abspath(destination))
+        if counts:
+            summary = ', '.join(f'{processor_name} {count}' for processor_name, count in counts.items())
+            self.log(f'- Post-processed | {name} |: {summary}')
+
+    async def join(self):
+        """
+        Waits until every queued file is post-processed and stops the worker processes.
+
+        :return: None
+        """
+        try:
+            while self._tasks:
+                await asyncio.gather(*self._tasks)
+        finally:
+            self.executor.shutdown(cancel_futures=True)
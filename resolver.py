@@ -0,0 +1,251 @@
+import asyncio
+import os
+import re
+import time
+
+import aiohttp
+
+import retry
+from feed import CampaignNotFoundError, aiter_post_pages, iter_post_pages
+from settings import API_URL, HEADERS, STATE_DIR
+from state import JsonStore
+
+CAMPAIGN_ID_PATTERN = re.compile(r'https://www\.patreon\.com/api/campaigns/(\d+)')
+DEFAULT_CACHE_PATH = os.path.join(STATE_DIR, 'campaigns.json')
+
+
+class CampaignCache(JsonStore):
+    """
+    Persistent mapping of creator URLs to campaign IDs.
+
+    Saved as a JSON file, so repeat runs can skip downloading the creator page. Entries older than `ttl` seconds
+    are treated as missing and resolved again.
+    """
+
+    def __init__(self, path=DEFAULT_CACHE_PATH, ttl=30 * 24 * 3600):
+        """
+        Initializes the CampaignCache and loads the existing entries.
+
+        :param path: Path to the JSON cache file.
+        :type path: str
+        :param ttl: Time in seconds after which an entry expires.
+        :type ttl: float
+        """
+        super().__init__(path)
+        self.ttl = ttl
+
+    @staticmethod
+    def key(url):
+        """
+        Normalizes a creator URL, so different spellings of the same page share an entry.
+
+        :param url: Patreon creator URL.
+        :type url: str
+        :return: Cache key.
+        :rtype: str
+        """
+        url = url.strip().rstrip('/').lower()
+        if url.startswith('http://'):
+            url = 'https://' + url[len('http://'):]
+        return url
+
+    def get(self, url):
+        """
+        Returns the cached campaign ID of a creator.
+
+        :param url: Patreon creator URL.
+        :type url: str
+        :return: Campaign ID, or None if it is not cached or expired.
+        :rtype: str or None
+        """
+        entry = self.entries.get(self.key(url))
+        if entry is None or time.time() - entry['resolved_at'] > self.ttl:
+            return None
+        return entry['campaign_id']
+
+    def set(self, url, campaign_id):
+        """
+        Stores the campaign ID of a creator.
+
+        :param url: Patreon creator URL.
+        :type url: str
+        :param campaign_id: Patreon campaign ID.
+        :type campaign_id: str
+        :return: None
+        """
+        self.entries[self.key(url)] = {'campaign_id': campaign_id, 'resolved_at': time.time()}
+
+    def invalidate(self, url=None):
+        """
+        Drops the entry of a creator, or every entry if no URL is given.
+
+        :param url: Patreon creator URL.
+        :type url: str
+        :return: None
+        """
+        if url is None:
+            self.entries.clear()
+        else:
+            self.entries.pop(self.key(url), None)
+
+
+def find_campaign_id(html_text):
+    """
+    Extracts the campaign ID from a creator page.
+
+    :param html_text: HTML of the creator page.
+    :type html_text: str
+    :return: Patreon campaign ID.
+    :rtype: str
+    :raises ValueError: If the page does not reference a campaign.
+    """
+    match = CAMPAIGN_ID_PATTERN.search(html_text)
+    if match is None:
+        raise ValueError('No campaign ID found on the page')
+    return match.group(1)
+
+
+async def resolve_campaign_id(session, url, headers=HEADERS, policy=None, limiter=None):
+    """
+    Fetches a creator page and extracts its campaign ID.
+
+    :param session: Aiohttp session.
+    :type session: aiohttp.ClientSession
+    :param url: Patreon creator URL.
+    :type url: str
+    :param headers: Request headers.
+    :type headers: dict
+    :param policy: Retry policy of the requests. Defaults to retry.DEFAULT_POLICY.
+    :type policy: retry.RetryPolicy
+    :param limiter: Optional rate limiter of the Patreon host.
+    :type limiter: retry.AdaptiveLimiter
+    :return: Patreon campaign ID.
+    :rtype: str
+    """
+    async with retry.request(session, url, policy, limiter, headers=headers) as response:
+        response.raise_for_status()
+        html_text = await response.text()
+    return find_campaign_id(html_text)
+
+
+async def resolve_campaign(session, url, headers=HEADERS, log=print, cache=None, policy=None, limiter=None):
+    """
+    Resolves the campaign ID of a creator, from the cache if possible. A creator that cannot be resolved is logged.
+
+    :param session: Aiohttp session.
+    :type session: aiohttp.ClientSession
+    :param url: Patreon creator URL.
+    :type url: str
+    :param headers: Request headers.
+    :type headers: dict
+    :param log: Callable receiving log lines.
+    :type log: callable
+    :param cache: Optional campaign cache, read before and updated after resolving. Saving it is up to the caller.
+    :type cache: CampaignCache
+    :param policy: Retry policy of the requests. Defaults to retry.DEFAULT_POLICY.
+    :type policy: retry.RetryPolicy
+    :param limiter: Optional rate limiter of the Patreon host.
+    :type limiter: retry.AdaptiveLimiter
+    :return: Patreon campaign ID, or None.
+    :rtype: str or None
+    """
+    cached_id = cache.get(url) if cache is not None else None
+    if cached_id is not None:
+        return cached_id
+
+    try:
+        campaign_id = await resolve_campaign_id(session, url, headers, policy, limiter)
+    except (aiohttp.ClientError, asyncio.TimeoutError, ValueError) as e:
+        log(f'Failed to resolve {url}: {e}')
+        return None
+
+    if cache is not None:
+        cache.set(url, campaign_id)
+    return campaign_id
+
+
+async def aiter_creator_pages(session, url, campaign_id, cache=None, api_url=API_URL, headers=HEADERS,
+                              policy=None, limiter=None, response_cache=None):
+    """
+    Yields the posts pages of a creator.
+
+    If the campaign no longer exists, e.g. because the cached ID is outdated, the creator page is fetched again
+    and the feed is walked with the new campaign ID.
+
+    :param session: Aiohttp session.
+    :type session: aiohttp.ClientSession
+    :param url: Patreon creator URL.
+    :type url: str
+    :param campaign_id: Campaign ID resolved for the creator.
+    :type campaign_id: str
+    :param cache: Optional campaign cache to update with the new ID.
+    :type cache: CampaignCache
+    :param api_url: Patreon API URL for fetching posts data.
+    :type api_url: str
+    :param headers: Request headers.
+    :type headers: dict
+    :param policy: Retry policy of the requests. Defaults to retry.DEFAULT_POLICY.
+    :type policy: retry.RetryPolicy
+    :param limiter: Optional rate limiter of the Patreon host.
+    :type limiter: retry.AdaptiveLimiter
+    :param response_cache: Optional cache of the API responses, see feed.aiter_post_pages.
+    :type response_cache: httpcache.ResponseCache
+    :return: Asynchronous generator of decoded posts pages.
+    :rtype: async_generator
+    """
+    try:
+        async for page in aiter_post_pages(session, campaign_id, api_url, headers, policy, limiter, response_cache):
+            yield page
+        return
+    except CampaignNotFoundError:
+        if cache is None:
+            raise
+
+    cache.invalidate(url)
+    campaign_id = await resolve_campaign_id(session, url, headers, policy, limiter)
+    cache.set(url, campaign_id)
+    cache.save()
+
+    async for page in aiter_post_pages(session, campaign_id, api_url, headers, policy, limiter, response_cache):
+        yield page
+
+
+def iter_creator_pages(session, url, campaign_id, cache=None, api_url=API_URL, headers=HEADERS, policy=None,
+                       response_cache=None):
+    """
+    Synchronous counterpart of aiter_creator_pages built on requests.
+
+    :param session: Requests session.
+    :type session: requests.Session
+    :param url: Patreon creator URL.
+    :type url: str
+    :param campaign_id: Campaign ID resolved for the creator.
+    :type campaign_id: str
+    :param cache: Optional campaign cache to update with the new ID.
+    :type cache: CampaignCache
+    :param api_url: Patreon API URL for fetching posts data.
+    :type api_url: str
+    :param headers: Request headers.
+    :type headers: dict
+    :param policy: Retry policy of the requests. Defaults to retry.DEFAULT_POLICY.
+    :type policy: retry.RetryPolicy
+    :param response_cache: Optional cache of the API responses, see feed.iter_post_pages.
+    :type response_cache: httpcache.ResponseCache
+    :return: Generator of decoded posts pages.
+    :rtype: generator
+    """
+    try:
+        yield from iter_post_pages(session, campaign_id, api_url, headers, policy, response_cache)
+        return
+    except CampaignNotFoundError:
+        if cache is None:
+            raise
+
+    cache.invalidate(url)
+    response = retry.get(session, url, policy, headers=headers)
+    response.raise_for_status()
+    campaign_id = find_campaign_id(response.text)
+    cache.set(url, campaign_id)
+    cache.save()
+
+    yield from iter_post_pages(session, campaign_id, api_url, headers, policy, response_cache)
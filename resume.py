@@ -0,0 +1,183 @@
+import os
+import re
+
+from state import JsonStore
+
+JOURNAL_NAME = '.partial-downloads.json'
+CONTENT_RANGE_PATTERN = re.compile(r'bytes (\d+)-(\d+)/(\d+|\*)')
+
+
+class ResumeJournal(JsonStore):
+    """
+    Journal of the unfinished downloads of a folder.
+
+    For every '.part' file it records the URL, the expected size and the validators (ETag, Last-Modified)
+    of the response, so a later run can continue the transfer with a Range request instead of starting over.
+    Patreon signs its download URLs and they change between runs, so a transfer is found again by file name, and
+    If-Range with the recorded validator makes the server send the whole file if its content changed.
+    """
+
+    remove_if_empty = True
+
+    def __init__(self, download_folder, autosave=True):
+        """
+        Initializes the ResumeJournal of a download folder and loads the existing entries.
+
+        :param download_folder: Path to the folder where the downloaded files are saved.
+        :type download_folder: str
+        :param autosave: Whether record() and discard() save the journal. Asynchronous callers turn this off and
+            call asave() instead, so the file lock is not waited for on the event loop.
+        :type autosave: bool
+        """
+        super().__init__(os.path.join(download_folder, JOURNAL_NAME))
+        self.autosave = autosave
+
+    def resume_offset(self, name, url, part_path):
+        """
+        Returns the number of bytes that can be kept from an earlier attempt to download a file.
+
+        A '.part' file without a journal entry cannot be trusted and is removed, as is one downloaded from another
+        URL without a validator, which could not tell the server to send the whole file if it changed, and one
+        still preallocated to its full size because the run writing it was killed.
+
+        :param name: File name.
+        :type name: str
+        :param url: File URL.
+        :type url: str
+        :param part_path: Path to the '.part' file.
+        :type part_path: str
+        :return: Offset to resume from.
+        :rtype: int
+        """
+        if not os.path.exists(part_path):
+            return 0
+
+        entry = self.entries.get(name)
+        if (entry is None or entry.get('preallocated')
+                or entry['url'] != url and not (entry.get('etag') or entry.get('last_modified'))):
+            os.remove(part_path)
+            self.discard(name)
+            return 0
+        return os.path.getsize(part_path)
+
+    def request_headers(self, name, offset):
+        """
+        Builds the headers of a file request, asking for the rest of the file if a part of it is already on disk.
+
+        The body is requested without content encoding, so byte offsets and Content-Length refer to the file
+        itself. If-Range makes the server send the whole file again if it changed since the first attempt.
+
+        :param name: File name.
+        :type name: str
+        :param offset: Number of bytes already on disk.
+        :type offset: int
+        :return: Request headers.
+        :rtype: dict
+        """
+        headers = {'Accept-Encoding': 'identity'}
+        if not offset:
+            return headers
+
+        headers['Range'] = f'bytes={offset}-'
+        entry = self.entries[name]
+        validator = entry.get('etag') or entry.get('last_modified')
+        if validator:
+            headers['If-Range'] = validator
+        return headers
+
+    def record(self, name, url, status, offset, headers):
+        """
+        Stores the journal entry of a transfer that is about to start and saves the journal if autosave is on.
+
+        :param name: File name.
+        :type name: str
+        :param url: File URL.
+        :type url: str
+        :param status: Response status code.
+        :type status: int
+        :param offset: Number of bytes already on disk.
+        :type offset: int
+        :param headers: Response headers.
+        :type headers: Mapping
+        :return: Expected size of the complete file, or None if unknown.
+        :rtype: int or None
+        """
+        size = expected_size(status, offset, headers)
+        self.entries[name] = {'url': url, 'size': size,
+                              'etag': headers.get('ETag'), 'last_modified': headers.get('Last-Modified')}
+        if self.autosave:
+            self.save()
+        return size
+
+    def preallocating(self, name, preallocated=True):
+        """
+        Marks the '.part' file of a transfer as preallocated, or as truncated to the bytes written once the transfer
+        stopped, and saves the journal if autosave is on. The size of a preallocated file does not tell how much of
+        it arrived, so it is not resumed.
+
+        :param name: File name.
+        :type name: str
+        :param preallocated: Whether the file is about to be preallocated, False once it is truncated.
+        :type preallocated: bool
+        :return: None
+        """
+        entry = self.entries.get(name)
+        if entry is None or bool(entry.get('preallocated')) == preallocated:
+            return
+        if preallocated:
+            entry['preallocated'] = True
+        else:
+            del entry['preallocated']
+        if self.autosave:
+            self.save()
+
+    def discard(self, name):
+        """
+        Drops the entry of a file, e.g. after it is complete, and saves the journal if autosave is on. An empty
+        journal is removed.
+
+        :param name: File name.
+        :type name: str
+        :return: None
+        """
+        if self.entries.pop(name, None) is not None and self.autosave:
+            self.save()
+
+
+def content_range_start(headers):
+    """
+    Returns the first byte of a partial response.
+
+    :param headers: Response headers.
+    :type headers: Mapping
+    :return: Offset of the first byte of the body in the file, or None if Content-Range is missing or invalid.
+    :rtype: int or None
+    """
+    match = CONTENT_RANGE_PATTERN.match(headers.get('Content-Range', ''))
+    return int(match.group(1)) if match else None
+
+
+def expected_size(status, offset, headers):
+    """
+    Works out the size of the complete file from the response headers.
+
+    :param status: Response status code, 200 or 206.
+    :type status: int
+    :param offset: Number of bytes already on disk.
+    :type offset: int
+    :param headers: Response headers.
+    :type headers: Mapping
+    :return: Expected size, or None if the server did not announce it.
+    :rtype: int or None
+    """
+    if status == 206:
+        match = CONTENT_RANGE_PATTERN.match(headers.get('Content-Range', ''))
+        if match and match.group(3) != '*':
+            return int(match.group(3))
+        if headers.get('Content-Length'):
+            return offset + int(headers['Content-Length'])
+        return None
+
+    if headers.get('Content-Length'):
+        return int(headers['Content-Length'])
+    return None
@@ -0,0 +1,275 @@
+import asyncio
+import contextlib
+import email.utils
+import random
+import time
+
+import aiohttp
+import requests
+
+RETRY_STATUSES = frozenset({429, 500, 502, 503, 504})
+
+
+def parse_retry_after(value):
+    """
+    Parses a Retry-After header given either in seconds or as an HTTP date.
+
+    :param value: Header value.
+    :type value: str
+    :return: Number of seconds to wait, or None if the header is missing or invalid.
+    :rtype: float or None
+    """
+    if not value:
+        return None
+    try:
+        return max(float(value), 0.0)
+    except ValueError:
+        pass
+    try:
+        moment = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    return max(moment.timestamp() - time.time(), 0.0)
+
+
+class RetryPolicy:
+    """
+    Decides which failed requests are retried and how long to wait before each attempt.
+
+    Waits grow exponentially with full jitter, so clients failing together do not retry in lockstep. A delay
+    requested by the server through Retry-After is always honoured.
+    """
+
+    def __init__(self, attempts=5, base_delay=0.5, max_delay=60.0, statuses=RETRY_STATUSES):
+        """
+        Initializes the RetryPolicy.
+
+        :param attempts: Maximum number of attempts, including the first one. 1 disables retrying.
+        :type attempts: int
+        :param base_delay: Upper bound of the first wait, in seconds. Doubles with every attempt.
+        :type base_delay: float
+        :param max_delay: Upper bound of any wait computed by the backoff, in seconds.
+        :type max_delay: float
+        :param statuses: Response statuses that are retried.
+        :type statuses: frozenset
+        """
+        if attempts < 1:
+            raise ValueError('At least one attempt is needed')
+
+        self.attempts = attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.statuses = statuses
+
+    def delay(self, attempt, retry_after=None):
+        """
+        Returns the time to wait before the next attempt.
+
+        :param attempt: Number of the failed attempt, starting at 0.
+        :type attempt: int
+        :param retry_after: Delay requested by the server, in seconds.
+        :type retry_after: float
+        :return: Time to wait, in seconds.
+        :rtype: float
+        """
+        backoff = random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+        if retry_after is not None:
+            return max(retry_after, backoff)
+        return backoff
+
+
+DEFAULT_POLICY = RetryPolicy()
+
+
+class AdaptiveLimiter:
+    """
+    Token bucket limiting the rate and the concurrency of the requests to one host.
+
+    Every request takes a token, and tokens come back at `rate` per second. When the host throttles, the rate
+    and the number of concurrent slots are halved and requests pause for the Retry-After delay. Every run of
+    successful requests as long as the current slot count adds a slot back and a tenth of the maximum rate,
+    so the limiter settles just below what the host accepts.
+    """
+
+    def __init__(self, rate=10.0, concurrency=4, min_rate=0.5):
+        """
+        Initializes the AdaptiveLimiter.
+
+        :param rate: Starting and maximum number of requests per second.
+        :type rate: float
+        :param concurrency: Starting and maximum number of slots held at the same time.
+        :type concurrency: int
+        :param min_rate: Lower bound of the rate when throttled.
+        :type min_rate: float
+        """
+        if rate <= 0 or concurrency < 1:
+            raise ValueError('Rate and concurrency must be positive')
+
+        self.max_rate = self.rate = rate
+        self.max_concurrency = self.concurrency = concurrency
+        self.min_rate = min(min_rate, rate)
+
+        self._tokens = max(rate, 1.0)
+        self._updated_at = time.monotonic()
+        self._paused_until = 0.0
+        self._successes = 0
+        self._active = 0
+        self._condition = asyncio.Condition()
+
+    def _refill(self, now):
+        self._tokens = min(self._tokens + (now - self._updated_at) * self.rate, max(self.rate, 1.0))
+        self._updated_at = now
+
+    async def acquire(self):
+        """
+        Waits for a token. Call before every request.
+
+        :return: None
+        """
+        while True:
+            now = time.monotonic()
+            self._refill(now)
+            if now >= self._paused_until and self._tokens >= 1:
+                self._tokens -= 1
+                return
+            await asyncio.sleep(max(self._paused_until - now, (1 - self._tokens) / self.rate))
+
+    @contextlib.asynccontextmanager
+    async def slot(self):
+        """
+        Holds one of the concurrent slots for the duration of a transfer.
+
+        :return: Asynchronous context manager.
+        """
+        async with self._condition:
+            await self._condition.wait_for(lambda: self._active < self.concurrency)
+            self._active += 1
+        try:
+            yield
+        finally:
+            async with self._condition:
+                self._active -= 1
+                self._condition.notify_all()
+
+    def throttled(self, retry_after=None):
+        """
+        Slows down after the host answered with 429, or with 503 and a Retry-After header.
+
+        :param retry_after: Delay requested by the server, in seconds.
+        :type retry_after: float
+        :return: None
+        """
+        self.rate = max(self.rate / 2, self.min_rate)
+        self.concurrency = max(self.concurrency // 2, 1)
+        self._tokens = min(self._tokens, 0.0)
+        self._successes = 0
+        if retry_after:
+            self._paused_until = max(self._paused_until, time.monotonic() + retry_after)
+
+    def succeeded(self):
+        """
+        Speeds up again after enough requests went through.
+
+        :return: None
+        """
+        self._successes += 1
+        if self._successes >= self.concurrency:
+            self._successes = 0
+            self.rate = min(self.rate + self.max_rate / 10, self.max_rate)
+            self.concurrency = min(self.concurrency + 1, self.max_concurrency)
+
+
+@contextlib.asynccontextmanager
+async def request(session, url, policy=None, limiter=None, log=None, **kwargs):
+    """
+    Sends a GET request with aiohttp, retrying connection errors and the statuses of the retry policy.
+
+    Used like session.get. The response of the last attempt is returned even if its status is an error, so
+    the caller handles it as before.
+
+    :param session: Aiohttp session.
+    :type session: aiohttp.ClientSession
+    :param url: Request URL.
+    :type url: str
+    :param policy: Retry policy. Defaults to DEFAULT_POLICY.
+    :type policy: RetryPolicy
+    :param limiter: Optional limiter of the requested host, told about throttling and successes.
+    :type limiter: AdaptiveLimiter
+    :param log: Optional callable receiving a line before every retry.
+    :type log: callable
+    :param kwargs: Extra arguments passed to session.get.
+    :return: Asynchronous context manager of the response.
+    """
+    policy = policy or DEFAULT_POLICY
+
+    for attempt in range(policy.attempts):
+        last_attempt = attempt + 1 == policy.attempts
+        if limiter is not None:
+            await limiter.acquire()
+
+        try:
+            response = await session.get(url, **kwargs)
+        except (aiohttp.ClientConnectionError, asyncio.TimeoutError) as e:
+            if last_attempt:
+                raise
+            reason, retry_after = str(e) or type(e).__name__, None
+        else:
+            retry_after = parse_retry_after(response.headers.get('Retry-After'))
+            if limiter is not None:
+                if response.status == 429 or (response.status == 503 and retry_after is not None):
+                    limiter.throttled(retry_after)
+                elif response.status < 500:
+                    limiter.succeeded()
+
+            if last_attempt or response.status not in policy.statuses:
+                try:
+                    yield response
+                finally:
+                    response.release()
+                return
+
+            response.release()
+            reason = f'status code {response.status}'
+
+        delay = policy.delay(attempt, retry_after)
+        if log is not None:
+            log(f'Retrying {url} in {delay:.1f} s ({reason}).')
+        await asyncio.sleep(delay)
+
+
+def get(http, url, policy=None, log=None, **kwargs):
+    """
+    Synchronous counterpart of request built on requests.
+
+    :param http: Requests session or the requests module.
+    :param url: Request URL.
+    :type url: str
+    :param policy: Retry policy. Defaults to DEFAULT_POLICY.
+    :type policy: RetryPolicy
+    :param log: Optional callable receiving a line before every retry.
+    :type log: callable
+    :param kwargs: Extra arguments passed to http.get.
+    :return: Response of the last attempt.
+    :rtype: requests.Response
+    """
+    policy = policy or DEFAULT_POLICY
+
+    for attempt in range(policy.attempts):
+        last_attempt = attempt + 1 == policy.attempts
+        try:
+            response = http.get(url, **kwargs)
+        except (requests.ConnectionError, requests.Timeout) as e:
+            if last_attempt:
+                raise
+            reason, retry_after = str(e) or type(e).__name__, None
+        else:
+            if last_attempt or response.status_code not in policy.statuses:
+                return response
+            response.close()
+            reason = f'status code {response.status_code}'
+            retry_after = parse_retry_after(response.headers.get('Retry-After'))
+
+        delay = policy.delay(attempt, retry_after)
+        if log is not None:
+            log(f'Retrying {url} in {delay:.1f} s ({reason}).')
+        time.sleep(delay)
@@ -0,0 +1,524 @@
+import asyncio
+import hashlib
+import os
+import sqlite3
+from urllib.parse import urlsplit
+
+import aiohttp
+
+from dedup import hash_file
+from metrics import TransferMetrics
+from resume import ResumeJournal, content_range_start
+from retry import DEFAULT_POLICY, AdaptiveLimiter, request
+
+
+class DownloadScheduler:
+    """
+    Downloads files with a bounded number of transfers in flight.
+
+    A fixed pool of workers drains a shared work queue, so up to `max_concurrency` files are transferred at once,
+    and no more than `per_host_limit` of them talk to the same host. Files can be submitted while the pool is
+    running, so downloading starts as soon as the first file is known. The queue is bounded, so submitting
+    waits while the workers are busy instead of piling up files in memory. Each host gets an adaptive rate limiter
+    that backs off when the host throttles, and interrupted transfers are retried from where they stopped.
+    Progress is counted in bytes by a TransferMetrics and reported through a callback instead of blocking the loop
+    on each file. Files are hashed, and moved into or linked from the blob store, on worker threads.
+
+    With a disk budget, a transfer only starts once the space it needs is reserved, so a nearly full disk pauses the
+    download. Files are written through a buffer of `write_buffer` bytes, and with a sync batcher their content is
+    flushed to the disk before they are renamed into place.
+
+    With a verifier, every saved file is checked on the verifier's thread pool while the worker moves on to the
+    next file. A file that fails the check is quarantined and downloaded once more.
+
+    Does not depend on Qt, so it can be driven by the GUI as well as by headless scripts.
+    """
+
+    def __init__(self, download_folder, max_concurrency=8, per_host_limit=4, chunk_size=256 * 1024,
+                 log=print, progress=None, store=None, metrics=None, policy=DEFAULT_POLICY, host_rate=20.0,
+                 manifest=None, queue_size=None, verifier=None, completed=None, layout=None,
+                 write_buffer=1024 * 1024, disk_budget=None, syncer=None):
+        """
+        Initializes the DownloadScheduler.
+
+        :param download_folder: Path to the folder where the downloaded files are saved.
+        :type download_folder: str
+        :param max_concurrency: Maximum number of transfers in flight overall.
+        :type max_concurrency: int
+        :param per_host_limit: Maximum number of transfers in flight to a single host.
+        :type per_host_limit: int
+        :param chunk_size: Size of the chunks read from the response body, in bytes.
+        :type chunk_size: int
+        :param log: Callable receiving log lines.
+        :type log: callable
+        :param progress: Optional callable receiving the TransferMetrics after every chunk and every finished file.
+        :type progress: callable
+        :param store: Optional blob store deduplicating the downloaded files.
+        :type store: dedup.BlobStore
+        :param metrics: Metrics to update. A new TransferMetrics is created if not given.
+        :type metrics: metrics.TransferMetrics
+        :param policy: Retry policy of the file requests and of the interrupted transfers.
+        :type policy: retry.RetryPolicy
+        :param host_rate: Maximum number of requests per second to a single host.
+        :type host_rate: float
+        :param manifest: Optional manifest recording the files and telling which ones were already downloaded.
+        :type manifest: manifest.Manifest
+        :param queue_size: Maximum number of files waiting for a worker. Defaults to four per worker.
+        :type queue_size: int
+        :param verifier: Optional verifier checking the saved files.
+        :type verifier: verify.Verifier
+        :param completed: Optional callable receiving the name and path of every file saved or linked into the
+            download folder, once it is verified.
+        :type completed: callable
+        :param layout: Optional output layout, whose listing of the download folder replaces a stat call per file.
+            File names may then be paths relative to the download folder.
+        :type layout: layout.OutputLayout
+        :param write_buffer: Size of the buffer the files are written through, in bytes. A larger buffer means
+            fewer, larger writes, which suits network and spinning disks.
+        :type write_buffer: int
+        :param disk_budget: Optional disk budget admitting the transfers.
+        :type disk_budget: storage.DiskBudget
+        :param syncer: Optional sync batcher flushing the files to the disk before they are renamed into place.
+        :type syncer: storage.SyncBatcher
+        """
+        if max_concurrency < 1 or per_host_limit < 1:
+            raise ValueError('Concurrency limits must be positive')
+
+        self.download_folder = download_folder
+        self.journal = ResumeJournal(download_folder, autosave=False)
+        self.max_concurrency = max_concurrency
+        self.per_host_limit = per_host_limit
+        self.chunk_size = chunk_size
+        self.log = log
+        self.progress = progress
+        self.store = store
+        self.metrics = metrics or TransferMetrics()
+        self.policy = policy
+        self.host_rate = host_rate
+        self.manifest = manifest
+        self.queue_size = queue_size or 4 * max_concurrency
+        self.verifier = verifier
+        self.completed = completed
+        self.layout = layout
+        self.write_buffer = write_buffer
+        self.disk_budget = disk_budget
+        self.syncer = syncer
+
+        self.failed = set()
+        self._sources = {}
+        self._placed = {}
+        self._requeued = set()
+        self._verifications = set()
+        self._journal_saves = set()
+        self._folders = set()
+        self._host_limits = {}
+        self._queue = None
+        self._workers = []
+
+    def _host_limit(self, url):
+        """
+        Returns the limiter guarding the host of the given URL, creating it on first use.
+
+        :param url: File URL.
+        :type url: str
+        :return: Per-host limiter.
+        :rtype: retry.AdaptiveLimiter
+        """
+        host = urlsplit(url).netloc
+        if host not in self._host_limits:
+            self._host_limits[host] = AdaptiveLimiter(self.host_rate, self.per_host_limit)
+        return self._host_limits[host]
+
+    def _save_journal(self):
+        """
+        Saves the resume journal in the background. Other processes downloading into the same folder share its
+        lock, which is waited for on a worker thread instead of the event loop.
+
+        :return: None
+        """
+        task = asyncio.ensure_future(self._write_journal())
+        self._journal_saves.add(task)
+        task.add_done_callback(self._journal_saves.discard)
+
+    async def _write_journal(self):
+        try:
+            await self.journal.asave()
+        except (OSError, TimeoutError) as e:
+            # The transfers go on; at worst an interrupted one starts over on the next run.
+            self.log(f'Error occurred while saving the resume journal: {e}')
+
+    @property
+    def stats(self):
+        return self.metrics.outcomes
+
+    def _report(self):
+        if self.progress is not None:
+            self.progress(self.metrics)
+
+    async def _fetch(self, session, name, url):
+        """
+        Downloads a single file.
+
+        The file is written to a '.part' file that is renamed once complete. A '.part' file left by an earlier,
+        interrupted attempt is continued with a Range request, so a transfer that breaks off is retried with
+        backoff from where it stopped. Files are hashed while they are streamed. With a manifest, a file already
+        downloaded by an earlier run, into any folder, is skipped. With a blob store, a file whose URL or ETag and
+        size are already known is linked from the store instead of being transferred.
+
+        :param session: Shared aiohttp session.
+        :type session: aiohttp.ClientSession
+        :param name: File name.
+        :type name: str
+        :param url: File URL.
+        :type url: str
+        :return: Outcome of the transfer: 'saved', 'linked', 'skipped' or 'failed'.
+        :rtype: str
+        """
+        source = self._sources.get(name)
+        if self.manifest is not None and source is not None:
+            try:
+                downloaded_path = await self.manifest.adownloaded_path(source[0], source[1], source[3])
+            except sqlite3.Error as e:
+                self.log(f'Error occurred while looking up | {name} | in the manifest: {e}')
+                downloaded_path = None
+            if downloaded_path is not None:
+                self.log(f'- The file | {name} | was already downloaded to {os.path.dirname(downloaded_path)}.')
+                return 'skipped'
+
+        file_path = os.path.join(self.download_folder, name)
+        existing_size = self._existing_size(name, file_path)
+        if existing_size is not None:
+            self.log(f'- The file | {name} | already exists.')
+            await self._remember(name, url, 'saved', existing_size, file_path=file_path)
+            return 'skipped'
+
+        folder = os.path.dirname(file_path)
+        if folder not in self._folders:
+            os.makedirs(folder, exist_ok=True)
+            self._folders.add(folder)
+
+        if self.store is not None:
+            digest = self.store.find(url=url)
+            if digest is not None:
+                return await self._link(name, url, digest, file_path)
+
+        try:
+            for attempt in range(self.policy.attempts):
+                try:
+                    return await self._transfer(session, name, url, file_path)
+                except aiohttp.ClientPayloadError as e:
+                    error = e
+                except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                    # request() already retried the connection, only a body cut off midway is retried here.
+                    self.log(f'Error occurred while downloading {url}: {e}')
+                    return 'failed'
+                except OSError as e:
+                    self.log(f'Error occurred while downloading {url}: {e}')
+                    return 'failed'
+
+                if attempt + 1 < self.policy.attempts:
+                    delay = self.policy.delay(attempt)
+                    self.log(f'- Download of | {name} | interrupted ({error}), retrying in {delay:.1f} s.')
+                    await asyncio.sleep(delay)
+        finally:
+            if self.disk_budget is not None:
+                self.disk_budget.release(name)
+
+        self.log(f'Error occurred while downloading {url}: {error}')
+        return 'failed'
+
+    def _existing_size(self, name, file_path):
+        """
+        Returns the size of a file already in the download folder. With a layout, a file missing from its listing
+        costs no stat call.
+
+        :param name: File name.
+        :type name: str
+        :param file_path: Path to the file.
+        :type file_path: str
+        :return: Size in bytes, or None if the file is not there.
+        :rtype: int or None
+        """
+        if self.layout is not None and not self.layout.exists(name):
+            return None
+        try:
+            return os.path.getsize(file_path)
+        except FileNotFoundError:
+            # Listed by the layout but moved since, e.g. by a post-processor: it is downloaded again.
+            return None
+
+    async def _transfer(self, session, name, url, file_path):
+        part_path = file_path + '.part'
+        hasher = None
+        loop = asyncio.get_running_loop()
+        limiter = self._host_limit(url)
+        if self.disk_budget is not None:
+            # Reserves the size announced by the posts feed before taking a slot, so waiting for space holds
+            # no connection.
+            progress = self.metrics.files.get(name)
+            await self.disk_budget.admit(name, progress and progress.expected)
+        async with limiter.slot():
+            offset = self.journal.resume_offset(name, url, part_path)
+            async with request(session, url, self.policy, limiter, self.log,
+                               headers=self.journal.request_headers(name, offset)) as response:
+                if response.status == 416 and offset:
+                    if self.journal.entries[name]['size'] == offset:
+                        return await self._complete(name, url, part_path, file_path)
+                    os.remove(part_path)
+                    self.journal.discard(name)
+                    self._save_journal()
+
+                if response.status not in (200, 206):
+                    self.log(f'Failed to download {url}. Status code: {response.status}')
+                    return 'failed'
+
+                if response.status == 200:
+                    offset = 0
+                elif content_range_start(response.headers) != offset:
+                    # Appending another range than the one asked for would corrupt the file: start over.
+                    os.remove(part_path)
+                    self.journal.discard(name)
+                    self._save_journal()
+                    raise aiohttp.ClientPayloadError(f'got {response.headers.get("Content-Range")} instead of bytes '
+                                                     f'{offset}-')
+                size = self.journal.record(name, url, response.status, offset, response.headers)
+                self._save_journal()
+                self.metrics.file_started(name, size, offset)
+                etag = response.headers.get('ETag')
+
+                if self.store is not None:
+                    digest = self.store.find(etag=etag, size=size)
+                    if digest is not None:
+                        if os.path.exists(part_path):
+                            os.remove(part_path)
+                        self.journal.discard(name)
+                        self._save_journal()
+                        return await self._link(name, url, digest, file_path)
+                # Reading back hundreds of MB of an earlier attempt would hold up every other transfer.
+                hasher = await loop.run_in_executor(None, hash_file, part_path) if offset else hashlib.sha256()
+                if self.disk_budget is not None and size is not None:
+                    self.disk_budget.grow(name, size - offset)
+
+                with open(part_path, 'ab' if offset else 'wb', buffering=self.write_buffer) as f:
+                    while True:
+                        try:
+                            chunk = await response.content.read(self.chunk_size)
+                        except (aiohttp.ClientConnectionError, asyncio.TimeoutError) as e:
+                            raise aiohttp.ClientPayloadError(f'stopped at {f.tell()} bytes ({e})') from e
+                        if not chunk:
+                            break
+                        f.write(chunk)
+                        if hasher is not None:
+                            hasher.update(chunk)
+                        self.metrics.bytes_arrived(name, len(chunk))
+                        self._report()
+                    written = f.tell()
+
+        if size is not None and written != size:
+            raise aiohttp.ClientPayloadError(f'stopped at {written} of {size} bytes')
+
+        if self.syncer is not None:
+            await self.syncer.sync(part_path)
+        return await self._complete(name, url, part_path, file_path, hasher, etag, size)
+
+    async def _complete(self, name, url, part_path, file_path, hasher=None, etag=None, size=None):
+        loop = asyncio.get_running_loop()
+        if hasher is None:
+            hasher = await loop.run_in_executor(None, hash_file, part_path)
+        digest = hasher.hexdigest()
+        if size is None:
+            size = os.path.getsize(part_path)
+
+        if self.store is None:
+            os.replace(part_path, file_path)
+        else:
+            # Moving into the store copies across drives, and linking falls back to a copy.
+            await loop.run_in_executor(None, self.store.put, part_path, digest)
+            self.store.remember(digest, url, etag, size)
+            await loop.run_in_executor(None, self.store.link, digest, file_path)
+
+        self.journal.discard(name)
+        self._save_journal()
+        self._placed[name] = (file_path, size, digest)
+        await self._remember(name, url, 'saved', size, digest, file_path)
+        self.log(f'- Saved: | {name} |')
+        return 'saved'
+
+    async def _link(self, name, url, digest, file_path):
+        await asyncio.get_running_loop().run_in_executor(None, self.store.link, digest, file_path)
+        await self._remember(name, url, 'linked', os.path.getsize(file_path), digest, file_path)
+        self.log(f'- Linked from the store: | {name} |')
+        return 'linked'
+
+    async def _remember(self, name, url, status, size=None, digest=None, file_path=None):
+        source = self._sources.get(name)
+        if self.manifest is None or source is None:
+            return
+        campaign_id, post_id, attachment_id, file_name = source
+        try:
+            await self.manifest.arecord(campaign_id, post_id, file_name, url, status, attachment_id, size, digest,
+                                        file_path and os.path.abspath(file_path))
+        except sqlite3.Error as e:
+            # The file itself is fine; only the next run may not know it was downloaded.
+            self.log(f'Error occurred while recording | {name} | in the manifest: {e}')
+
+    async def _finish(self, name, url, outcome):
+        if outcome == 'failed':
+            self.failed.add(name)
+            await self._remember(name, url, outcome)
+        elif outcome in ('saved', 'linked'):
+            if self.layout is not None:
+                self.layout.add(name)
+            if self.completed is not None:
+                self.completed(name, os.path.join(self.download_folder, name))
+        self.metrics.file_finished(name, outcome)
+        self._report()
+
+    async def _verify(self, name, url):
+        """
+        Checks a saved file. A broken file is moved to the quarantine, dropped from the blob store and queued again
+        once; if the second download is broken too, it stays in the quarantine and counts as failed.
+
+        :param name: File name.
+        :type name: str
+        :param url: File URL.
+        :type url: str
+        :return: None
+        """
+        file_path, size, digest = self._placed.pop(name)
+        outcome = 'saved'
+        try:
+            problem = await self.verifier.check(file_path, size)
+            if problem is not None:
+                quarantine_path = self.verifier.quarantine(file_path)
+                if self.store is not None:
+                    self.store.remove(digest)
+                if name not in self._requeued:
+                    self._requeued.add(name)
+                    self.log(f'- | {name} | failed verification ({problem}), moved to the quarantine and queued again.')
+                    await self._remember(name, url, 'failed')
+                    await self._queue.put((name, url))
+                    return
+                self.log(f'Failed to verify | {name} | again ({problem}), kept at {quarantine_path}.')
+                outcome = 'failed'
+        except Exception as e:
+            self.log(f'Error occurred while verifying | {name} |: {e!r}')
+            outcome = 'failed'
+
+        await self._finish(name, url, outcome)
+        self._sources.pop(name, None)
+
+    async def _worker(self, session, queue):
+        while True:
+            name, url = await queue.get()
+            verifying = False
+            try:
+                outcome = await self._fetch(session, name, url)
+                verifying = outcome == 'saved' and self.verifier is not None and name in self._placed
+                if verifying:
+                    verification = asyncio.create_task(self._verify(name, url))
+                    self._verifications.add(verification)
+                    verification.add_done_callback(self._verifications.discard)
+                else:
+                    await self._finish(name, url, outcome)
+            except Exception as e:
+                # An unexpected error costs this file only; a dead worker would leave join() waiting forever.
+                self.log(f'Error occurred while downloading {url}: {e!r}')
+                await self._finish(name, url, 'failed')
+            finally:
+                if not verifying:
+                    self._placed.pop(name, None)
+                    self._sources.pop(name, None)
+                queue.task_done()
+
+    async def start(self, session):
+        """
+        Starts the worker pool. Files can be submitted afterwards while earlier ones are already downloading.
+
+        :param session: Aiohttp session shared by the workers.
+        :type session: aiohttp.ClientSession
+        :return: None
+        """
+        self._queue = asyncio.Queue(self.queue_size)
+        self._workers = [asyncio.create_task(self._worker(session, self._queue))
+                         for _ in range(self.max_concurrency)]
+
+    async def submit(self, name, url, size=None, source=None):
+        """
+        Queues a file for download. Waits while the queue is full.
+
+        :param name: File name.
+        :type name: str
+        :param url: File URL.
+        :type url: str
+        :param size: Size of the file in bytes if the posts feed announced it, counted in the progress until
+            the response tells the exact size.
+        :type size: int
+        :param source: Campaign ID, post ID, attachment ID and name of the file in the posts feed, under which it is
+            kept in the manifest.
+        :type source: tuple
+        :return: None
+        """
+        if source is not None:
+            self._sources[name] = source
+        self.metrics.file_queued(name, size)
+        await self._queue.put((name, url))
+
+    async def join(self):
+        """
+        Waits until every submitted file is downloaded and verified and stops the worker pool.
+
+        :return: Number of saved, linked, skipped and failed files.
+        :rtype: dict
+        """
+        try:
+            await self._queue.join()
+            while self._verifications:
+                await asyncio.gather(*self._verifications)
+                await self._queue.join()
+        finally:
+            for task in self._workers + list(self._verifications):
+                task.cancel()
+            await asyncio.gather(*self._workers, *self._verifications, return_exceptions=True)
+            self._workers = []
+            await asyncio.gather(*self._journal_saves)
+            await self._write_journal()
+            if self.store is not None:
+                self.store.save()
+
+        return dict(self.stats)
+
+    def new_session(self, limit=None):
+        """
+        Creates an aiohttp session with a keep-alive connection pool.
+
+        :param limit: Size of the connection pool. Defaults to the concurrency limit.
+        :type limit: int
+        :return: Aiohttp session.
+        :rtype: aiohttp.ClientSession
+        """
+        return aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=limit or self.max_concurrency))
+
+    async def run(self, content_to_download, session=None):
+        """
+        Downloads all the given files, keeping up to `max_concurrency` transfers in flight.
+
+        :param content_to_download: Dictionary with data for downloading files, the key - file name,
+            the value - file URL.
+        :type content_to_download: dict
+        :param session: Optional aiohttp session to reuse. A new one is created and closed otherwise.
+        :type session: aiohttp.ClientSession
+        :return: Number of saved, linked, skipped and failed files.
+        :rtype: dict
+        """
+        if session is None:
+            async with self.new_session() as session:
+                return await self.run(content_to_download, session)
+
+        await self.start(session)
+        try:
+            for name, url in content_to_download.items():
+                await self.submit(name, url)
+        finally:
+            stats = await self.join()
+        return stats
@@ -0,0 +1,7 @@
+import os
+
+API_URL = 'https://www.patreon.com/api/posts'
+HEADERS = {'User-Agent': 'Mozilla/5.0 (compatible; Google-Podcast)'}
+
+# Folder keeping the state shared between runs: caches, journals and the like.
+STATE_DIR = os.path.join(os.path.expanduser('~'), '.patreonscraper')
@@ -0,0 +1,151 @@
+import asyncio
+import hashlib
+import multiprocessing
+import os
+import queue
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+from engine import Engine
+from layout import DEFAULT_TEMPLATE, shard_safe
+from metrics import aggregate_snapshots
+from resolver import CampaignCache
+
+
+def shard_of(url, count):
+    """
+    Returns the shard a creator belongs to. The result only depends on the URL, so separate hosts working
+    on the same creator list agree on it.
+
+    :param url: Patreon creator URL.
+    :type url: str
+    :param count: Number of shards.
+    :type count: int
+    :return: Shard index, from 0 to count - 1.
+    :rtype: int
+    """
+    digest = hashlib.sha1(CampaignCache.key(url).encode('utf-8')).digest()
+    return int.from_bytes(digest[:8], 'big') % count
+
+
+def partition(urls, count):
+    """
+    Splits creator URLs into shards.
+
+    :param urls: List of Patreon creator URLs.
+    :type urls: list
+    :param count: Number of shards.
+    :type count: int
+    :return: List of `count` lists of creator URLs, some of them possibly empty.
+    :rtype: list
+    """
+    shards = [[] for _ in range(count)]
+    for url in dict.fromkeys(urls):
+        shards[shard_of(url, count)].append(url)
+    return shards
+
+
+def run_shard(index, urls, download_folder, engine_options, events, interval=0.5):
+    """
+    Runs an Engine over one shard of the creators. Runs in a worker process.
+
+    Log lines and metrics snapshots, at most one every `interval` seconds, are sent to the parent through
+    the events queue.
+
+    :param index: Shard index.
+    :type index: int
+    :param urls: Creator URLs of the shard.
+    :type urls: list
+    :param download_folder: Path to the folder where the downloaded files are saved.
+    :type download_folder: str
+    :param engine_options: Extra arguments passed to Engine.
+    :type engine_options: dict
+    :param events: Queue receiving ('log', index, line) and ('progress', index, snapshot) tuples.
+    :type events: multiprocessing.Queue
+    :param interval: Minimum time between two metrics snapshots, in seconds.
+    :type interval: float
+    :return: Number of saved, linked, skipped and failed files.
+    :rtype: dict
+    """
+    last_report = 0.0
+
+    def log(text):
+        events.put(('log', index, text))
+
+    def progress(metrics):
+        nonlocal last_report
+        now = time.monotonic()
+        if now - last_report >= interval:
+            last_report = now
+            events.put(('progress', index, metrics.snapshot()))
+
+    engine = Engine(urls, download_folder, log=log, progress=progress, **engine_options)
+    try:
+        stats = asyncio.run(engine.run())
+    finally:
+        engine.close()
+    events.put(('progress', index, engine.metrics.snapshot()))
+    return stats
+
+
+def run_sharded(urls, download_folder, processes=None, log=print, progress=None, **engine_options):
+    """
+    Downloads the files of many creators with a pool of processes, each running its own Engine over a shard of
+    the creators.
+
+    The parent only relays the log lines of the shards and combines their metrics. The shards share the download
+    folder and all the state kept between runs: the manifest is a SQLite database and the JSON stores merge
+    their changes on save, see state.JsonStore. The layout gets a folder per creator unless it already tells
+    the creators apart, see layout.shard_safe.
+
+    :param urls: List of Patreon creator URLs.
+    :type urls: list
+    :param download_folder: Path to the folder where the downloaded files are saved.
+    :type download_folder: str
+    :param processes: Number of worker processes. Defaults to the number of CPUs.
+    :type processes: int
+    :param log: Callable receiving log lines, prefixed with the shard number.
+    :type log: callable
+    :param progress: Optional callable receiving the combined metrics snapshot, see metrics.aggregate_snapshots.
+    :type progress: callable
+    :param engine_options: Extra arguments passed to every Engine, e.g. extensions. Must be picklable.
+    :return: Number of saved, linked, skipped and failed files of all the shards.
+    :rtype: dict
+    """
+    shards = [shard for shard in partition(urls, processes or os.cpu_count() or 1) if shard]
+    engine_options = dict(engine_options, layout=shard_safe(engine_options.get('layout', DEFAULT_TEMPLATE)))
+    stats = {'saved': 0, 'linked': 0, 'skipped': 0, 'failed': 0}
+    snapshots = {}
+    if not shards:
+        return stats
+
+    def relay(event):
+        kind, index, payload = event
+        if kind == 'log':
+            log(f'[{index + 1}/{len(shards)}] {payload}')
+        else:
+            snapshots[index] = payload
+            if progress is not None:
+                progress(aggregate_snapshots(snapshots.values()))
+
+    with multiprocessing.Manager() as manager, ProcessPoolExecutor(len(shards)) as pool:
+        events = manager.Queue()
+        futures = [pool.submit(run_shard, index, shard, download_folder, engine_options, events)
+                   for index, shard in enumerate(shards)]
+
+        while not all(future.done() for future in futures) or not events.empty():
+            try:
+                relay(events.get(timeout=0.2))
+            except queue.Empty:
+                pass
+
+        for index, future in enumerate(futures):
+            try:
+                shard_stats = future.result()
+            except Exception as e:
+                log(f'[{index + 1}/{len(shards)}] Shard failed: {e}')
+                continue
+            for key in stats:
+                stats[key] += shard_stats[key]
+
+    return stats
@@ -0,0 +1,204 @@
+import asyncio
+import contextlib
+import copy
+import json
+import os
+import threading
+import time
+
+
+@contextlib.contextmanager
+def file_lock(path, timeout=30.0, stale=60.0):
+    """
+    Holds an exclusive lock on a file while the block runs.
+
+    The lock is a '.lock' file created next to the file with O_EXCL, which works between processes and between
+    hosts sharing the folder. A lock older than `stale` seconds was left by a crashed process and is broken.
+    Waiting sleeps, so callers on an event loop run this on a worker thread, see JsonStore.asave.
+
+    :param path: Path to the locked file.
+    :type path: str
+    :param timeout: Time to wait for the lock, in seconds.
+    :type timeout: float
+    :param stale: Age after which a lock is broken, in seconds.
+    :type stale: float
+    :return: Context manager.
+    """
+    lock_path = path + '.lock'
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            os.close(os.open(lock_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+            break
+        except FileExistsError:
+            try:
+                if break_stale_lock(lock_path, stale):
+                    continue
+            except OSError:
+                continue
+            if time.monotonic() > deadline:
+                raise TimeoutError(f'Could not lock {path}')
+            time.sleep(0.01)
+
+    try:
+        yield
+    finally:
+        try:
+            os.remove(lock_path)
+        except OSError:
+            pass
+
+
+def break_stale_lock(lock_path, stale):
+    """
+    Removes a lock file left by a crashed process.
+
+    The lock is first renamed to a name only this process uses, which is atomic, and removed only if it is still
+    the stale file that was looked at. A fresh lock taken by another process in the meantime is put back.
+
+    :param lock_path: Path to the lock file.
+    :type lock_path: str
+    :param stale: Age after which a lock is broken, in seconds.
+    :type stale: float
+    :return: Whether the lock was broken.
+    :rtype: bool
+    :raises OSError: If the lock file changed while looking at it.
+    """
+    status = os.stat(lock_path)
+    if time.time() - status.st_mtime <= stale:
+        return False
+
+    moved_path = f'{lock_path}.{os.getpid()}.stale'
+    os.replace(lock_path, moved_path)
+    moved_status = os.stat(moved_path)
+    if (moved_status.st_ino, moved_status.st_mtime_ns) != (status.st_ino, status.st_mtime_ns):
+        try:
+            # Creating a link fails if a lock exists again, so the lock of a third process is never replaced.
+            os.link(moved_path, lock_path)
+        finally:
+            os.remove(moved_path)
+        return False
+    os.remove(moved_path)
+    return True
+
+
+def merge(base, ours, theirs, depth=1):
+    """
+    Three-way merge of dictionaries: applies the changes made from `base` to `ours` on top of `theirs`.
+
+    :param base: Entries as they were loaded.
+    :type base: dict
+    :param ours: Entries as they are now.
+    :type ours: dict
+    :param theirs: Entries as they are on disk, possibly changed by another process in the meantime.
+    :type theirs: dict
+    :param depth: Number of nested dictionary levels merged key by key. Deeper values are replaced as a whole.
+    :type depth: int
+    :return: Merged entries.
+    :rtype: dict
+    """
+    merged = dict(theirs)
+    for key in base.keys() - ours.keys():
+        merged.pop(key, None)
+
+    for key, value in ours.items():
+        if key in base and base[key] == value:
+            continue
+        if depth > 1 and isinstance(value, dict) and isinstance(merged.get(key), dict):
+            value = merge(base.get(key) or {}, value, merged[key], depth - 1)
+        merged[key] = value
+    return merged
+
+
+class JsonStore:
+    """
+    Base class for the small pieces of state kept between runs as JSON files.
+
+    Subclasses work on the `entries` dictionary and call save() when they are done. Several processes, even on
+    different hosts, can share a store: save() locks the file and merges the changes made since loading into
+    what is on disk, so the entries written by the others are kept. asave() does the same on a worker thread,
+    so waiting for the lock does not hold up an event loop.
+    """
+
+    # Number of nested dictionary levels merged key by key on save.
+    merge_depth = 1
+    # Whether the file is removed instead of saved once no entries are left.
+    remove_if_empty = False
+
+    def __init__(self, path):
+        """
+        Initializes the store and loads the existing entries. A missing or unreadable file gives an empty store.
+
+        :param path: Path to the JSON file.
+        :type path: str
+        """
+        self.path = path
+        self.entries = self._load()
+        self._base = copy.deepcopy(self.entries)
+        self._save_lock = None
+        self._save_requests = 0
+        self._saved_requests = 0
+
+    def _load(self):
+        if os.path.exists(self.path):
+            try:
+                with open(self.path, encoding='utf-8') as f:
+                    return json.load(f)
+            except (OSError, ValueError):
+                pass
+        return {}
+
+    def write(self, base, entries):
+        """
+        Merges the changes from `base` to `entries` into the file on disk, under its lock. The file is replaced
+        atomically, so an interrupted run cannot corrupt it. Only reads its arguments, so it can run on a thread.
+
+        :param base: Entries as they were last loaded or written.
+        :type base: dict
+        :param entries: Entries to write.
+        :type entries: dict
+        :return: Entries as written.
+        :rtype: dict
+        """
+        os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+        with file_lock(self.path):
+            merged = merge(base, entries, self._load(), self.merge_depth)
+            if merged or not self.remove_if_empty:
+                temp_path = f'{self.path}.{os.getpid()}.{threading.get_ident()}.tmp'
+                with open(temp_path, 'w', encoding='utf-8') as f:
+                    json.dump(merged, f, indent=1)
+                os.replace(temp_path, self.path)
+            elif os.path.exists(self.path):
+                os.remove(self.path)
+        return merged
+
+    def save(self):
+        """
+        Writes the entries to disk.
+
+        :return: None
+        """
+        self.entries = self.write(self._base, self.entries)
+        self._base = copy.deepcopy(self.entries)
+
+    async def asave(self):
+        """
+        Writes the entries to disk on a worker thread. Changes made while writing are kept for the next save,
+        and saves asked for while another one runs are done together.
+
+        :return: None
+        """
+        self._save_requests += 1
+        request = self._save_requests
+        if self._save_lock is None:
+            self._save_lock = asyncio.Lock()
+
+        async with self._save_lock:
+            if self._saved_requests >= request:
+                return
+            covered = self._save_requests
+            entries = copy.deepcopy(self.entries)
+            merged = await asyncio.get_running_loop().run_in_executor(None, self.write, self._base, entries)
+            self.entries = merge(entries, self.entries, merged, self.merge_depth)
+            self._base = copy.deepcopy(merged)
+            self._saved_requests = covered
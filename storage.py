@@ -0,0 +1,202 @@
+import asyncio
+import errno
+import os
+import shutil
+
+MB = 1024 * 1024
+
+
+class DiskFullError(OSError):
+    """
+    Raised when a file does not fit on the disk even with no other transfer running.
+    """
+
+
+class DiskBudget:
+    """
+    Admission control of the disk space of the download folder.
+
+    A transfer reserves the bytes it is going to write before it starts, from the size announced by the posts feed
+    and then from Content-Length. A transfer is only admitted if the free space, minus what the running transfers
+    reserved, stays above `min_free`; otherwise it waits until another transfer is done, so a full disk pauses
+    the download instead of leaving many truncated files behind. A file that does not fit while no other transfer
+    holds a reservation fails at once, as waiting would hold its worker forever.
+    """
+
+    def __init__(self, folder, min_free=1024 * MB, poll_interval=5.0, log=print):
+        """
+        Initializes the DiskBudget.
+
+        :param folder: Path to the download folder.
+        :type folder: str
+        :param min_free: Free space to keep on the disk, in bytes.
+        :type min_free: int
+        :param poll_interval: Time between two checks of the free space while waiting, in seconds.
+        :type poll_interval: float
+        :param log: Callable receiving log lines.
+        :type log: callable
+        """
+        self.folder = folder
+        self.min_free = min_free
+        self.poll_interval = poll_interval
+        self.log = log
+        self._reserved = {}
+        self._released = asyncio.Event()
+
+    def free_space(self):
+        """
+        Returns the free space of the disk holding the download folder.
+
+        :return: Free space in bytes.
+        :rtype: int
+        """
+        return shutil.disk_usage(self.folder).free
+
+    def available(self, name=None):
+        """
+        Returns the space a transfer can still reserve.
+
+        :param name: File whose own reservation is not counted, as it is being replaced.
+        :type name: str
+        :return: Available space in bytes, possibly negative.
+        :rtype: int
+        """
+        reserved = sum(self._reserved.values()) - self._reserved.get(name, 0)
+        return self.free_space() - reserved - self.min_free
+
+    def _check_fits(self, name, size):
+        others = any(reserved for other, reserved in self._reserved.items() if other != name)
+        if self.available(name) < size and not others:
+            raise DiskFullError(errno.ENOSPC, f'{size / MB:.1f} MB needed, {max(self.available(name), 0) / MB:.1f} MB '
+                                              f'available above the {self.min_free / MB:.0f} MB kept free')
+
+    async def admit(self, name, size):
+        """
+        Reserves space for a file, waiting while there is not enough.
+
+        :param name: File name.
+        :type name: str
+        :param size: Bytes about to be written, or None if unknown.
+        :type size: int
+        :return: None
+        :raises DiskFullError: If the file does not fit and no other transfer holds a reservation.
+        """
+        size = size or 0
+        waiting = False
+        while self.available(name) < size:
+            self._check_fits(name, size)
+            if not waiting:
+                waiting = True
+                self.log(f'- Waiting for free space: | {name} | needs {size / MB:.1f} MB, '
+                         f'{max(self.available(name), 0) / MB:.1f} MB available above the '
+                         f'{self.min_free / MB:.0f} MB kept free.')
+            self._released.clear()
+            try:
+                await asyncio.wait_for(self._released.wait(), self.poll_interval)
+            except asyncio.TimeoutError:
+                pass
+
+        if waiting:
+            self.log(f'- Enough free space for | {name} |, resuming.')
+        self._reserved[name] = size
+
+    def grow(self, name, size):
+        """
+        Replaces the reservation of a file once its exact size is known, without waiting: the transfer then holds
+        a connection, which is not kept idle while other transfers finish.
+
+        :param name: File name.
+        :type name: str
+        :param size: Bytes about to be written.
+        :type size: int
+        :return: None
+        :raises DiskFullError: If the file does not fit and no other transfer holds a reservation.
+        """
+        self._check_fits(name, size)
+        self._reserved[name] = size
+
+    def release(self, name):
+        """
+        Drops the reservation of a file once it is written or abandoned.
+
+        :param name: File name.
+        :type name: str
+        :return: None
+        """
+        if self._reserved.pop(name, None):
+            self._released.set()
+
+
+def sync_files(paths):
+    """
+    Makes sure the written content of files reached the disk. Only these files are flushed, not the other
+    writes pending on the system, so a batch costs as little as its own files.
+
+    :param paths: Paths to the files.
+    :type paths: list
+    :return: None
+    """
+    for path in paths:
+        with open(path, 'rb+') as f:
+            os.fsync(f.fileno())
+
+
+class SyncBatcher:
+    """
+    Groups the fsync calls of the finished files.
+
+    A file is synced before it is renamed into place, so a crash never leaves a file that looks complete but is
+    not on the disk. Files finishing close together are synced one after the other on a worker thread, up to
+    `batch_size` of them, or whatever finished within `delay` seconds, so the event loop waits for one thread hop
+    per batch instead of one per file.
+    """
+
+    def __init__(self, batch_size=32, delay=1.0):
+        """
+        Initializes the SyncBatcher.
+
+        :param batch_size: Maximum number of files synced together. 1 syncs every file on its own.
+        :type batch_size: int
+        :param delay: Maximum time a file waits for others to join its batch, in seconds.
+        :type delay: float
+        """
+        self.batch_size = batch_size
+        self.delay = delay
+        self._paths = []
+        self._done = None
+        self._timer = None
+
+    async def sync(self, path):
+        """
+        Waits until the content of a file reached the disk.
+
+        :param path: Path to the file, closed.
+        :type path: str
+        :return: None
+        """
+        loop = asyncio.get_running_loop()
+        if self._done is None:
+            self._done = loop.create_future()
+            self._timer = loop.call_later(self.delay, self._flush)
+        done = self._done
+        self._paths.append(path)
+        if len(self._paths) >= self.batch_size:
+            self._flush()
+        await asyncio.shield(done)
+
+    def _flush(self):
+        paths, done = self._paths, self._done
+        self._paths, self._done = [], None
+        self._timer.cancel()
+        if not paths:
+            return
+
+        task = asyncio.get_running_loop().run_in_executor(None, sync_files, paths)
+
+        def settle(task):
+            if task.exception() is not None:
+                done.set_exception(task.exception())
+            else:
+                done.set_result(None)
+
+        task.add_done_callback(settle)
@@ -0,0 +1,106 @@
+import json
+
+import pytest
+
+from decoder import PageDecoder, decode_page, slim_included, slim_post
+
+PAGE = {
+    'data': [
+        {'id': '1', 'type': 'post',
+         'attributes': {'title': 'Café {1} [beta] "quoted"', 'published_at': '2024-01-02T03:04:05.000+00:00',
+                        'content': '<p>' + 'x' * 300 + '</p>', 'post_file': {'name': 'a.zip', 'url': 'https://f/a'}},
+         'relationships': {'attachments': {'data': [{'id': '10', 'type': 'attachment'}]},
+                           'user': {'data': {'id': '7', 'type': 'user'}}}},
+        {'id': '2', 'type': 'post', 'attributes': {'title': 'Zweite Übung ✓', 'published_at': None},
+         'relationships': {}},
+    ],
+    'included': [
+        {'id': '10', 'type': 'attachment', 'attributes': {'name': 'b\\c.package', 'url': 'https://f/b'}},
+        {'id': '11', 'type': 'media', 'attributes': {'file_name': 'c.zip', 'download_url': 'https://f/c',
+                                                      'size_bytes': 1234567890, 'image_urls': {'x': 'y'}}},
+        {'id': '7', 'type': 'user', 'attributes': {'full_name': 'Creator'}},
+    ],
+    'links': {'next': 'https://www.patreon.com/api/posts?page%5Bcursor%5D=abc'},
+    'meta': {'pagination': {'total': 2}},
+}
+BODY = json.dumps(PAGE, ensure_ascii=False, indent=1).encode('utf-8')
+
+
+def expected():
+    return {
+        'data': [slim_post(post) for post in PAGE['data']],
+        'included': [item for item in map(slim_included, PAGE['included']) if item is not None],
+        'links': PAGE['links'],
+        'meta': PAGE['meta'],
+    }
+
+
+def test_whole_body():
+    assert decode_page([BODY]) == expected()
+
+
+def test_every_split_point():
+    for split in range(1, len(BODY)):
+        assert decode_page([BODY[:split], BODY[split:]]) == expected(), split
+
+
+def test_single_bytes():
+    # Splits the multi-byte characters and the numbers too.
+    assert decode_page(BODY[i:i + 1] for i in range(len(BODY))) == expected()
+
+
+def test_number_at_the_end_of_a_chunk():
+    body = b'{"meta": 12345, "data": []}'
+    split = body.index(b'345')
+    assert decode_page([body[:split], body[split:]]) == {'meta': 12345, 'data': []}
+
+
+def test_streamed_key_that_is_not_a_list():
+    assert decode_page([b'{"data": null, "included": {"a": 1}}']) == {'data': None, 'included': {'a': 1}}
+
+
+def test_drops_objects_that_are_not_files():
+    page = decode_page([b'{"data": [1, "x", {"id": "1"}], "included": [{"type": "user", "id": "2"}]}'])
+    assert [post['id'] for post in page['data']] == ['1']
+    assert page['included'] == []
+
+
+def test_raw_text_is_not_kept():
+    decoder = PageDecoder()
+    decoder.feed(BODY[:BODY.index(b'"included"')])
+    # Only the text after the last complete post is buffered.
+    assert len(decoder._buffer) < 100
+    decoder.feed(BODY[BODY.index(b'"included"'):])
+    assert decoder.close() == expected()
+
+
+@pytest.mark.parametrize('body', [
+    b'',
+    b'{"data": [',
+    b'{"data": [{"id": "1"}',
+    b'{"data": [{"id": "1"},',
+    b'{"data": [{"id": "1"}], "links": {"next": "htt',
+    b'{"meta": 12',
+    b'{"data": []',
+])
+def test_truncated(body):
+    with pytest.raises(ValueError):
+        decode_page([body])
+
+
+@pytest.mark.parametrize('body', [
+    b'[]',
+    b'{"data" [] }',
+    b'{"data": [] "meta": 1}',
+    b'{"data": [{"id": "1"} {"id": "2"}]}',
+    b'{"data": [{"id": "1",}]}',
+    b'{"meta": tru}',
+])
+def test_malformed(body):
+    with pytest.raises(ValueError):
+        decode_page([body])
+
+
+def test_invalid_utf8():
+    with pytest.raises(ValueError):
+        decode_page([b'{"meta": "\xff"}'])
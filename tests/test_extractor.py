@@ -0,0 +1,63 @@
+from extractor import extract_attachments
+
+
+def page(relationships, included, post_file=None):
+    attributes = {'title': 'Post', 'published_at': '2024-01-01'}
+    if post_file is not None:
+        attributes['post_file'] = post_file
+    return {'data': [{'id': 'p', 'attributes': attributes, 'relationships': relationships}], 'included': included}
+
+
+def links(kind, *ids):
+    return {'data': [{'type': kind, 'id': item_id} for item_id in ids]}
+
+
+def attachment(item_id, name, url):
+    return {'type': 'attachment', 'id': item_id, 'attributes': {'name': name, 'url': url}}
+
+
+def media(item_id, name, url, size=None):
+    return {'type': 'media', 'id': item_id, 'attributes': {'file_name': name, 'download_url': url,
+                                                         'size_bytes': size}}
+
+
+def test_same_file_as_attachment_and_media_is_reported_once():
+    files = list(extract_attachments(page(
+        {'attachments': links('attachment', '1'), 'media': links('media', 'm1')},
+        [attachment('1', 'a.zip', 'u1'), media('m1', 'a.zip', 'd1', 5)])))
+    assert [(file.name, file.url, file.size, file.id) for file in files] == [('a.zip', 'u1', 5, '1')]
+    assert files[0].post_title == 'Post' and files[0].published_at == '2024-01-01'
+
+
+def test_different_files_sharing_a_name_are_all_reported():
+    files = list(extract_attachments(page(
+        {'attachments': links('attachment', '1', '2'), 'media': links('media', 'm1', 'm2')},
+        [attachment('1', 'a.zip', 'u1'), attachment('2', 'a.zip', 'u2'),
+         media('m1', 'a.zip', 'd1', 5), media('m2', 'a.zip', 'd2', 7)])))
+    assert [(file.name, file.url, file.size) for file in files] == [('a.zip', 'u1', 5), ('a (2).zip', 'u2', 7)]
+
+
+def test_renamed_file_without_an_id_gets_its_position():
+    files = list(extract_attachments(page(
+        {'attachments': links('attachment', '1')},
+        [attachment('1', 'a.zip', 'u1')], post_file={'name': 'a.zip', 'url': 'pf'})))
+    # The post file pairs with the first attachment of its name, so there is only one file.
+    assert [(file.name, file.url, file.id) for file in files] == [('a.zip', 'pf', '1')]
+
+    files = list(extract_attachments(page(
+        {'attachments': links('attachment', '1', '2')},
+        [attachment('1', 'readme', 'u1'), {'type': 'attachment', 'attributes': {'name': 'readme', 'url': 'u2'}}])))
+    assert [file.name for file in files] == ['readme']
+
+
+def test_an_object_linked_twice_is_reported_once():
+    files = list(extract_attachments(page(
+        {'attachments': links('attachment', '1', '1')}, [attachment('1', 'a.zip', 'u1')])))
+    assert [file.name for file in files] == ['a.zip']
+
+
+def test_links_to_missing_or_unusable_objects_are_skipped():
+    files = list(extract_attachments(page(
+        {'attachments': links('attachment', '1', '2', '3')},
+        [attachment('2', '', 'u2'), {'type': 'user', 'id': '3'}])))
+    assert files == []
@@ -0,0 +1,67 @@
+from feed import SyncState, is_seen, mark_key, post_mark, trim_page
+
+
+def mark(published_at, post_id):
+    return {'published_at': published_at, 'post_id': post_id}
+
+
+def test_advance_to_the_newest_post(tmp_path):
+    state = SyncState(str(tmp_path / 'sync.json'))
+    state.advance('c', [mark('2024-01-03', '3'), mark('2024-01-01', '1'), mark('2024-01-02', '2')])
+    assert state.get('c') == mark('2024-01-03', '3')
+
+
+def test_advance_stops_below_the_oldest_failed_post(tmp_path):
+    state = SyncState(str(tmp_path / 'sync.json'))
+    posts = [mark('2024-01-04', '4'), mark('2024-01-03', '3'), mark('2024-01-02', '2'), mark('2024-01-01', '1')]
+    state.advance('c', posts, failed=[mark('2024-01-04', '4'), mark('2024-01-02', '2')])
+    assert state.get('c') == mark('2024-01-01', '1')
+
+
+def test_advance_does_not_move_if_the_oldest_post_failed(tmp_path):
+    state = SyncState(str(tmp_path / 'sync.json'))
+    state.entries['c'] = mark('2023-12-31', '0')
+    state.advance('c', [mark('2024-01-02', '2'), mark('2024-01-01', '1')], failed=[mark('2024-01-01', '1')])
+    assert state.get('c') == mark('2023-12-31', '0')
+
+
+def test_advance_never_moves_back(tmp_path):
+    state = SyncState(str(tmp_path / 'sync.json'))
+    state.entries['c'] = mark('2024-01-05', '5')
+    state.advance('c', [mark('2024-01-01', '1')])
+    assert state.get('c') == mark('2024-01-05', '5')
+
+
+def test_advance_without_posts(tmp_path):
+    state = SyncState(str(tmp_path / 'sync.json'))
+    state.advance('c', [])
+    assert state.get('c') is None
+
+
+def test_mark_key_compares_ids_as_numbers():
+    assert mark_key(mark('2024-01-01', '10')) > mark_key(mark('2024-01-01', '9'))
+
+
+def test_post_without_a_date():
+    post = {'id': '5', 'attributes': {}}
+    assert post_mark(post) == mark(None, '5')
+    assert is_seen(post, mark('2024-01-01', '1'))
+    assert not is_seen(post, None)
+
+
+def test_trim_page_drops_seen_posts_and_their_files():
+    page = {
+        'data': [
+            {'id': '2', 'attributes': {'published_at': '2024-01-02'},
+             'relationships': {'attachments': {'data': [{'type': 'attachment', 'id': '20'}]}}},
+            {'id': '1', 'attributes': {'published_at': '2024-01-01'},
+             'relationships': {'attachments': {'data': [{'type': 'attachment', 'id': '10'}]}}},
+        ],
+        'included': [{'type': 'attachment', 'id': '20'}, {'type': 'attachment', 'id': '10'}],
+    }
+    trimmed, reached_seen = trim_page(page, mark('2024-01-01', '1'))
+    assert reached_seen
+    assert [post['id'] for post in trimmed['data']] == ['2']
+    assert trimmed['included'] == [{'type': 'attachment', 'id': '20'}]
+
+    assert trim_page(page, None) == (page, False)
@@ -0,0 +1,78 @@
+import asyncio
+import json
+
+from state import JsonStore, merge
+
+
+def test_merge_keeps_their_changes():
+    base = {'a': 1}
+    assert merge(base, {'a': 1}, {'a': 2, 'b': 3}) == {'a': 2, 'b': 3}
+
+
+def test_merge_applies_our_changes():
+    base = {'a': 1, 'b': 1}
+    assert merge(base, {'a': 5, 'b': 1, 'c': 6}, {'a': 1, 'b': 2}) == {'a': 5, 'b': 2, 'c': 6}
+
+
+def test_merge_conflict_is_won_by_ours():
+    assert merge({'a': 1}, {'a': 2}, {'a': 3}) == {'a': 2}
+
+
+def test_merge_deletions():
+    # We deleted 'a', they deleted 'b'; both stay deleted, their new 'c' is kept.
+    assert merge({'a': 1, 'b': 1}, {'b': 1}, {'a': 1, 'c': 1}) == {'c': 1}
+
+
+def test_merge_deletion_against_their_change():
+    assert merge({'a': 1}, {}, {'a': 2}) == {}
+
+
+def test_merge_depth():
+    base = {'urls': {'x': 1}}
+    ours = {'urls': {'x': 1, 'y': 2}}
+    theirs = {'urls': {'x': 1, 'z': 3}}
+    assert merge(base, ours, theirs, depth=2) == {'urls': {'x': 1, 'y': 2, 'z': 3}}
+    assert merge(base, ours, theirs, depth=1) == {'urls': {'x': 1, 'y': 2}}
+
+
+def test_merge_does_not_change_its_arguments():
+    base, ours, theirs = {'a': {'x': 1}}, {'a': {'x': 2}}, {'a': {'x': 1, 'y': 1}}
+    merge(base, ours, theirs, depth=2)
+    assert (base, ours, theirs) == ({'a': {'x': 1}}, {'a': {'x': 2}}, {'a': {'x': 1, 'y': 1}})
+
+
+def test_stores_sharing_a_file(tmp_path):
+    path = str(tmp_path / 'state.json')
+    first, second = JsonStore(path), JsonStore(path)
+    first.entries['a'] = 1
+    first.save()
+    second.entries['b'] = 2
+    second.save()
+    first.entries['c'] = 3
+    first.save()
+    with open(path, encoding='utf-8') as f:
+        assert json.load(f) == {'a': 1, 'b': 2, 'c': 3}
+    assert first.entries == {'a': 1, 'b': 2, 'c': 3}
+
+
+def test_unreadable_file_gives_an_empty_store(tmp_path):
+    path = tmp_path / 'state.json'
+    path.write_text('{"a": ', encoding='utf-8')
+    assert JsonStore(str(path)).entries == {}
+
+
+def test_asave_keeps_changes_made_while_writing(tmp_path):
+    path = str(tmp_path / 'state.json')
+    store = JsonStore(path)
+
+    async def run():
+        store.entries['a'] = 1
+        saving = asyncio.ensure_future(store.asave())
+        await asyncio.sleep(0)
+        store.entries['b'] = 2
+        await saving
+        await store.asave()
+
+    asyncio.run(run())
+    assert store.entries == {'a': 1, 'b': 2}
+    assert JsonStore(path).entries == {'a': 1, 'b': 2}
@@ -0,0 +1,177 @@
+import asyncio
+import os
+import zipfile
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+
+# Folder inside the download folder receiving the files that failed verification.
+QUARANTINE_NAME = '.quarantine'
+
+# First bytes of the archive formats whose content cannot be tested without extra dependencies.
+SIGNATURES = {
+    '.rar': b'Rar!\x1a\x07',
+    '.7z': b'7z\xbc\xaf\x27\x1c',
+    '.package': b'DBPF',
+}
+
+
+def check_zip(path):
+    """
+    Reads every member of a zip archive and checks its CRC.
+
+    Encrypted members and compression methods Python does not support cannot be tested and are accepted.
+
+    :param path: Path to the archive.
+    :type path: str
+    :return: Description of the problem, or None if the archive is intact.
+    :rtype: str or None
+    """
+    try:
+        with zipfile.ZipFile(path) as archive:
+            bad_member = archive.testzip()
+    except (RuntimeError, NotImplementedError):
+        return None
+    except (zipfile.BadZipFile, zlib.error, EOFError, OSError) as e:
+        return f'broken zip archive ({e})'
+    if bad_member is not None:
+        return f'broken zip archive member {bad_member}'
+    return None
+
+
+def check_signature(path, signature):
+    """
+    Checks that a file starts with the signature of its format, which catches e.g. an HTML error page saved
+    under an archive name.
+
+    :param path: Path to the file.
+    :type path: str
+    :param signature: Expected first bytes.
+    :type signature: bytes
+    :return: Description of the problem, or None if the signature matches.
+    :rtype: str or None
+    """
+    with open(path, 'rb') as f:
+        if f.read(len(signature)) != signature:
+            return f'not a {os.path.splitext(path)[1]} file'
+    return None
+
+
+def verify_file(path, size=None, archives=True):
+    """
+    Checks a downloaded file: its size on disk and, for archives, its content.
+
+    Zip archives are test-read in full. Other archive formats are only checked for their signature; their
+    completeness rests on the size check against Content-Length done while downloading.
+
+    :param path: Path to the file.
+    :type path: str
+    :param size: Expected size in bytes, e.g. from Content-Length.
+    :type size: int
+    :param archives: Whether to check the content of archives.
+    :type archives: bool
+    :return: Description of the problem, or None if the file is fine.
+    :rtype: str or None
+    """
+    actual_size = os.path.getsize(path)
+    if size is not None and actual_size != size:
+        return f'{actual_size} bytes instead of {size}'
+    if not archives:
+        return None
+
+    extension = os.path.splitext(path)[1].lower()
+    if extension == '.zip':
+        return check_zip(path)
+    if extension in SIGNATURES:
+        return check_signature(path, SIGNATURES[extension])
+    return None
+
+
+def quarantine(path, folder):
+    """
+    Moves a file that failed verification out of the download folder. An earlier file of the same name in
+    the quarantine is kept, the new one gets the first free number suffix, e.g. 'name.2.zip'.
+
+    :param path: Path to the file.
+    :type path: str
+    :param folder: Path to the quarantine folder.
+    :type folder: str
+    :return: New path of the file.
+    :rtype: str
+    """
+    os.makedirs(folder, exist_ok=True)
+    target_path = os.path.join(folder, os.path.basename(path))
+    stem, extension = os.path.splitext(target_path)
+    number = 2
+    while os.path.exists(target_path):
+        target_path = f'{stem}.{number}{extension}'
+        number += 1
+    os.replace(path, target_path)
+    return target_path
+
+
+class Verifier:
+    """
+    Verifies downloaded files on a small thread pool, so reading archives back does not hold up the downloads.
+    Failed files are moved to a quarantine folder.
+    """
+
+    def __init__(self, quarantine_folder, workers=2, archives=True):
+        """
+        Initializes the Verifier.
+
+        :param quarantine_folder: Path to the folder receiving the files that failed verification.
+        :type quarantine_folder: str
+        :param workers: Number of files verified at the same time.
+        :type workers: int
+        :param archives: Whether to check the content of archives.
+        :type archives: bool
+        """
+        self.quarantine_folder = quarantine_folder
+        self.archives = archives
+        self.executor = ThreadPoolExecutor(workers, thread_name_prefix='verify')
+
+    @classmethod
+    def inside(cls, download_folder, **kwargs):
+        """
+        Creates a verifier quarantining the files into a folder inside the download folder.
+
+        :param download_folder: Path to the download folder.
+        :type download_folder: str
+        :param kwargs: Extra arguments passed to Verifier.
+        :return: Verifier.
+        :rtype: Verifier
+        """
+        return cls(os.path.join(download_folder, QUARANTINE_NAME), **kwargs)
+
+    async def check(self, path, size=None):
+        """
+        Verifies a file on the thread pool, see verify_file.
+
+        :param path: Path to the file.
+        :type path: str
+        :param size: Expected size in bytes.
+        :type size: int
+        :return: Description of the problem, or None if the file is fine.
+        :rtype: str or None
+        """
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, verify_file, path, size, self.archives)
+
+    def quarantine(self, path):
+        """
+        Moves a file into the quarantine folder.
+
+        :param path: Path to the file.
+        :type path: str
+        :return: New path of the file.
+        :rtype: str
+        """
+        return quarantine(path, self.quarantine_folder)
+
+    def close(self):
+        """
+        Waits for the running checks and stops the thread pool.
+
+        :return: None
+        """
+        self.executor.shutdown()
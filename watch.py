@@ -0,0 +1,179 @@
+import asyncio
+import random
+import time
+
+from engine import Engine, dated_folder
+
+# Suffixes of the polling intervals in a watch file, in seconds.
+INTERVAL_UNITS = {'s': 1, 'm': 60, 'h': 3600, 'd': 86400}
+
+
+def parse_interval(text):
+    """
+    Parses a polling interval like '90s', '30m', '6h' or '1d'. A bare number counts minutes.
+
+    :param text: Interval.
+    :type text: str
+    :return: Interval in seconds.
+    :rtype: float
+    :raises ValueError: If the interval is not a positive duration.
+    """
+    text = text.strip().lower()
+    unit = INTERVAL_UNITS.get(text[-1:])
+    seconds = float(text[:-1]) * unit if unit else float(text) * 60
+    if seconds <= 0:
+        raise ValueError(f'Invalid interval: {text}')
+    return seconds
+
+
+def read_watch_file(path, default_interval):
+    """
+    Reads the creators to watch from a text file, one per line: a creator URL, optionally followed by its polling
+    interval, e.g. 'https://www.patreon.com/name 6h'. Empty lines and lines starting with '#' are ignored.
+
+    :param path: Path to the text file.
+    :type path: str
+    :param default_interval: Interval of the creators without one, in seconds.
+    :type default_interval: float
+    :return: Polling interval of every creator URL, in seconds.
+    :rtype: dict
+    :raises ValueError: If an interval is invalid.
+    """
+    intervals = {}
+    with open(path, encoding='utf-8') as f:
+        for line in f:
+            if not line.strip() or line.lstrip().startswith('#'):
+                continue
+            url, *interval = line.split()
+            intervals[url] = parse_interval(interval[0]) if interval else default_interval
+    return intervals
+
+
+class Watcher:
+    """
+    Polls many creators, each on its own interval, and downloads their new files.
+
+    One Engine and one aiohttp session live across the polls, so the campaign IDs, the high-water marks, the cached
+    posts pages, the manifest and the connection pool stay warm in memory. The watcher always downloads
+    incrementally: polling a creator without new posts costs a single conditional request to the posts API,
+    answered by 304 Not Modified. A file that failed keeps its post new, so the next poll tries it again. A poll
+    that fails as a whole is logged and the creators are polled again on their next turn.
+
+    Each next poll is shifted by a random fraction of the interval, up to `jitter`, so creators added together do
+    not keep hitting Patreon at the same moment. Creators due at the same time are polled by the same engine run.
+    """
+
+    def __init__(self, intervals, root, dated=True, jitter=0.1, log=print, **engine_options):
+        """
+        Initializes the Watcher.
+
+        :param intervals: Polling interval of every creator URL, in seconds.
+        :type intervals: dict
+        :param root: Path to the main download folder.
+        :type root: str
+        :param dated: Whether to download into the 'Downloaded at <date>' folder of the day of each poll.
+        :type dated: bool
+        :param jitter: Largest shift of a poll, as a fraction of the interval.
+        :type jitter: float
+        :param log: Callable receiving log lines.
+        :type log: callable
+        :param engine_options: Extra arguments passed to the Engine.
+        """
+        self.intervals = dict(intervals)
+        self.root = root
+        self.dated = dated
+        self.jitter = jitter
+        self.log = log
+        self.engine_options = dict(engine_options, incremental=True)
+        self.engine_options.setdefault('store_folder', root)
+        self.engine = None
+        self.due = dict.fromkeys(self.intervals, time.monotonic())
+
+    def folder(self):
+        """
+        Returns the download folder of the next poll, creating it if needed.
+
+        :return: Path to the download folder.
+        :rtype: str
+        """
+        return dated_folder(self.root) if self.dated else self.root
+
+    def prepare(self):
+        """
+        Creates the engine, or a new one when the download folder changed with the day. The old engine is closed;
+        the session of the watcher is not tied to an engine and stays open.
+
+        :return: Engine of the next poll.
+        :rtype: Engine
+        """
+        folder = self.folder()
+        if self.engine is None or self.engine.download_folder != folder:
+            if self.engine is not None:
+                self.engine.close()
+            self.engine = Engine(list(self.intervals), folder, log=self.log, **self.engine_options)
+        return self.engine
+
+    def next_poll(self, url):
+        """
+        Schedules the next poll of a creator, one jittered interval from now.
+
+        :param url: Patreon creator URL.
+        :type url: str
+        :return: None
+        """
+        interval = self.intervals[url]
+        self.due[url] = time.monotonic() + interval * (1 + random.uniform(-self.jitter, self.jitter))
+
+    async def poll(self, urls, session):
+        """
+        Downloads the new files of the given creators.
+
+        :param urls: Patreon creator URLs.
+        :type urls: list
+        :param session: Aiohttp session shared by the polls.
+        :type session: aiohttp.ClientSession
+        :return: Number of saved, linked, skipped and failed files of this poll.
+        :rtype: dict
+        """
+        engine = self.prepare()
+        before = dict(engine.metrics.outcomes)
+        stats = await engine.run(urls, session)
+        return {outcome: count - before.get(outcome, 0) for outcome, count in stats.items()}
+
+    async def run(self, cycles=None):
+        """
+        Polls the creators until cancelled.
+
+        The session is created once and kept for the whole life of the watcher, also when the engine is replaced
+        with the day, so its connection pool stays warm.
+
+        :param cycles: Optional number of polls after which to stop, e.g. for a test run.
+        :type cycles: int
+        :return: None
+        """
+        try:
+            async with self.prepare().new_session() as session:
+                while cycles is None or cycles > 0:
+                    wait = min(self.due.values()) - time.monotonic()
+                    if wait > 0:
+                        await asyncio.sleep(wait)
+
+                    now = time.monotonic()
+                    urls = [url for url, due in self.due.items() if due <= now]
+                    for url in urls:
+                        self.next_poll(url)
+
+                    self.log(f'- Polling {len(urls)} creators...')
+                    try:
+                        stats = await self.poll(urls, session)
+                    except Exception as e:
+                        # A long running watcher outlives a full disk, a locked database or a network outage.
+                        self.log(f'Error occurred while polling: {e!r}')
+                    else:
+                        self.log(f'- Poll completed! {stats}')
+                    if cycles is not None:
+                        cycles -= 1
+        finally:
+            if self.engine is not None:
+                self.engine.close()
+                self.engine = None